@@ -0,0 +1,57 @@
+# Benchmark of cosmic ray rejection with lib/math/spectra on simulated
+# spectra, so no camera is needed.
+
+import time
+import numpy as np
+from lib.math import spectra
+
+NPIX = 1024
+NSPEC = 200
+NCOSMIC = 3
+
+x = np.arange(NPIX, dtype=np.float64)
+clean = 100 + 2000 * np.exp(-(x - 400)**2 / 20.) + \
+    500 * np.exp(-(x - 700)**2 / 2.)
+rand = np.random.RandomState(0)
+raw = rand.poisson(clean, (NSPEC, NPIX)).astype(np.float64)
+for i in range(NSPEC):
+    raw[i, rand.choice(NPIX, NCOSMIC, replace=False)] += 3000
+dark = rand.poisson(100, (5, NPIX))
+
+def count_bad(specs):
+    err = np.abs(specs - (clean - 100))
+    return int((err > 6 * np.sqrt(clean) + 20).sum())
+
+# Median filter with a python loop over the pixels
+start = time.time()
+for i in range(10):
+    med = np.array([np.median(raw[i, max(j-2, 0):j+3]) for j in range(NPIX)])
+stop = time.time()
+print 'python loop median filter: %.2f ms / spectrum' % \
+    ((stop - start) / 10 * 1e3)
+
+start = time.time()
+for i in range(NSPEC):
+    med = spectra.median_filter(raw[i], 5)
+stop = time.time()
+print 'median_filter: %.2f ms / spectrum' % ((stop - start) / NSPEC * 1e3)
+
+start = time.time()
+med = spectra.median_filter(raw, 5)
+stop = time.time()
+print 'median_filter on all frames: %.2f ms / spectrum' % \
+    ((stop - start) / NSPEC * 1e3)
+
+for nhistory in (0, 5):
+    pipe = spectra.SpectrumPipeline(nhistory=nhistory)
+    key = pipe.backgrounds.make_key(exposure=1.0)
+    pipe.backgrounds.add(key, dark)
+    out = np.empty_like(raw)
+    start = time.time()
+    for i in range(NSPEC):
+        pipe.process(raw[i], key=key, out=out[i])
+    stop = time.time()
+    print 'SpectrumPipeline(nhistory=%d): %.2f ms / spectrum, ' \
+        '%d pixels patched, %d bad pixels left (of %d cosmics)' % \
+        (nhistory, (stop - start) / NSPEC * 1e3, pipe.get_patched_count(),
+        count_bad(out), NSPEC * NCOSMIC)
@@ -0,0 +1,41 @@
+# Benchmark of binary block transfers with lib/visaio, using the mock
+# VISA backend so no hardware is needed.
+
+import time
+import struct
+import numpy as np
+from lib import visaio
+
+N = 1000000
+data = np.random.randn(N).astype(np.float32)
+block = visaio.make_block(data, 'REAL32', 'big') + '\n'
+
+backend = visaio.MockVisaBackend({'CURV?': block}, max_chunk=65536)
+io = visaio.VisaIO(backend)
+
+start = time.time()
+for i in range(10):
+    backend.write('CURV?')
+    raw = ''
+    while len(raw) < len(block):
+        buf = np.empty(65536, dtype=np.uint8)
+        n = backend.readinto(buf, 0, 65536)
+        raw += buf[:n].tostring()
+    ndigits = int(raw[1])
+    vals = [struct.unpack('>f', raw[2+ndigits+j:6+ndigits+j])[0] \
+        for j in range(0, 4 * N, 4)]
+stop = time.time()
+print 'string concatenation + struct.unpack: %.3f sec' % ((stop - start) / 10)
+
+start = time.time()
+for i in range(10):
+    vals = io.ask_block('CURV?', 'REAL32', 'big')
+stop = time.time()
+print 'VisaIO.ask_block: %.3f sec' % ((stop - start) / 10)
+
+out = np.empty(N, dtype=np.float32)
+start = time.time()
+for i in range(10):
+    vals = io.ask_block('CURV?', 'REAL32', 'big', out=out)
+stop = time.time()
+print 'VisaIO.ask_block with out buffer: %.3f sec' % ((stop - start) / 10)
@@ -7,21 +7,38 @@ import NI_DAQ
 import Standa_USMC
 Standa_USMC.detect_instruments() # Creates Standa0 and Standa1
 NI_DAQ.detect_instruments() # creates NI DAQ instruments for all NI DAQs in the system
-ddg = qt.instruments.create('ddg','SR_DG645',address='GPIB0::15::INSTR')
-tl = qt.instruments.create('tl','ThorLabs_ITC4001',address='USB0::0x1313::0x804A::M00277475::INSTR')
-verdi = qt.instruments.create('verdi','Coherent_VerdiG_USB')
-xps = qt.instruments.create('xps','Newport_XPS',address='192.168.0.254')
-li = qt.instruments.create('lockin','Lockin_726x',address='GPIB0::17::INSTR')
-ls332 = qt.instruments.create('ls332','Lakeshore_332',address='GPIB0::18::INSTR')
-fsm = qt.instruments.create('fsm','Newport_FSM')
-snspd = qt.instruments.create('snspd','SSPDController',ni_ins=qt.instruments['NIDAQ6216'],resistance=200)
-fm = qt.instruments.create('fm','Coherent_FieldMasterGS',address='ASRL7::INSTR')
-sr400 = qt.instruments.create('sr400','SR_400',address='GPIB1::20::INSTR')
-ls211 = qt.instruments.create('ls211','Lakeshore_211',address='COM8')
-awg = qt.instruments.create('awg','Tektronix_AWG5014',address='GPIB0::14::INSTR')
-pxi = qt.instruments.create('pxi','NI_RFSG',resource_name='IQ5611')
-tlm = qt.instruments.create('tlm','Thorlabs_TSP01',address='USB0::0x1313::0x80F8::M00291947::INSTR')
-em = qt.instruments.create('em','environment_monitor')
+_ins = qt.instruments.create_many([
+    {'name': 'ddg', 'type': 'SR_DG645', 'kwargs': {'address': 'GPIB0::15::INSTR'}},
+    {'name': 'tl', 'type': 'ThorLabs_ITC4001', 'kwargs': {'address': 'USB0::0x1313::0x804A::M00277475::INSTR'}},
+    {'name': 'verdi', 'type': 'Coherent_VerdiG_USB'},
+    {'name': 'xps', 'type': 'Newport_XPS', 'kwargs': {'address': '192.168.0.254'}},
+    {'name': 'lockin', 'type': 'Lockin_726x', 'kwargs': {'address': 'GPIB0::17::INSTR'}},
+    {'name': 'ls332', 'type': 'Lakeshore_332', 'kwargs': {'address': 'GPIB0::18::INSTR'}},
+    {'name': 'fsm', 'type': 'Newport_FSM'},
+    {'name': 'snspd', 'type': 'SSPDController', 'kwargs': {'ni_ins': qt.instruments.ref('NIDAQ6216'), 'resistance': 200}},
+    {'name': 'fm', 'type': 'Coherent_FieldMasterGS', 'kwargs': {'address': 'ASRL7::INSTR'}},
+    {'name': 'sr400', 'type': 'SR_400', 'kwargs': {'address': 'GPIB1::20::INSTR'}},
+    {'name': 'ls211', 'type': 'Lakeshore_211', 'kwargs': {'address': 'COM8'}},
+    {'name': 'awg', 'type': 'Tektronix_AWG5014', 'kwargs': {'address': 'GPIB0::14::INSTR'}},
+    {'name': 'pxi', 'type': 'NI_RFSG', 'kwargs': {'resource_name': 'IQ5611'}},
+    {'name': 'tlm', 'type': 'Thorlabs_TSP01', 'kwargs': {'address': 'USB0::0x1313::0x80F8::M00291947::INSTR'}},
+    {'name': 'em', 'type': 'environment_monitor'},
+])
+ddg = _ins['ddg']
+tl = _ins['tl']
+verdi = _ins['verdi']
+xps = _ins['xps']
+li = _ins['lockin']
+ls332 = _ins['ls332']
+fsm = _ins['fsm']
+snspd = _ins['snspd']
+fm = _ins['fm']
+sr400 = _ins['sr400']
+ls211 = _ins['ls211']
+awg = _ins['awg']
+pxi = _ins['pxi']
+tlm = _ins['tlm']
+em = _ins['em']
 #def __init__(self, name, ni_ins, resistance=500):
 
 #combined.add_variable_combined('waveoffset', [{
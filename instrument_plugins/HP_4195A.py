@@ -21,7 +21,7 @@ import visa
 import types
 import logging
 from time import sleep
-import struct
+import time
 import numpy
 import qt
 
@@ -43,6 +43,9 @@ class HP_4195A(Instrument):
     3. fix docstrings
     '''
 
+    # Sweep end bit of the status byte
+    STB_SWEEP_END = 0x01
+
     def __init__(self, name, address, reset=False):
         '''
         Initializes the HP_4195A, and communicates with the wrapper
@@ -229,13 +232,37 @@ class HP_4195A(Instrument):
             None
 
         Output:
-            data (int)  : list of data points
+            data (numpy array)  : data points
         '''
     
         data = self._visainstrument.ask('FMT2;A?')
 
-        d = [struct.unpack('>d', data[i:i+8])[0] for i in range(4, len(data),8)]
-        return d
+        # 4 byte header, followed by big-endian float64 values
+        npoints = (len(data) - 4) / 8
+        d = numpy.frombuffer(data, dtype='>f8', count=npoints, offset=4)
+        return d.astype(numpy.float64)
+
+    def wait_sweep(self, timeout=None):
+        '''
+        Trigger a sweep and wait until the sweep end bit is set in the
+        status byte. The GUI stays responsive while waiting.
+
+        Input:
+            timeout (float): maximum time to wait in seconds
+
+        Output:
+            True if the sweep finished, False on timeout
+        '''
+        # Reading the status byte clears it
+        self._visainstrument.stb
+        self.send_trigger()
+        start = time.time()
+        while not self._visainstrument.stb & self.STB_SWEEP_END:
+            if timeout is not None and time.time() - start > timeout:
+                logging.warning('Timeout waiting for sweep to finish')
+                return False
+            qt.msleep(0.01)
+        return True
 
 #### Functions for doing measurements
 
@@ -262,12 +289,14 @@ class HP_4195A(Instrument):
         
         print 'sending trigger to network analyzer, and wait to finish'
         print 'estimated waiting time: %.2f s' % sweep_time
-        self.send_trigger()
-        qt.msleep(sweep_time)
+        if not self.wait_sweep(timeout=sweep_time + 1.0):
+            # Abort the sweep and the pending query before giving up
+            self._visainstrument.clear()
+            qt.mend()
+            raise IOError('Timeout waiting for sweep to finish')
     
         print 'readout network analyzer'
         reply = self.read()
-        reply = numpy.array(reply)
     
         qt.mend()
 
@@ -289,7 +318,7 @@ class HP_4195A(Instrument):
         d.add_coordinate('freq [Hz]')
         d.add_value('S_ij [dB]')
         d.create_file(filepath=filepath)
-        d.add_data_point(zip(freqs, reply))
+        d.add_data_point(numpy.column_stack((freqs, reply)))
         d.close_file()
         if plot:
             p = qt.plot(d, name='netan', clear=True)
@@ -21,7 +21,7 @@ import visa
 import types
 import logging
 from time import sleep
-import struct
+import time
 import numpy
 
 import qt
@@ -44,6 +44,9 @@ class HP_8753C(Instrument):
     3. fix docstrings
     '''
 
+    # Message available bit of the status byte
+    STB_MAV = 0x10
+
     def __init__(self, name, address, reset=False):
         '''
         Initializes the HP_8753C, and communicates with the wrapper
@@ -196,23 +199,43 @@ class HP_8753C(Instrument):
             None
 
         Output:
-            data (int)  : list of data points
+            data (numpy array)  : real part of the data points
         '''
         data = self._visainstrument.ask('FORM2;DISPDATA;OUTPFORM;')
-        d = [struct.unpack('>f', data[i:i+4])[0] for i in range(4, len(data),8)]
-        return d
+        # 4 byte header, followed by big-endian (real, imag) float32 pairs
+        npoints = (len(data) - 4) / 8
+        d = numpy.frombuffer(data, dtype='>f4', count=2*npoints, offset=4)
+        return d[::2].astype(numpy.float64)
+
+    def wait_sweep(self, timeout=None):
+        '''
+        Start a single sweep and wait until it is finished, using the
+        OPC? query. The status byte is polled for a message available,
+        so the GUI stays responsive while waiting.
+
+        Input:
+            timeout (float): maximum time to wait in seconds
+
+        Output:
+            True if the sweep finished, False on timeout
+        '''
+        self._visainstrument.write('OPC?;SING;')
+        start = time.time()
+        while not self._visainstrument.stb & self.STB_MAV:
+            if timeout is not None and time.time() - start > timeout:
+                logging.warning('Timeout waiting for sweep to finish')
+                return False
+            qt.msleep(0.01)
+        self._visainstrument.read()
+        return True
 
 ### Functions for doing measurements
 
     def get_trace(self):
         '''
         This function performs a full measurement.
-        First a trigger is sent to initiate a sweep.
-        An estimate is made of the time the sweep takes.
-        After the estimated time the data is queried from
-        the device. Usually the estimated time is a bit
-        lower then the actual time, the device will
-        respond as soon as it is finished.
+        A single sweep is started and the data is queried from
+        the device as soon as the sweep has finished.
         It is assumed that the instrument is already on
         'trigger hold'-mode.
 
@@ -234,16 +257,18 @@ class HP_8753C(Instrument):
         IF_Bandwidth = self.get_IF_Bandwidth(query=False)
 
         freqs = numpy.linspace(startfreq,stopfreq,numpoints)
-        sweep_time = numpoints / IF_Bandwidth
+        sweep_time = float(numpoints) / IF_Bandwidth
 
         print 'sending trigger to network analyzer, and wait to finish'
         print 'estimated waiting time: %.2f s' % sweep_time
-        self.send_trigger()
-        qt.msleep(sweep_time)
+        if not self.wait_sweep(timeout=2 * sweep_time + self._visainstrument.timeout):
+            # Abort the sweep and the pending query before giving up
+            self._visainstrument.clear()
+            qt.mend()
+            raise IOError('Timeout waiting for sweep to finish')
 
         print 'reading out network analyzer'
         reply = self.read()
-        reply = numpy.array(reply)
 
         qt.mend()
 
@@ -265,7 +290,7 @@ class HP_8753C(Instrument):
         d.add_coordinate('freq [Hz]')
         d.add_value('S_ij [dB]')
         d.create_file(filepath=filepath)
-        d.add_data_point(zip(freqs, reply))
+        d.add_data_point(numpy.column_stack((freqs, reply)))
         d.close_file()
         if plot:
             p = qt.plot(d, name='netan', clear=True)
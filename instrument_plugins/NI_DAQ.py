@@ -17,7 +17,12 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import types
+import logging
+import gobject
+import numpy
 from lib.dll_support import nidaq
+from lib.dll_support import nidaq_stream
+from lib import streaming
 from instrument import Instrument
 import qt
 
@@ -29,6 +34,15 @@ def _get_channel(devchan):
         return devchan
     return parts[1]
 
+def _count_channels(chan):
+    '''Number of channels in a specification such as 'ai0:3'.'''
+    if ':' not in chan:
+        return 1
+    first, last = chan.split(':')
+    first = int(first.lstrip('abcdefghijklmnopqrstuvwxyz'))
+    last = int(last.lstrip('abcdefghijklmnopqrstuvwxyz'))
+    return abs(last - first) + 1
+
 class NI_DAQ(Instrument):
 
     def __init__(self, name, id):
@@ -36,6 +50,14 @@ class NI_DAQ(Instrument):
 
         self._id = id
 
+        self._cont_reader = None
+        self._cont_queue = None
+        self._cont_queue_used = False
+        self._cont_thread = None
+        self._cont_data = None
+        self._cont_data_queue = None
+        self._cont_data_hid = None
+
         for ch_in in self._get_input_channels():
             ch_in = _get_channel(ch_in)
             self.add_parameter(ch_in,
@@ -81,8 +103,27 @@ class NI_DAQ(Instrument):
             type=types.FloatType,
             units='s')
 
+        self.add_parameter('task_cache',
+            flags=Instrument.FLAG_GETSET,
+            type=types.BooleanType,
+            doc='Keep tasks committed between reads and writes (global '
+                'setting, shared by all NI DAQ devices)')
+
+        self.add_parameter('cont_overruns', flags=Instrument.FLAG_GET,
+            type=types.IntType)
+        self.add_parameter('cont_underruns', flags=Instrument.FLAG_GET,
+            type=types.IntType)
+        self.add_parameter('cont_samples', flags=Instrument.FLAG_GET,
+            type=types.IntType)
 
         self.add_function('reset')
+        self.add_function('clear_task_cache')
+        self.add_function('get_task_cache_stats')
+        self.add_function('hot_tasks')
+        self.add_function('start_continuous')
+        self.add_function('stop_continuous')
+        self.add_function('is_continuous_running')
+        self.add_function('get_continuous_data')
         self.add_function('digital_out')
         self.add_function('write')
         self.add_function('write_and_count')
@@ -92,6 +133,7 @@ class NI_DAQ(Instrument):
         self.reset()
         self.set_chan_config('RSE')
         self.set_count_time(1)
+        self.get_task_cache()
         self.get_all()
 
 
@@ -99,8 +141,12 @@ class NI_DAQ(Instrument):
         ch_in = [_get_channel(ch) for ch in self._get_input_channels()]
         self.get(ch_in)
 
+    def __del__(self):
+        self.stop_continuous()
+
     def reset(self):
         '''Reset device.'''
+        self.stop_continuous()
         nidaq.reset_device(self._id)
 
     def _get_input_channels(self):
@@ -122,10 +168,31 @@ class NI_DAQ(Instrument):
 
     def do_set_chan_config(self, val):
         self._chan_config = val
+        self.clear_task_cache()
 
     def do_set_count_time(self, val):
         self._count_time = val
 
+    def do_get_task_cache(self):
+        return nidaq.is_task_cache_enabled()
+
+    def do_set_task_cache(self, val):
+        nidaq.enable_task_cache(val)
+
+    def clear_task_cache(self):
+        '''Release all tasks of this device kept by the task cache.'''
+        nidaq.clear_task_cache(self._id)
+
+    def get_task_cache_stats(self):
+        return nidaq.get_task_cache_stats()
+
+    def hot_tasks(self):
+        '''
+        Return context manager that keeps tasks committed during a sweep,
+        even if the task_cache parameter is off.
+        '''
+        return nidaq.HotTasks()
+
     def do_get_counter(self, channel):
         devchan = '%s/%s' % (self._id, channel)
         src = self.get(channel + "_src")
@@ -168,8 +235,12 @@ class NI_DAQ(Instrument):
         # This routine is a slightly more general version of the set output
         # routine already written. The purpose here is to allow the user direct
         # access to the lower nidaq.py module's "write" function that allows
-        # setting of the frequency of the write, among other things.
-        devchan = '%s/%s' % (self._id, channel)
+        # setting of the frequency of the write, among other things. A list
+        # of channels writes data[i] to channel[i] simultaneously.
+        if type(channel) in (types.ListType, types.TupleType):
+            devchan = ','.join(['%s/%s' % (self._id, c) for c in channel])
+        else:
+            devchan = '%s/%s' % (self._id, channel)
         return nidaq.writearray(devchan, data, freq, minv, maxv,
                 timeout)
     def readarray(self, samples, trigchan, freq, minv, maxv,
@@ -206,9 +277,210 @@ class NI_DAQ(Instrument):
         return array_out
     # Dummy
     def do_set_counter_src(self, val, channel):
+        nidaq.release_channels(['%s/%s' % (self._id, channel)])
+        return True
+
+    def start_continuous(self, channel, freq=10000.0, chunk=1000,
+            reduce=None, factor=1, queue_size=16, minv=-10.0, maxv=10.0,
+            clock=None, data=None, update_interval=0.5, simulate=False):
+        '''
+        Starts continuous acquisition of analog inputs or a counter in a
+        background thread. Items are retrieved with get_continuous_data(),
+        passed to functions added with add_continuous_callback(), and / or
+        added to a Data object.
+
+        Items are dictionaries with 'data' (float[channels, n], counts per
+        sample for counters), 'start' (index of the first sample) and 'dt'
+        (seconds between samples).
+
+        Input:
+            channel (string)     : e.g. 'ai0', 'ai0:3' or 'ctr0'
+            freq (float)         : sample rate
+            chunk (int)          : samples per channel read at a time
+            reduce (string)      : None, 'decimate' (every factor-th
+                                   sample) or 'average' (mean of factor
+                                   samples)
+            factor (int)         : decimation / averaging factor
+            queue_size (int)     : maximum number of items waiting in the
+                                   queue; further items are dropped and
+                                   counted as overruns
+            minv, maxv (float)   : analog input range
+            clock (string)       : sample clock terminal for counters, e.g.
+                                   'ai/SampleClock' or 'PFI1'
+            data (Data)          : add samples to this Data object, from
+                                   the main loop every update_interval s
+            simulate (bool)      : use a simulated source instead of the
+                                   device, for testing
+
+        Output:
+            None
+        '''
+        self.stop_continuous()
+
+        is_counter = channel.startswith('ctr')
+        devchan = '%s/%s' % (self._id, channel)
+        if simulate:
+            if is_counter:
+                kind = 'counter'
+            else:
+                kind = 'ai'
+            source = nidaq_stream.SimulatedSource(freq, chunk,
+                nchannels=_count_channels(channel), kind=kind)
+        elif is_counter:
+            if clock is None:
+                raise ValueError('Counters need a sample clock terminal')
+            src = self.get(channel + "_src")
+            if src is not None and src != '':
+                src = '/%s/%s' % (self._id, src)
+            source = nidaq_stream.CounterSource('/' + devchan, freq, chunk,
+                '/%s/%s' % (self._id, clock), src=src)
+        else:
+            source = nidaq_stream.AISource(devchan, freq, chunk, minv, maxv,
+                config=self._chan_config)
+
+        self._cont_reader = nidaq_stream.ContinuousReader(source,
+            reduce=reduce, factor=factor)
+        self._cont_queue = streaming.DataQueue(queue_size)
+        self._cont_queue_used = False
+        self._cont_thread = streaming.StreamThread(self._cont_reader.read,
+            queue=self._cont_queue, name='%s continuous' % self.get_name())
+
+        self._cont_data_queue = None
+        if data is not None:
+            self._cont_data = data
+            self._cont_data_queue = streaming.DataQueue(queue_size)
+            self._cont_thread.add_callback(self._cont_data_queue.put)
+            self._cont_data_hid = gobject.timeout_add(
+                int(update_interval * 1000), self._update_cont_data)
+
+        logging.debug(__name__ + ' : Starting continuous acquisition')
+        self._cont_reader.start()
+        self._cont_thread.start()
+
+    def stop_continuous(self):
+        '''
+        Stops continuous acquisition. Items still in the queue can be
+        retrieved with get_continuous_data().
+        '''
+        if self._cont_thread is None:
+            return
+        logging.debug(__name__ + ' : Stopping continuous acquisition')
+        self._cont_thread.stop()
+        self._cont_thread = None
+        self._cont_reader.stop()
+        if self._cont_data_hid is not None:
+            gobject.source_remove(self._cont_data_hid)
+            self._cont_data_hid = None
+            self._update_cont_data()
+            self._cont_data = None
+        self.get_cont_overruns()
+        self.get_cont_underruns()
+        self.get_cont_samples()
+
+    def is_continuous_running(self):
+        return self._cont_thread is not None and self._cont_thread.isAlive()
+
+    def get_continuous_data(self, timeout=1.0):
+        '''
+        Returns the next item from the queue, or None if nothing arrived
+        within timeout seconds.
+        '''
+        if self._cont_queue is None:
+            raise ValueError('Continuous acquisition not started')
+        if self._cont_thread is not None and \
+                self._cont_thread.get_error() is not None:
+            raise ValueError('Continuous acquisition failed: %s' % \
+                self._cont_thread.get_error())
+        if not self._cont_queue_used:
+            # Items dropped before anyone read the queue were not lost
+            self._cont_queue.reset_counters()
+            self._cont_queue_used = True
+        return self._cont_queue.get(timeout)
+
+    def create_scan_source(self, aochannels, ctrchan, freq, chunk=1000,
+            bufsize=None, simulate=False, rate_func=None):
+        '''
+        Returns a source for hardware-timed scans (see lib.rasterscan): a
+        continuous analog output on aochannels with counter ctrchan
+        latched on the AO sample clock. The counter source terminal is
+        taken from the <ctrchan>_src parameter.
+
+        Input:
+            aochannels (list): e.g. ['ao0', 'ao1']
+            ctrchan (string): e.g. 'ctr0'
+            freq (float): sample rate
+            chunk (int): samples per transfer
+            bufsize (int): buffer size in samples, default 4 chunks
+            simulate (bool): return a simulated source, counting with
+                rate_func(vdata) per second
+        '''
+        if simulate:
+            return nidaq_stream.SimulatedAOCounterSource(len(aochannels),
+                freq, chunk, bufsize=bufsize, rate_func=rate_func)
 
+        src = self.get(ctrchan + "_src")
+        if src is not None and src != '':
+            src = '/%s/%s' % (self._id, src)
+        aochans = ['%s/%s' % (self._id, ch) for ch in aochannels]
+        return nidaq_stream.AOCounterSource(aochans,
+            '/%s/%s' % (self._id, ctrchan), '/%s/ao/SampleClock' % self._id,
+            freq, chunk, src=src, bufsize=bufsize)
+
+    def add_continuous_callback(self, func):
+        '''
+        Call func(item) for every item, in the acquisition thread. Only
+        valid while the acquisition is running.
+        '''
+        if self._cont_thread is None:
+            raise ValueError('Continuous acquisition not started')
+        self._cont_thread.add_callback(func)
+
+    def remove_continuous_callback(self, func):
+        if self._cont_thread is not None:
+            self._cont_thread.remove_callback(func)
+
+    def _update_cont_data(self):
+        '''Add queued items to the Data object, in the main loop.'''
+        if self._cont_data is None:
+            return False
+        for item in self._cont_data_queue.get_all():
+            vals = item['data']
+            t = (item['start'] + numpy.arange(vals.shape[1])) * item['dt']
+            self._cont_data.add_data_point(t, *vals)
         return True
 
+    def do_get_cont_overruns(self):
+        '''
+        Number of times data was lost: the device buffer overflowed or an
+        item was dropped because a queue was full. The queue of
+        get_continuous_data() only counts once it is used, when only
+        callbacks or a Data object get the items it simply fills up.
+        '''
+        if self._cont_reader is None:
+            return 0
+        ret = self._cont_reader.get_overruns()
+        if self._cont_queue_used:
+            ret += self._cont_queue.get_overruns()
+        if self._cont_data_queue is not None:
+            ret += self._cont_data_queue.get_overruns()
+        return ret
+
+    def do_get_cont_underruns(self):
+        '''
+        Number of get_continuous_data() calls that timed out without data.
+        '''
+        if self._cont_queue is None:
+            return 0
+        return self._cont_queue.get_underruns()
+
+    def do_get_cont_samples(self):
+        '''
+        Number of samples per channel acquired since start_continuous().
+        '''
+        if self._cont_reader is None:
+            return 0
+        return self._cont_reader.get_sample_count()
+
     def digital_out(self, lines, val):
         devchan = '%s/%s' % (self._id, lines)
         return nidaq.write_dig_port8(devchan, val)
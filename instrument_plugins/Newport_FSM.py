@@ -18,8 +18,14 @@ import logging
 import time
 import qt
 import math
+import gobject
 import numpy as np
+from lib import trajectory
+from lib import rasterscan
 
+# Smooth moves between positions
+AO_SMOOTH_RATE = 50000.0 # Hz
+AO_SMOOTH_STEPS_PER_VOLT = 1000.0
 
 
 class Newport_FSM(Instrument):
@@ -68,6 +74,12 @@ class Newport_FSM(Instrument):
         # Instrument functions
         self.add_function('zero')
         self.add_function('move')
+        self.add_function('write_trajectory')
+        self.add_function('raster_scan')
+        self.add_function('stop_raster_scan')
+
+        self._raster = None
+        self._raster_hid = None
 
 
     def move(self, Xcoord, Ycoord):
@@ -116,24 +128,95 @@ class Newport_FSM(Instrument):
             logging.debug(__name__ + 'voltage bounds exceeded')
             return -1
 
-    def simple_sweep_um(self, x_um_array, rate, channel):
-        # This is a crude sweep that just uses repeated software calls. This is
-        # in contrast to a hardware-controlled sweep that loads the points and
-        # then writes them using hardware timing.
-        for x_c in x_um_array:
-            self.do_set_abs_position(x_c, channel)
-            time.sleep(1.0/float(rate))
-        return
+    def _um_to_V_checked(self, um_arrays, channels):
+        '''
+        Convert positions to a voltage trajectory, float64[len(channels), n],
+        and raise ValueError if any voltage is out of bounds.
+        '''
+        traj = np.vstack([self.convert_um_to_V(
+            np.asarray(um, dtype=np.float64), c)
+            for um, c in zip(um_arrays, channels)])
+        self._check_V(traj, channels)
+        return traj
 
-    def simple_sweep_V(self, x_V_array, rate, channel):
-        # This is a crude sweep that just uses repeated software calls. This is
-        # in contrast to a hardware-controlled sweep that loads the points and
-        # then writes them using hardware timing.
-        for x_V in x_V_array:
-            x_c = self.convert_V_to_um(x_V, channel)
-            self.do_set_abs_position(x_c, channel)
-            time.sleep(1.0/float(rate))
-        return
+    def _check_V(self, traj, channels):
+        trajectory.check_bounds(traj,
+            [self.fsm_dimensions[c]['min_v'] for c in channels],
+            [self.fsm_dimensions[c]['max_v'] for c in channels],
+            names=channels)
+
+    def write_trajectory(self, traj_V, rate, channels, approach=True):
+        '''
+        Write a voltage trajectory with hardware timing.
+
+        Input:
+            traj_V (array): float[len(channels), n] voltages, or float[n]
+                for a single channel
+            rate (float): samples per second
+            channels (string or list): 'X', 'Y' or a list of both
+            approach (bool): first move smoothly from the current position
+
+        Output:
+            number of samples written per channel
+        '''
+        if type(channels) in (types.StringType, types.UnicodeType):
+            channels = [channels]
+        traj = trajectory.as_trajectory(traj_V)
+        if traj.shape[0] != len(channels):
+            raise ValueError('Trajectory has %d axes for %d channels' % \
+                (traj.shape[0], len(channels)))
+        self._check_V(traj, channels)
+        if traj.shape[1] == 0:
+            return None
+
+        if approach:
+            self._approach_V(traj[:,0], channels)
+
+        ret = self._write_V(traj, rate, channels)
+        for i, c in enumerate(channels):
+            self.update_value('abs_position' + c,
+                self.convert_V_to_um(traj[i,-1], c))
+        return ret
+
+    def _approach_V(self, target_V, channels):
+        '''Move smoothly from the current position to target_V, if known.'''
+        cur = [self.get('abs_position' + c, query=False) for c in channels]
+        if None in cur:
+            return
+        start = [self.convert_um_to_V(p, c) for p, c in zip(cur, channels)]
+        self._write_V(trajectory.smooth_move(start, target_V,
+            AO_SMOOTH_STEPS_PER_VOLT), AO_SMOOTH_RATE, channels)
+
+    def _write_V(self, traj, rate, channels):
+        if traj.shape[1] == 0:
+            return None
+        # Finite tasks need at least two samples
+        if traj.shape[1] == 1:
+            traj = np.repeat(traj, 2, axis=1)
+        aochans = [self.fsm_dimensions[c]['ao_channel'] for c in channels]
+        if len(aochans) == 1:
+            traj = traj[0]
+            aochans = aochans[0]
+        # writearray raises on DAQmx errors; also check the count before
+        # the position is updated
+        n = self._ni63.writearray(traj, rate, -10.0, 10.0, 10.0, aochans)
+        if n != traj.shape[-1]:
+            raise RuntimeError('Wrote %s of %d samples' % (n, traj.shape[-1]))
+        return n
+
+    def simple_sweep_um(self, x_um_array, rate, channel, approach=True):
+        '''
+        Sweep one channel through the positions in x_um_array (um) at
+        rate points per second. The whole array is converted and checked
+        first, then written with hardware timing.
+        '''
+        traj = self._um_to_V_checked([x_um_array], [channel])
+        return self.write_trajectory(traj, rate, channel, approach=approach)
+
+    def simple_sweep_V(self, x_V_array, rate, channel, approach=True):
+        '''Like simple_sweep_um, with positions given in volts.'''
+        return self.write_trajectory(x_V_array, rate, channel,
+            approach=approach)
 
     def sweep_and_count(self, x_um_array, rate, ctr, term, channel):
         # Set the terminal of the corresponding counter to the desired terminal
@@ -150,20 +233,143 @@ class Newport_FSM(Instrument):
         self._ni63.set_count_time(prev_count_time)
         return carray
 
+    def raster_scan(self, x_um_array, y_um_array, rate, ctr='ctr0',
+            term='PFI0', snake=True, settle=0, move=20, chunk_time=0.05,
+            data=None, plot=True, h5data=None, wait=True, simulate=False,
+            rate_func=None):
+        '''
+        Hardware-timed 2D scan. The complete X/Y voltage trajectory is
+        computed up front and streamed to one continuous AO task, with the
+        counter sampled on the AO clock, so the image is taken without
+        per-line task setup. Lines are added to a Data object (and an
+        HDF5 dataset) as they complete.
+
+        Input:
+            x_um_array (array): pixel positions along a line (um)
+            y_um_array (array): line positions (um)
+            rate (float): pixels per second
+            ctr (string): counter channel
+            term (string): counter source terminal
+            snake (bool): alternate line direction, otherwise fly back
+            settle (int): samples to wait at the start of each line
+            move (int): samples for the move to the next line
+            chunk_time (float): seconds of samples per transfer
+            data (Data): data object with X, Y and counts columns, default
+                is to create one (with a Plot3D if plot is True)
+            h5data (HDF5Data): also store the image as dataset 'counts'
+            wait (bool): block until the scan is finished
+            simulate (bool): use a simulated output / counter, with
+                rate_func(V[2, n]) counts per second
+
+        Output:
+            counts image, float[len(y), len(x)], if wait is True
+        '''
+        self.stop_raster_scan()
+
+        x_um_array = np.asarray(x_um_array, dtype=np.float64)
+        y_um_array = np.asarray(y_um_array, dtype=np.float64)
+        x_V = self._um_to_V_checked([x_um_array], ['X'])[0]
+        y_V = self._um_to_V_checked([y_um_array], ['Y'])[0]
+
+        traj, index, line_end = trajectory.raster(x_V, y_V, snake=snake,
+            settle=settle, move=move)
+        chunk = max(int(rate * chunk_time), 1)
+
+        if not simulate:
+            getattr(self._ni63, 'set_' + ctr + '_src')(term)
+            # Go smoothly to the first pixel
+            self._approach_V(traj[:,0], ['X', 'Y'])
+
+        source = self._ni63.create_scan_source(
+            [self.fsm_dimensions['X']['ao_channel'],
+             self.fsm_dimensions['Y']['ao_channel']],
+            ctr, rate, chunk, simulate=simulate, rate_func=rate_func)
+        scan = rasterscan.RasterScan(source, traj, index, line_end,
+            (len(y_um_array), len(x_um_array)))
+
+        own_data = data is None
+        if own_data:
+            data = qt.Data(name='fsm_raster')
+            data.add_coordinate('X [um]')
+            data.add_coordinate('Y [um]')
+            data.add_value('counts')
+            data.create_file()
+            if plot:
+                qt.Plot3D(data, name='fsm_raster', style='image')
+
+        h5dset = None
+        if h5data is not None:
+            h5dset = h5data.create_dataset('counts',
+                (len(y_um_array), len(x_um_array)), 'f')
+            h5dset.attrs['x_um'] = x_um_array
+            h5dset.attrs['y_um'] = y_um_array
+
+        # Where the outputs stay after the last line
+        if snake and len(y_um_array) % 2 == 0:
+            x_end = x_um_array[0]
+        else:
+            x_end = x_um_array[-1]
+        self._raster = (scan, data, x_um_array, y_um_array, h5dset,
+            own_data, (x_end, y_um_array[-1]), simulate)
+        scan.start()
+        self._raster_hid = gobject.timeout_add(100, self._raster_update)
+
+        if not wait:
+            return None
+
+        while not scan.is_done():
+            qt.msleep(0.05)
+        self._raster_update()
+        if scan.get_error() is not None:
+            scan.stop()
+            raise ValueError('Raster scan failed: %s' % scan.get_error())
+        return scan.get_image()
+
+    def _raster_update(self):
+        '''Add completed lines to the Data object, in the main loop.'''
+        if self._raster is None:
+            return False
+        scan, data, x_um_array, y_um_array, h5dset, own_data, end, simulate = \
+            self._raster
+        for item in scan.get_lines():
+            j = item['line']
+            data.add_data_point(x_um_array,
+                np.repeat(y_um_array[j], len(x_um_array)), item['values'],
+                newblock=True)
+            if h5dset is not None:
+                h5dset[j,:] = item['values']
+
+        if scan.is_done():
+            # The thread ends on an error without stopping the tasks
+            if scan.get_error() is not None:
+                logging.warning('Raster scan failed: %s', scan.get_error())
+                scan.stop()
+            self._raster = None
+            self._raster_hid = None
+            if own_data:
+                data.close_file()
+            # A simulated scan does not move the mirror
+            if not simulate and scan.get_lines_done() == len(y_um_array):
+                self.update_value('abs_positionX', end[0])
+                self.update_value('abs_positionY', end[1])
+            return False
+        return True
+
+    def stop_raster_scan(self):
+        '''Abort a running raster scan.'''
+        if self._raster is None:
+            return
+        self._raster[0].stop()
+        self._raster_update()
+
     def AO_smooth(self, x_init, x_final, channel):
-        # Use a cosine function to interpolate between two positions
-        ao_smooth_rate = 50000.0 # Hz
-        ao_smooth_steps_per_volt = 1000.0 # 1000 steps per Volt of movement
-        # Convert initial and final positions to volts
+        # Use a cosine function to interpolate between two positions, with
+        # AO_SMOOTH_STEPS_PER_VOLT samples per volt of movement
         v_init = self.convert_um_to_V(x_init, channel)
         v_final = self.convert_um_to_V(x_final, channel)
-        # Compute the number of steps we're going to use
-        n_steps = math.ceil(np.abs((v_final-v_init))*ao_smooth_steps_per_volt)
-        # Create the array of voltage points
-        v_array = v_init*np.ones(n_steps) + (v_final-v_init)*(1.0-np.cos(np.linspace(0.0,np.pi,n_steps)))/2.0
-        # Now write the array to the appropriate DAQ channel
-        return self._ni63.writearray(v_array, ao_smooth_rate, -10.0, 10.0,
-                10.0, self.fsm_dimensions[channel]['ao_channel'])
+        traj = trajectory.smooth_move(v_init, v_final, AO_SMOOTH_STEPS_PER_VOLT)
+        self._check_V(traj, [channel])
+        return self._write_V(traj, AO_SMOOTH_RATE, [channel])
 
 
     def zero(self):
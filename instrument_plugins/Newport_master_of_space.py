@@ -14,6 +14,7 @@ import types
 import gobject
 import numpy as np
 from lib import config
+from lib.dll_support import adwin_stream
 
 # constants
 LINESCAN_CHECK_INTERVAL = 50 # [ms]
@@ -22,15 +23,36 @@ LINESCAN_CHECK_INTERVAL = 50 # [ms]
 # moment! fix that! (origin not taken into account)
 
 class master_of_space(CyclopeanInstrument):
-    def __init__(self, name, adwin):
+    def __init__(self, name, adwin, linescan_data=None, linescan_px_par=None,
+            adwin_device=None):
         """
         Parameters:
             adwin : string
                 qtlab-name of the adwin instrument to be used
+            linescan_data : list of int
+                DATA arrays the linescan process fills, one per value. If
+                given (with linescan_px_par), the pixels are transferred in
+                a background thread while the scan runs.
+            linescan_px_par : int
+                Par holding the linescan pixel clock
+            adwin_device : int
+                ADwin device number of the adwin instrument, required for
+                the transfer (with linescan_data)
         """
         CyclopeanInstrument.__init__(self, name, tags=['positioner'])
         self._adwin = qt.instruments[adwin]
 
+        if linescan_data is not None and adwin_device is None:
+            raise ValueError('adwin_device is required with linescan_data')
+
+        self._linescan_data_nos = linescan_data
+        self._linescan_px_par = linescan_px_par
+        self._adwin_device = adwin_device
+        self._adwin_dll = None
+        self._linescan_drain = None
+        self._linescan_data = None
+        self._linescan_positions = None
+
         #print 'init'
         # should not change often, hardcode is fine for now
         self.rt_dimensions = {
@@ -123,6 +145,8 @@ class master_of_space(CyclopeanInstrument):
                 flags=Instrument.FLAG_GET)
 
         self.add_function('linescan_start')
+        self.add_function('linescan_stop_transfer')
+        self.add_function('get_linescan_values')
 
         # for positioning with attocubes
         self.add_parameter('lt_settings',
@@ -179,7 +203,14 @@ class master_of_space(CyclopeanInstrument):
 
     # Line scan control
     def linescan_start(self, dimensions, starts, stops, steps, px_time,
-            relative=False, value='counts'):
+            relative=False, value='counts', data=None):
+        '''
+        Start a linescan on the adwin. If the instrument was created with
+        linescan_data, the pixels are read while the scan runs and, if
+        'data' is given, appended to that Data object as they arrive
+        (columns: positions of the scanned dimensions, then one column per
+        DATA array).
+        '''
         #print 'linescan_start'
 
         # for now, user has to wait until scan is finished
@@ -216,14 +247,54 @@ class master_of_space(CyclopeanInstrument):
                 print "Error in master_of_space.linescan_start: Exceeding max.min voltage"
                 print stops[i] / dim['micron_per_volt']
 
+        self._linescan_px_clock = 0
+        self._linescan_data = data
+        self._linescan_positions = [np.linspace(starts_v[i], stops_v[i],
+            steps) * self.dimensions[d]['micron_per_volt']
+            for i, d in enumerate(dimensions)]
+        drain = self._create_linescan_drain(steps)
+
         self._adwin.linescan(dacs, np.array(starts_v), np.array(stops_v),
                 steps, px_time, value=value, scan_to_start=True)
 
         # start monitoring the status
-        gobject.timeout_add(LINESCAN_CHECK_INTERVAL, self._linescan_check)
+        if drain is not None:
+            drain.start()
+            self._linescan_drain = drain
+            gobject.timeout_add(LINESCAN_CHECK_INTERVAL,
+                self._linescan_drain_check)
+        else:
+            gobject.timeout_add(LINESCAN_CHECK_INTERVAL, self._linescan_check)
 
         return True
 
+    def _create_linescan_drain(self, steps):
+        if self._linescan_data_nos is None or self._linescan_px_par is None:
+            return None
+        if self._adwin_dll is None:
+            from lib.dll_support import ADwin
+            # All ADwin objects share one lock, so the drain thread and
+            # the adwin instrument do not call the DLL at the same time.
+            self._adwin_dll = ADwin.ADwin(self._adwin_device)
+        reader = adwin_stream.ArrayReader(self._adwin_dll,
+            self._linescan_data_nos, steps, self._linescan_px_par)
+        return adwin_stream.ADwinDrain(reader)
+
+    def linescan_stop_transfer(self):
+        '''Stop the background transfer of linescan pixels.'''
+        if self._linescan_drain is not None:
+            self._linescan_drain.stop()
+
+    def get_linescan_values(self):
+        '''
+        Return the values of the last linescan, one array per DATA array,
+        filled up to the current pixel clock. Returns None without a
+        background transfer.
+        '''
+        if self._linescan_drain is None:
+            return None
+        return self._linescan_drain.get_reader().get_buffers()
+
     def do_get_linescan_running(self):
         return self._linescan_running
 
@@ -268,6 +339,38 @@ class master_of_space(CyclopeanInstrument):
 
             return False
 
+    # add the pixels transferred by the drain thread; signals (px clock
+    # and the data update) are emitted once per interval, not per pixel.
+    def _linescan_drain_check(self):
+        drain = self._linescan_drain
+        items = drain.get_items()
+        if len(items) > 0:
+            if self._linescan_data is not None:
+                start = items[0]['start']
+                stop = items[-1]['start'] + len(items[-1]['values'][0])
+                cols = [p[start:stop] for p in self._linescan_positions]
+                for i in range(len(items[0]['values'])):
+                    cols.append(np.concatenate(
+                        [item['values'][i] for item in items]))
+                self._linescan_data.add_data_point(*cols)
+
+            self._linescan_px_clock = drain.get_progress()
+            self.get_linescan_px_clock()
+
+        if not drain.is_done():
+            return True
+
+        err = drain.get_error()
+        if err is not None:
+            print 'Error in master_of_space: linescan transfer failed: %s' % err
+
+        if self._adwin.is_linescan_running():
+            return True
+
+        self._linescan_running = False
+        self.get_linescan_running()
+        return False
+
 
     ### managing the coordinate system
     def set_origin(self, relative=False, **kw):
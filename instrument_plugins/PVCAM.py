@@ -4,10 +4,12 @@
 
 from lib.dll_support import pvcam_dev
 reload(pvcam_dev)
+from lib import framering
 from instrument import Instrument
 import types
 import logging
 import time
+import numpy as np
 
 class PVCAM(Instrument):
     '''
@@ -31,7 +33,12 @@ class PVCAM(Instrument):
             flags=Instrument.FLAG_GETSET, minval=0, maxval=(len(self.get_readout_rates())-1))
         self.add_parameter('exposure_time', type=types.FloatType,
             flags=Instrument.FLAG_GETSET)
+        self.add_parameter('frame_count', type=types.IntType,
+            flags=Instrument.FLAG_GET)
+        self.add_parameter('dropped_frames', type=types.IntType,
+            flags=Instrument.FLAG_GET)
 
+        self._stream = None
 
 
         self.add_function('acquire_image')
@@ -39,6 +46,10 @@ class PVCAM(Instrument):
         self.add_function('get_sensor_size')
         self.add_function('get_readout_ports')
         self.add_function('rem')
+        self.add_function('start_continuous')
+        self.add_function('stop_continuous')
+        self.add_function('get_new_frames')
+        self.add_function('get_latest_frame')
 ##        self.add_function('get_all')
 ##        self.add_function('open')
 ##        self.add_function('close')
@@ -63,6 +74,7 @@ class PVCAM(Instrument):
         self._dev.uninitialize()
         return
     def rem(self):
+        self.stop_continuous()
         self.close()
         self.uninit()
         return
@@ -98,6 +110,63 @@ class PVCAM(Instrument):
         # return the array
         return image_array
 
+    def start_continuous(self, nframes=16, simulate=False):
+        '''
+        Start continuous acquisition into a circular buffer of nframes
+        frames. Get the frames with get_new_frames() or get_latest_frame().
+        With simulate=True a simulated camera with the same frame size
+        and exposure time is used.
+        '''
+        self.stop_continuous()
+        source = pvcam_dev.ContinuousSource(self._dev)
+        shape = source.ring_shape()
+        if simulate:
+            source = framering.SimulatedCamera(shape,
+                frame_time=self._dev.get_exposure_time())
+        ring = framering.FrameRing(nframes, shape, np.uint16)
+        self._stream = framering.FrameStream(source, ring)
+        self._stream.start()
+
+    def stop_continuous(self):
+        if self._stream is None:
+            return
+        self._stream.stop()
+        self.get_frame_count()
+        self.get_dropped_frames()
+
+    def is_continuous_running(self):
+        return self._stream is not None and self._stream.is_running()
+
+    def get_new_frames(self, timeout=0, copy=False):
+        '''
+        Return list of (frame number, image) of all frames acquired since
+        the last call. The images are views into the circular buffer,
+        valid until it wraps around, unless copy is True.
+        '''
+        if self._stream is None:
+            return []
+        return self._stream.get_ring().get_new(timeout, copy=copy)
+
+    def get_latest_frame(self, copy=True):
+        '''Return the most recent image of the continuous acquisition.'''
+        if self._stream is None:
+            return None
+        ret = self._stream.get_ring().get_latest(copy=copy)
+        if ret is None:
+            return None
+        return ret[1]
+
+    def do_get_frame_count(self):
+        if self._stream is None:
+            return 0
+        return self._stream.get_ring().get_frame_count()
+
+    def do_get_dropped_frames(self):
+        if self._stream is None:
+            return 0
+        ring = self._stream.get_ring()
+        return ring.get_dropped() + ring.get_overruns()
+
     def get_sensor_size(self):
         return self._dev.get_sensor_size()
 
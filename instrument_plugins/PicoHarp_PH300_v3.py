@@ -13,6 +13,8 @@ import qt
 from qt import *
 from numpy import *
 from data import Data
+from lib import streaming
+from lib.file_support import picoharp
 
 class PicoHarp_PH300_v3(Instrument): #1
     '''
@@ -42,6 +44,17 @@ class PicoHarp_PH300_v3(Instrument): #1
         if LibraryVersion[0][0:3] != '3.0':
             logging.warning(__name__ + ' : DLL Library supposed to be ver. 3.0, but found ' + LibraryVersion[0] + 'instead.')
 
+        self._mode = 0
+        self._tttr_thread = None
+        self._tttr_queue = None
+        self._tttr_writer = None
+        self._tttr_ring = []
+        self._tttr_records = 0
+        self._tttr_throughput = 0
+        self._tttr_fifo_fill = 0
+        self._tttr_fifo_full = 0
+        self._tttr_subscribers = []
+
         self.OpenDevice()
 
         self.add_parameter('Binning', flags = Instrument.FLAG_SET, type=types.IntType)
@@ -56,6 +69,10 @@ class PicoHarp_PH300_v3(Instrument): #1
         self.add_parameter('Flag_Overflow', flags = Instrument.FLAG_GET, type=types.BooleanType)
         self.add_parameter('Flag_FifoFull', flags = Instrument.FLAG_GET, type=types.BooleanType)
         self.add_parameter('SyncOffset', flags = Instrument.FLAG_SET, type=types.IntType)
+        self.add_parameter('TTTR_Records', flags = Instrument.FLAG_GET, type=types.IntType)
+        self.add_parameter('TTTR_Throughput', flags = Instrument.FLAG_GET, type=types.FloatType, units='records/s')
+        self.add_parameter('TTTR_FifoFill', flags = Instrument.FLAG_GET, type=types.FloatType)
+        self.add_parameter('TTTR_FifoFullCount', flags = Instrument.FLAG_GET, type=types.IntType)
         self.add_function('start_histogram_mode')
         self.add_function('get_Histogram')
         self.add_function('start_T2_mode')
@@ -68,6 +85,9 @@ class PicoHarp_PH300_v3(Instrument): #1
         self.add_function('set_InputCFD0')
         self.add_function('set_InputCFD1')
         self.add_function('get_CountRate')
+        self.add_function('start_TTTR_stream')
+        self.add_function('stop_TTTR_stream')
+        self.add_function('get_TTTR_block')
         self.start_histogram_mode()
 
 
@@ -105,11 +125,13 @@ class PicoHarp_PH300_v3(Instrument): #1
     def start_histogram_mode(self):
         if self._PH300_win32.PH_Initialize(self.DevIdx, 0) != 0:
             logging.warning(__name__ + ' : Histogramming mode could not be started')
+        self._mode = 0
         self._init_continue()
 
     def start_T2_mode(self):
         if self._PH300_win32.PH_Initialize(self.DevIdx, 2) != 0:
             logging.warning(__name__ + ' : T2 mode could not be started')
+        self._mode = 2
         self._init_continue()
 
     def get_DeviceType(self):
@@ -118,6 +140,7 @@ class PicoHarp_PH300_v3(Instrument): #1
     def start_T3_mode(self):
         if self._PH300_win32.PH_Initialize(self.DevIdx, 3) != 0:
             logging.warning(__name__ + ' : T3 mode could not be started')
+        self._mode = 3
         self._init_continue()
 
     def set_InputCFD0(self, level, zerocross):
@@ -304,4 +327,182 @@ class PicoHarp_PH300_v3(Instrument): #1
         if success < 0:
             logging.warning(__name__ + ' : error in PH_TTSetMarkerEdges')
 
-
+    # TTTR streaming
+
+    def start_TTTR_stream(self, tacq, filename=None, ring_size=8,
+            block_size=131072, queue_size=16):
+        '''
+        Starts a T2 / T3 measurement (see start_T2_mode / start_T3_mode)
+        and a thread that continuously reads the FIFO into a ring of
+        preallocated buffers. Each block read is decoded and published as a
+        dictionary with keys:
+            records: raw records, valid until the ring wraps around
+            T2 mode: channels, times (4 ps units), markers, marker_times
+            T3 mode: channels, nsync, dtime, markers, marker_nsync (no
+                times, so lib.math.correlation needs T2 mode)
+        Blocks are passed to the functions registered with
+        subscribe_TTTR(), called from the reader thread, and put in a queue
+        read by get_TTTR_block(). If the queue is full blocks are dropped.
+
+        Input:
+            tacq (int)       : acquisition time in ms
+            filename (string): optional PT2 / PT3 file to write records to
+            ring_size (int)  : number of read buffers
+            block_size (int) : maximum records per read (max 131072)
+            queue_size (int) : maximum number of blocks in the queue, 0 to
+                               not queue blocks
+
+        Output:
+            None
+        '''
+        if self._mode not in (2, 3):
+            raise ValueError('Start T2 or T3 mode first')
+        self.stop_TTTR_stream()
+
+        if len(self._tttr_ring) != ring_size or \
+                self._tttr_ring[0].size != block_size:
+            self._tttr_ring = [numpy.zeros(block_size, dtype=numpy.uint32)
+                for i in range(ring_size)]
+        self._tttr_index = 0
+
+        if self._mode == 2:
+            self._tttr_decoder = picoharp.T2Decoder()
+        else:
+            self._tttr_decoder = picoharp.T3Decoder()
+
+        if filename is not None:
+            self._tttr_writer = picoharp.TTTRFileWriter(filename,
+                mode=self._mode, header={
+                    'AcquisitionTime': tacq,
+                    'Resolution': self.get_Resolution(query=False) / 1000.0,
+                })
+
+        self._tttr_records = 0
+        self._tttr_fifo_full = 0
+        self._tttr_tstart = time()
+        self._tttr_tlast = self._tttr_tstart
+        self._tttr_nlast = 0
+
+        if queue_size > 0:
+            self._tttr_queue = streaming.DataQueue(queue_size)
+        else:
+            self._tttr_queue = None
+        self._tttr_thread = streaming.StreamThread(self._read_TTTR_block,
+            queue=self._tttr_queue, name='%s TTTR' % self.get_name())
+        for func in self._tttr_subscribers:
+            self._tttr_thread.add_callback(func)
+
+        self.StartMeas(tacq)
+        self._tttr_thread.start()
+
+    def _read_TTTR_block(self):
+        buf = self._tttr_ring[self._tttr_index]
+        n = self._PH300_win32.PH_TTReadData(self.DevIdx, buf.ctypes.data,
+            len(buf))
+        if n < 0:
+            raise ValueError('Error %d in PH_TTReadData' % n)
+
+        self._tttr_fifo_fill = float(n) / len(buf)
+        if self._do_get_Flag_FifoFull():
+            self._tttr_fifo_full += 1
+            logging.warning(__name__ + ' : FIFO full, records lost')
+
+        if n == 0:
+            if not self._do_get_MeasRunning():
+                self._finish_TTTR_stream()
+            else:
+                sleep(0.005)
+            return None
+
+        self._tttr_index = (self._tttr_index + 1) % len(self._tttr_ring)
+        records = buf[:n]
+        if self._tttr_writer is not None:
+            self._tttr_writer.write(records)
+
+        self._tttr_records += n
+        now = time()
+        if now - self._tttr_tlast > 1.0:
+            self._tttr_throughput = (self._tttr_records - self._tttr_nlast) / \
+                (now - self._tttr_tlast)
+            self._tttr_tlast = now
+            self._tttr_nlast = self._tttr_records
+
+        block = {'records': records}
+        if self._mode == 2:
+            keys = ('channels', 'times', 'markers', 'marker_times')
+        else:
+            keys = ('channels', 'nsync', 'dtime', 'markers', 'marker_nsync')
+        block.update(zip(keys, self._tttr_decoder.decode(records)))
+        return block
+
+    def _finish_TTTR_stream(self):
+        '''Called from the reader thread when the measurement is done.'''
+        self._tttr_thread.stop()
+        if self._tttr_writer is not None:
+            self._tttr_writer.close(stop_reason=0)
+            self._tttr_writer = None
+
+    def stop_TTTR_stream(self):
+        '''
+        Stops the measurement and the reader thread, and closes the file.
+
+        Input:
+            None
+
+        Output:
+            None
+        '''
+        if self._tttr_thread is None:
+            return
+        if self._tttr_thread.isAlive():
+            self.StopMeas()
+        self._tttr_thread.stop()
+        if self._tttr_writer is not None:
+            self._tttr_writer.close(stop_reason=1)
+            self._tttr_writer = None
+        elapsed = time() - self._tttr_tstart
+        if elapsed > 0:
+            self._tttr_throughput = self._tttr_records / elapsed
+        self.get_TTTR_Records()
+        self.get_TTTR_Throughput()
+        self.get_TTTR_FifoFullCount()
+
+    def is_TTTR_streaming(self):
+        return self._tttr_thread is not None and self._tttr_thread.isAlive()
+
+    def subscribe_TTTR(self, func):
+        '''
+        Call func(block) for every block read, see start_TTTR_stream.
+        The function is called from the reader thread.
+        '''
+        self._tttr_subscribers.append(func)
+        if self._tttr_thread is not None:
+            self._tttr_thread.add_callback(func)
+
+    def unsubscribe_TTTR(self, func):
+        if func in self._tttr_subscribers:
+            self._tttr_subscribers.remove(func)
+        if self._tttr_thread is not None:
+            self._tttr_thread.remove_callback(func)
+
+    def get_TTTR_block(self, timeout=1.0):
+        '''
+        Returns the next decoded block from the queue, or None if nothing
+        arrived within timeout seconds.
+        '''
+        if self._tttr_queue is None:
+            raise ValueError('TTTR stream not started with a queue')
+        return self._tttr_queue.get(timeout)
+
+    def _do_get_TTTR_Records(self):
+        return self._tttr_records
+
+    def _do_get_TTTR_Throughput(self):
+        return self._tttr_throughput
+
+    def _do_get_TTTR_FifoFill(self):
+        '''Fraction of the last read buffer that was filled.'''
+        return self._tttr_fifo_fill
+
+    def _do_get_TTTR_FifoFullCount(self):
+        return self._tttr_fifo_full
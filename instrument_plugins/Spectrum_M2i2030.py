@@ -19,7 +19,9 @@
 from ctypes import *
 from _Spectrum_M2i2030.errors import errors as _spcm_errors
 from _Spectrum_M2i2030.regs import regs as _spcm_regs
+from _Spectrum_M2i2030 import fifo
 from instrument import Instrument
+from lib import streaming
 import pickle
 from time import sleep, time
 import types
@@ -66,6 +68,15 @@ class Spectrum_M2i2030(Instrument):
         logging.info(__name__ + ' : Initializing instrument Spectrum')
         Instrument.__init__(self, name, tags=['physical'])
 
+        # DMA buffer, kept between readouts
+        self._buffer = numpy.zeros(0, dtype=numpy.int8)
+
+        # FIFO streaming state
+        self._fifo_source = None
+        self._fifo_reader = None
+        self._fifo_queue = None
+        self._fifo_thread = None
+
         # Load dll and open connection
         self._card_is_open = False
         self._load_dll()
@@ -88,6 +99,10 @@ class Spectrum_M2i2030(Instrument):
         self.add_parameter('ramsize', flags=Instrument.FLAG_GET)
         self.add_parameter('card_status', flags=Instrument.FLAG_GET)
 
+        self.add_parameter('fifo_overruns', flags=Instrument.FLAG_GET, type=types.IntType)
+        self.add_parameter('fifo_underruns', flags=Instrument.FLAG_GET, type=types.IntType)
+        self.add_parameter('fifo_segments', flags=Instrument.FLAG_GET, type=types.IntType)
+
         # add functions
         self.add_function('start')
         self.add_function('start_with_trigger_and_waitready')
@@ -117,6 +132,10 @@ class Spectrum_M2i2030(Instrument):
         self.add_function('set_trigger_ORmask_tmask_ext0')
         self.add_function('trigger_termination_50Ohm')
         self.add_function('trigger_termination_highOhm')
+        self.add_function('set_fifo_mode')
+        self.add_function('start_fifo')
+        self.add_function('stop_fifo')
+        self.add_function('get_fifo_data')
 
         self.reset()
 
@@ -131,6 +150,7 @@ class Spectrum_M2i2030(Instrument):
             None
         '''
         logging.info(__name__ + ' : Deleting Spectrum instrument')
+        self.stop_fifo()
         self._close()
 
 ###########################
@@ -1114,27 +1134,39 @@ class Spectrum_M2i2030(Instrument):
 ### read data from card
 #######################
 
+    def _get_buffer(self, nbytes):
+        '''
+        Returns the first nbytes of the DMA buffer, which is only
+        reallocated if it is too small.
+        '''
+        if len(self._buffer) < nbytes:
+            logging.debug(__name__ + ' : Allocating %d byte buffer' % nbytes)
+            self._buffer = numpy.zeros(nbytes, dtype=numpy.int8)
+        return self._buffer[:nbytes]
+
     def readout_raw_buffer(self, nr_of_channels=1):
         '''
-        Reads out the buffer, and returns a list with the size of the
+        Reads out the buffer, and returns an array with the size of the
         buffer. Contains only data if the channel is triggered.
 
+        The array uses the memory of the driver's DMA buffer, so it is
+        overwritten by the next readout. Use copy() to keep the data.
+
         Input:
-            None
+            nr_of_channels (int) : number of enabled channels
 
         Output:
-            data (int[memsize]): The data of the buffer
+            data (int8[memsize*nr_of_channels]): The data of the buffer
         '''
         logging.debug(__name__ + ' : Readout raw buffer')
         lMemsize = self.get_memsize()
         lBufsize = lMemsize * nr_of_channels
 
-        a = (c_int8 * lBufsize)()
-        p_data = pointer(a)
+        data = self._get_buffer(lBufsize)
 
         # setup buffer
         err = self._spcm_win32.DefTransfer64(self._spcm_win32.handel, _spcm_regs.SPCM_BUF_DATA, 1,
-            0, p_data, c_int64(0), c_int64(lBufsize))
+            0, data.ctypes.data_as(c_void_p), c_int64(0), c_int64(lBufsize))
         if (err!=0):
             logging.error(__name__ + ' : Error setting up buffer')
             self._get_error()
@@ -1148,36 +1180,70 @@ class Spectrum_M2i2030(Instrument):
             self._get_error()
             raise ValueError('Error communicating with device')
 
-        data = p_data.contents[:]
         return data
 
+    def _readout_segments(self, nr_of_channels=1):
+        '''
+        Reads out the buffer and returns it as a (segments, segmentsize)
+        view per channel.
+        '''
+        lMemsize = self.get_memsize()
+        lSegsize = self.get_segmentsize()
+
+        lnumber_of_samples = lMemsize / lSegsize
+
+        data = self.readout_raw_buffer(nr_of_channels=nr_of_channels)
+        data = data.reshape((lnumber_of_samples, lSegsize, nr_of_channels))
+        return [data[:,:,i] for i in range(nr_of_channels)]
+
+    def convert_to_float(self, data, amp, offset, out=None):
+        '''
+        Converts binary data to the input voltage in float32.
+
+        Input:
+            data (int8 array) : binary data
+            amp (float)       : half of the range in millivolts
+            offset (float)    : offset in millivolts
+            out (float32 array) : optional array of the same shape to
+                store the result in
+
+        Output:
+            data (float32 array)
+        '''
+        if out is None:
+            out = numpy.empty(data.shape, dtype=numpy.float32)
+        numpy.multiply(data, numpy.float32(2.0 * amp / 255.0), out)
+        out += numpy.float32(offset)
+        return out
+
     def readout_singlechannel_singlemode_bin(self):
         '''
-        Reads out the buffer, and returns a list with the size of the
+        Reads out the buffer, and returns an array with the size of the
         buffer. Contains only data if the channel is triggered.
+        The array is overwritten by the next readout.
 
         Input:
             None
 
         Output:
-            data (int[memsize]): The data of the buffer
+            data (int8[memsize]): The data of the buffer
         '''
         logging.debug(__name__ + ' : Readout binaries from buffer')
 
         data = self.readout_raw_buffer()
         return data
 
-    def readout_singlechannel_singlemode_float(self):
+    def readout_singlechannel_singlemode_float(self, out=None):
         '''
         Reads out the buffer, and converts the data to the actual input voltage.
-        Returns a list with the size of the buffer.
+        Returns an array with the size of the buffer.
         Contains only data if the channel is triggered.
 
         Input:
-            None
+            out (float32[memsize]) : optional array to store the result in
 
         Output:
-            dataout (float[memsize]): The data of the buffer
+            dataout (float32[memsize]): The data of the buffer
         '''
         logging.debug(__name__ + ' : Readout float after converting from binaries')
 
@@ -1185,83 +1251,220 @@ class Spectrum_M2i2030(Instrument):
         offset = float(self.get_input_offset_ch0())
 
         data = self.readout_raw_buffer()
-        if data == 'timeout':
-            return data
-        data = numpy.array(data, numpy.float32)
-        data = []
-        data = 2.0 * amp * (data / 255.0) + offset
-        return data
+        return self.convert_to_float(data, amp, offset, out=out)
 
     def readout_singlechannel_multimode_bin(self):
-        lMemsize = self.get_memsize()
-        lSegsize = self.get_segmentsize()
-
-        lnumber_of_samples = lMemsize / lSegsize
-
-        data = self.readout_raw_buffer()
-        if data == 'timeout':
-            return data
-        data = numpy.array(data, numpy.int8)
-        data = numpy.reshape(data, (lnumber_of_samples, lSegsize))
-        return data
+        '''
+        Returns int8[segments, segmentsize] view on the DMA buffer.
+        '''
+        return self._readout_segments()[0]
 
-    def readout_singlechannel_multimode_float(self):
-        lMemsize = self.get_memsize()
-        lSegsize = self.get_segmentsize()
+    def readout_singlechannel_multimode_float(self, out=None):
+        '''
+        Returns float32[segments, segmentsize] with the input voltages,
+        stored in 'out' if given.
+        '''
         amp = float(self.get_input_amp_ch0())
         offset = float(self.get_input_offset_ch0())
 
-        lnumber_of_samples = lMemsize / lSegsize
-
-        data = self.readout_raw_buffer()
-        if data == 'timeout':
-            return data
-        data = numpy.array(data, numpy.float32)
-        data = numpy.reshape(data, (lnumber_of_samples, lSegsize))
-        data = 2.0 * amp * (data / 255.0) + offset
-        return data
+        data = self._readout_segments()[0]
+        return self.convert_to_float(data, amp, offset, out=out)
 
     def readout_doublechannel_multimode_bin(self):
-        lMemsize = self.get_memsize()
-        lSegsize = self.get_segmentsize()
-
-        lnumber_of_samples = lMemsize / lSegsize
-
-        data = self.readout_raw_buffer(nr_of_channels=2)
-        if data == 'timeout':
-            return data
-        data = numpy.array(data, numpy.int8)
-        data = numpy.reshape(data, (lMemsize, 2))
-        data0 = data[:,0]
-        data1 = data[:,1]
-        data0 = numpy.reshape(data0, (lnumber_of_samples, lSegsize))
-        data1 = numpy.reshape(data1, (lnumber_of_samples, lSegsize))
+        '''
+        Returns tuple of int8[segments, segmentsize] views on the DMA buffer
+        for channel 0 and 1.
+        '''
+        data0, data1 = self._readout_segments(nr_of_channels=2)
         return (data0, data1)
 
-    def readout_doublechannel_multimode_float(self):
-        lMemsize = self.get_memsize()
-        lSegsize = self.get_segmentsize()
+    def readout_doublechannel_multimode_float(self, out=None):
+        '''
+        Returns tuple of float32[segments, segmentsize] with the input
+        voltages of channel 0 and 1. If 'out' (float32[2, segments,
+        segmentsize]) is given the results are stored in out[0] and out[1].
+        '''
         amp0 = float(self.get_input_amp_ch0())
-        offset0 = float(self.get_input_offset_ch1())
-        amp1 = float(self.get_input_amp_ch0())
+        offset0 = float(self.get_input_offset_ch0())
+        amp1 = float(self.get_input_amp_ch1())
         offset1 = float(self.get_input_offset_ch1())
 
-        lnumber_of_samples = lMemsize / lSegsize
-
-        data = self.readout_raw_buffer(nr_of_channels=2)
-        if data == 'timeout':
-            return data
-        data = numpy.array(data, numpy.int8)
-        data = numpy.reshape(data, (lMemsize, 2))
-        data0 = data[:,0]
-        data1 = data[:,1]
-        data0 = numpy.reshape(data0, (lnumber_of_samples, lSegsize))
-        data1 = numpy.reshape(data1, (lnumber_of_samples, lSegsize))
-        data0 = 2.0 * amp0 * (data0 / 255.0) + offset0
-        data1 = 2.0 * amp1 * (data1 / 255.0) + offset1
+        data0, data1 = self._readout_segments(nr_of_channels=2)
+        if out is None:
+            out = (None, None)
+        data0 = self.convert_to_float(data0, amp0, offset0, out=out[0])
+        data1 = self.convert_to_float(data1, amp1, offset1, out=out[1])
         return (data0, data1)
 
 
+#######################
+### FIFO streaming
+#######################
+
+    def set_fifo_mode(self):
+        '''
+        Sets the card in FIFO multiple recording mode, acquiring segments
+        until stopped. Channels, segment size, posttrigger and trigger
+        are set as for multiple recording.
+
+        Input:
+            None
+
+        Output:
+            None
+        '''
+        logging.debug(__name__ + ' : Set the card in FIFO multi mode')
+        self._set_param(_spcm_regs.SPC_CARDMODE, _spcm_regs.SPC_REC_FIFO_MULTI)
+        self._set_param(_spcm_regs.SPC_LOOPS, 0)
+
+    def start_fifo(self, reduce=None, navg=100, queue_size=16,
+            notify_segments=64, buffer_segments=4096, channels=None,
+            segsize=None, simulate=False, segment_rate=1000.0):
+        '''
+        Starts continuous acquisition in a background thread, see
+        set_fifo_mode(). Completed (and optionally reduced) segments are
+        retrieved with get_fifo_data().
+
+        Input:
+            reduce (string)      : None for raw int8[n, segsize, channels]
+                                   blocks, 'average' for the float32 voltage
+                                   average of navg segments, or 'histogram'
+                                   for int64[channels, 256] sample histograms
+                                   of navg segments
+            navg (int)           : segments per averaged / histogrammed item
+            queue_size (int)     : maximum number of items waiting in the
+                                   queue; further items are dropped and
+                                   counted as overruns
+            notify_segments (int): segments per DMA notification. On the
+                                   card this has to be a multiple of 4 kB.
+            buffer_segments (int): size of the DMA ring buffer in segments
+            channels (int)       : number of enabled channels, default is to
+                                   ask the card (1 when simulating)
+            segsize (int)        : samples per segment, default is to ask
+                                   the card (required when simulating)
+            simulate (bool)      : use a simulated DMA source instead of
+                                   the card, for testing
+            segment_rate (float) : simulated segments per second
+
+        Output:
+            None
+        '''
+        self.stop_fifo()
+
+        if channels is None:
+            if simulate:
+                channels = 1
+            else:
+                channels = self._get_param(_spcm_regs.SPC_CHCOUNT)
+        if segsize is None:
+            segsize = self.get_segmentsize(query=not simulate)
+
+        amp = [float(self.get_input_amp_ch0(query=not simulate) or 500),
+            float(self.get_input_amp_ch1(query=not simulate) or 500)]
+        offset = [float(self.get_input_offset_ch0(query=not simulate) or 0),
+            float(self.get_input_offset_ch1(query=not simulate) or 0)]
+
+        segbytes = segsize * channels
+        notify_size = notify_segments * segbytes
+        bufsize = buffer_segments * segbytes
+        if bufsize % notify_size != 0:
+            raise ValueError('buffer_segments should be a multiple of notify_segments')
+
+        if simulate:
+            self._fifo_source = fifo.SimulatedDMASource(bufsize, notify_size,
+                segsize, channels, segment_rate=segment_rate)
+        else:
+            if notify_size % 4096 != 0:
+                raise ValueError('Notify size %d is not a multiple of 4 kB' % notify_size)
+            self._fifo_source = fifo.CardDMASource(self, bufsize, notify_size)
+
+        self._fifo_reader = fifo.FIFOReader(self._fifo_source, segsize,
+            channels, reduce=reduce, navg=navg, amp=amp[:channels],
+            offset=offset[:channels])
+        self._fifo_queue = streaming.DataQueue(queue_size)
+        self._fifo_thread = streaming.StreamThread(self._fifo_reader.read,
+            queue=self._fifo_queue, name='%s FIFO' % self.get_name(),
+            multiple=True)
+
+        logging.debug(__name__ + ' : Starting FIFO acquisition')
+        self._fifo_source.start()
+        self._fifo_thread.start()
+
+    def stop_fifo(self):
+        '''
+        Stops FIFO acquisition. Items still in the queue can be retrieved
+        with get_fifo_data().
+
+        Input:
+            None
+
+        Output:
+            None
+        '''
+        if self._fifo_thread is None:
+            return
+        logging.debug(__name__ + ' : Stopping FIFO acquisition')
+        self._fifo_thread.stop()
+        self._fifo_thread = None
+        self._fifo_source.stop()
+        self.get_fifo_overruns()
+        self.get_fifo_underruns()
+        self.get_fifo_segments()
+
+    def is_fifo_running(self):
+        return self._fifo_thread is not None and self._fifo_thread.isAlive()
+
+    def get_fifo_data(self, timeout=1.0):
+        '''
+        Returns the next item from the FIFO queue, or None if nothing
+        arrived within timeout seconds.
+
+        Input:
+            timeout (float) : seconds
+
+        Output:
+            item, see start_fifo()
+        '''
+        if self._fifo_queue is None:
+            raise ValueError('FIFO acquisition not started')
+        if self._fifo_thread is not None and \
+                self._fifo_thread.get_error() is not None:
+            raise ValueError('FIFO acquisition failed: %s' % \
+                self._fifo_thread.get_error())
+        return self._fifo_queue.get(timeout)
+
+    def get_fifo_histogram_bins(self):
+        '''
+        Returns the voltage of each histogram bin, float[channels, 256].
+        '''
+        return self._fifo_reader.get_histogram_bins()
+
+    def do_get_fifo_overruns(self):
+        '''
+        Number of times data was lost: the DMA buffer was full or an item
+        was dropped because the queue was full.
+        '''
+        if self._fifo_reader is None:
+            return 0
+        return self._fifo_reader.get_overruns() + self._fifo_queue.get_overruns()
+
+    def do_get_fifo_underruns(self):
+        '''
+        Number of get_fifo_data() calls that timed out without data.
+        '''
+        if self._fifo_queue is None:
+            return 0
+        return self._fifo_queue.get_underruns()
+
+    def do_get_fifo_segments(self):
+        '''
+        Number of segments processed since start_fifo().
+        '''
+        if self._fifo_reader is None:
+            return 0
+        return self._fifo_reader.get_segment_count()
+
+
 ### test run
 
     def test(self, memsize=2048, posttrigger=1024, amp=500):
@@ -17,13 +17,14 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 from instrument import Instrument
+from lib import uploadcache
+from lib import visaio
 import visa
 import types
 import logging
 import numpy
 import struct
 from time import sleep, localtime
-from cStringIO import StringIO
 import numpy as np
 
 
@@ -114,6 +115,19 @@ class Tektronix_AWG5014(Instrument):
         'DC_OUTPUT_LEVEL_N'         :   'd', #V
     }
 
+    # Sample format of WFM files: float32 value followed by marker byte
+    WFM_DTYPE = numpy.dtype([('w', '<f4'), ('m', 'u1')])
+
+    # struct format character -> little endian numpy dtype, sizes as in
+    # struct's standard mode
+    _PACK_DTYPES = {
+        'b': '<i1', 'B': '<u1',
+        'h': '<i2', 'H': '<u2',
+        'i': '<i4', 'I': '<u4',
+        'l': '<i4', 'L': '<u4',
+        'f': '<f4', 'd': '<f8',
+    }
+
     def __init__(self, name, address, reset=False, clock=1e9, numpoints=1000):
         '''
         Initializes the AWG5014.
@@ -137,6 +151,7 @@ class Tektronix_AWG5014(Instrument):
         self._values['files'] = {}
         self._clock = clock
         self._numpoints = numpoints
+        self._upload_cache = uploadcache.UploadCache(name)
 
         # Add parameters
         self.add_parameter('trigger_mode', type=types.StringType,
@@ -218,12 +233,16 @@ class Tektronix_AWG5014(Instrument):
         self.add_function('get_event_jump_timing')
         self.add_function('generate_awg_file')
         self.add_function('send_awg_file')
+        self.add_function('stream_awg_file')
+        self.add_function('write_awg_file')
         self.add_function('load_awg_file')
         self.add_function('get_error')
         self.add_function('pack_waveform')
         self.add_function('clear_visa')
         self.add_function('initialize_dc_waveforms')
         self.add_function('reconnect_visa')
+        self.add_function('get_upload_stats')
+        self.add_function('clear_upload_cache')
 
         if reset:
             self.reset()
@@ -233,6 +252,7 @@ class Tektronix_AWG5014(Instrument):
     # Functions
 
     def clear_visa(self):
+        self._upload_cache.invalidate()
         self._visainstrument.clear()
         for i in range(5):
             try:
@@ -243,6 +263,7 @@ class Tektronix_AWG5014(Instrument):
     def reconnect_visa(self):
         # This function is to be used to reconnect via TCP/IP if the connection
         # has dropped after being unused for a time.
+        self._upload_cache.invalidate()
         self._visainstrument = visa.instrument(self._address, timeout=20)
         return
     def reset(self):
@@ -256,6 +277,7 @@ class Tektronix_AWG5014(Instrument):
             None
         '''
         logging.info(__name__ + ' : Resetting instrument')
+        self._upload_cache.invalidate()
         self._visainstrument.write('*RST')
 
     def get_state(self):
@@ -350,6 +372,7 @@ class Tektronix_AWG5014(Instrument):
             None
         '''
         logging.debug(__name__ + ' : Clear waveforms from channels')
+        self._upload_cache.invalidate()
         self._visainstrument.write('SOUR1:FUNC:USER ""')
         self._visainstrument.write('SOUR2:FUNC:USER ""')
         self._visainstrument.write('SOUR3:FUNC:USER ""')
@@ -571,30 +594,47 @@ class Tektronix_AWG5014(Instrument):
     def force_trigger_event(self):
         self._visainstrument.write('TRIG:IMM')
 
+    def _write_cached(self, key, cmd):
+        '''
+        Write settings command 'cmd' unless it was already sent for 'key'
+        since the last cache invalidation.
+        '''
+        digest = uploadcache.digest(cmd)
+        if self._upload_cache.is_current(key, digest, len(cmd)):
+            return
+        self._visainstrument.write(cmd)
+        self._upload_cache.store(key, digest)
+
     def set_sqel_goto_target_index(self, element_no, goto_to_index_no):
-        self._visainstrument.write('SEQ:ELEM%s:GOTO:INDex %s' %(element_no, goto_to_index_no))
+        self._write_cached(('seq', element_no, 'goto_index'),
+            'SEQ:ELEM%s:GOTO:INDex %s' %(element_no, goto_to_index_no))
 
     def set_sqel_goto_state(self, element_no,goto_state):
-        self._visainstrument.write('SEQuence:ELEMent%s:GOTO:STATe %s' %(element_no, int(goto_state)))
+        self._write_cached(('seq', element_no, 'goto_state'),
+            'SEQuence:ELEMent%s:GOTO:STATe %s' %(element_no, int(goto_state)))
 
 
     def set_sqel_loopcnt_to_inf(self, element_no, state=True):
-        self._visainstrument.write('seq:elem%s:loop:inf %s' %(element_no,int(state)))
+        self._write_cached(('seq', element_no, 'loop'),
+            'seq:elem%s:loop:inf %s' %(element_no,int(state)))
 
     def get_sqel_loopcnt(self, element_no=1):
         return self._visainstrument.ask('SEQ:ELEM%s:LOOP:COUN?' %(element_no))
 
     def set_sqel_loopcnt(self, loopcount, element_no=1):
-        self._visainstrument.write('SEQ:ELEM%s:LOOP:COUN %s' %(element_no,loopcount))
+        self._write_cached(('seq', element_no, 'loop'),
+            'SEQ:ELEM%s:LOOP:COUN %s' %(element_no,loopcount))
 
     def set_sqel_waveform(self, waveform_name, channel, element_no=1):
-        self._visainstrument.write('SEQ:ELEM%s:WAV%s "%s"' %(element_no, channel, waveform_name))
+        self._write_cached(('seq', element_no, 'wav%s' % channel),
+            'SEQ:ELEM%s:WAV%s "%s"' %(element_no, channel, waveform_name))
 
     def get_sqel_waveform(self, channel, element_no=1):
         return self._visainstrument.ask('SEQ:ELEM%s:WAV%s?' %(element_no, channel))
 
     def set_sqel_trigger_wait(self, element_no, state=1):
-       self._visainstrument.write('SEQ:ELEM%s:TWA %s' %(element_no, state))
+        self._write_cached(('seq', element_no, 'twait'),
+            'SEQ:ELEM%s:TWA %s' %(element_no, state))
 
     def get_sqel_trigger_wait(self, element_no):
         return self._visainstrument.ask('SEQ:ELEM%s:TWA?' %(element_no))
@@ -603,13 +643,25 @@ class Tektronix_AWG5014(Instrument):
         return self._visainstrument.ask('SEQ:LENG?')
 
     def set_sq_length(self, seq_length):
+        seq_length = int(seq_length)
+        digest = uploadcache.digest(seq_length)
+        if self._upload_cache.is_current(('seq', 'length'), digest):
+            return
+        # Shrinking drops the elements above the new length, growing adds
+        # elements with default settings that were not cached
+        for key in self._upload_cache.get_keys('seq'):
+            if key[1] != 'length' and int(key[1]) > seq_length:
+                self._upload_cache.remove(key)
         self._visainstrument.write('SEQ:LENG %s' %seq_length)
+        self._upload_cache.store(('seq', 'length'), digest)
 
     def set_sqel_event_jump_target_index(self, element_no, jtar_index_no):
-        self._visainstrument.write('SEQ:ELEM%s:JTAR:INDex %s' %(element_no, jtar_index_no))
+        self._write_cached(('seq', element_no, 'jump_index'),
+            'SEQ:ELEM%s:JTAR:INDex %s' %(element_no, jtar_index_no))
 
     def set_sqel_event_jump_type(self, element_no,jtar_state):
-        self._visainstrument.write('SEQuence:ELEMent%s:JTAR:TYPE %s' %(element_no, jtar_state))
+        self._write_cached(('seq', element_no, 'jump_type'),
+            'SEQuence:ELEMent%s:JTAR:TYPE %s' %(element_no, jtar_state))
 
     def get_sq_mode(self):
         return self._visainstrument.ask('AWGC:SEQ:TYPE?')
@@ -709,17 +761,41 @@ class Tektronix_AWG5014(Instrument):
                 dat = struct.pack(dtype,value)
                 lendat = len(dat)
                 #print 'name: ',name, 'dtype: ',dtype, 'len: ',lendat, 'vals: ',len(value)
+            elif dtype[-1] in self._PACK_DTYPES:
+                # Arrays are packed in one go, e.g. waveform data
+                dat = numpy.asarray(value,
+                    dtype=self._PACK_DTYPES[dtype[-1]]).tostring()
+                lendat = len(dat)
             else:
                 #print tuple(value)
                 dat = struct.pack('<'+dtype,*tuple(value))
                 lendat = len(dat)
                 #print 'name: ',name, 'dtype: ',dtype, 'len: ',lendat, 'vals: ',len(value)
         #print lendat
-        return struct.pack('<II',len(name+'\x00'),lendat) + name + '\x00' + dat
+        return self._pack_record_header(name, lendat) + dat
+
+    def _pack_record_header(self, name, lendat):
+        return struct.pack('<II',len(name+'\x00'),lendat) + name + '\x00'
 
     def generate_awg_file(self,
         packed_waveforms,wfname_l, nrep, trig_wait, goto_state, jump_to, channel_cfg, sequence_cfg):
         '''
+        Returns the awg file as a single string, see iter_awg_records for
+        the arguments. For large sequences use stream_awg_file or
+        write_awg_file instead, which do not build the file in memory.
+        '''
+
+        parts = self.iter_awg_records(packed_waveforms, wfname_l, nrep,
+            trig_wait, goto_state, jump_to, channel_cfg, sequence_cfg)
+        return ''.join([getattr(p, 'tostring', lambda: p)() for p in parts])
+
+    def iter_awg_records(self,
+        packed_waveforms,wfname_l, nrep, trig_wait, goto_state, jump_to, channel_cfg, sequence_cfg):
+        '''
+        Generator yielding the contents of an awg file record by record.
+        Waveform data is yielded as a little endian uint16 array, which is
+        not copied if the packed waveform already has that type.
+
         packed_waveforms: dictionary containing packed waveforms with keys wfname_l and delay_labs
         wfname_l: array of waveform names array([[segm1_ch1,segm2_ch1..],[segm1_ch2,segm2_ch2..],...])
         nrep_l: list of len(segments) specifying the no of reps per segment (0,65536)
@@ -732,78 +808,122 @@ class Tektronix_AWG5014(Instrument):
         for info on filestructure and valid record names, see AWG Help, File and Record Format
 
         '''
-        wfname_l
         timetuple = tuple(np.array(localtime())[[0,1,8,2,3,4,5,6,7]])
 
         #general settings
-        head_str = StringIO()
-        head_str.write(self._pack_record('MAGIC',5000,'h')+\
-                       self._pack_record('VERSION',1,'h'))
+        yield self._pack_record('MAGIC',5000,'h')+\
+              self._pack_record('VERSION',1,'h')
         for k in sequence_cfg.keys():
             if k in self.AWG_FILE_FORMAT_HEAD:
-                head_str.write(self._pack_record(k,sequence_cfg[k],self.AWG_FILE_FORMAT_HEAD[k]))
+                yield self._pack_record(k,sequence_cfg[k],self.AWG_FILE_FORMAT_HEAD[k])
             else:
                 logging.warning('AWG: ' + k + ' not recognized as valid AWG setting')
 
         #channel settings
-        ch_record_str = StringIO()
         for k in channel_cfg.keys():
             ch_k = k[:-1] + 'N'
             if ch_k in self.AWG_FILE_FORMAT_CHANNEL:
-                ch_record_str.write(self._pack_record(k,channel_cfg[k],self.AWG_FILE_FORMAT_CHANNEL[ch_k]))
+                yield self._pack_record(k,channel_cfg[k],self.AWG_FILE_FORMAT_CHANNEL[ch_k])
             else:
                 logging.warning('AWG: ' + k + ' not recognized as valid AWG channel setting')
+
         #waveforms
         ii=21
-        wf_record_str = StringIO()
         wlist = packed_waveforms.keys()
         wlist.sort()
         for wf in wlist:
-            wfdat = packed_waveforms[wf]
+            wfdat = numpy.asarray(packed_waveforms[wf],
+                dtype=self._PACK_DTYPES['H'])
             lenwfdat = len(wfdat)
-            #print 'WAVEFORM_NAME_%s: '%ii, wf, 'len: ',len(wfdat)
-            wf_record_str.write(
-                    self._pack_record('WAVEFORM_NAME_%s'%ii, wf+'\x00','%ss'%len(wf+'\x00'))+\
-                    self._pack_record('WAVEFORM_TYPE_%s'%ii, 1,'h')+\
-                    self._pack_record('WAVEFORM_LENGTH_%s'%ii,lenwfdat,'l')+\
-                    self._pack_record('WAVEFORM_TIMESTAMP_%s'%ii, timetuple[:-1],'8H')+\
-                    self._pack_record('WAVEFORM_DATA_%s'%ii, wfdat,'%sH'%lenwfdat))
+            yield self._pack_record('WAVEFORM_NAME_%s'%ii, wf+'\x00','%ss'%len(wf+'\x00'))+\
+                  self._pack_record('WAVEFORM_TYPE_%s'%ii, 1,'h')+\
+                  self._pack_record('WAVEFORM_LENGTH_%s'%ii,lenwfdat,'l')+\
+                  self._pack_record('WAVEFORM_TIMESTAMP_%s'%ii, timetuple[:-1],'8H')+\
+                  self._pack_record_header('WAVEFORM_DATA_%s'%ii, wfdat.nbytes)
+            yield wfdat
             ii+=1
 
         #sequence
         kk=1
-        seq_record_str = StringIO()
         for segment in wfname_l.transpose():
-            seq_record_str.write(
-                    self._pack_record('SEQUENCE_WAIT_%s'%kk, trig_wait[kk-1],'h')+\
-                    self._pack_record('SEQUENCE_LOOP_%s'%kk, int(nrep[kk-1]),'l')+\
-                    self._pack_record('SEQUENCE_JUMP_%s'%kk, jump_to[kk-1],'h')+\
-                    self._pack_record('SEQUENCE_GOTO_%s'%kk, goto_state[kk-1],'h'))
+            rec = self._pack_record('SEQUENCE_WAIT_%s'%kk, trig_wait[kk-1],'h')+\
+                  self._pack_record('SEQUENCE_LOOP_%s'%kk, int(nrep[kk-1]),'l')+\
+                  self._pack_record('SEQUENCE_JUMP_%s'%kk, jump_to[kk-1],'h')+\
+                  self._pack_record('SEQUENCE_GOTO_%s'%kk, goto_state[kk-1],'h')
             for wfname in segment:
-
                 if wfname is not None:
-
                     ch = wfname[-1]
-                    #print wfname,'SEQUENCE_WAVEFORM_NAME_CH_'+ch+'_%s'%kk
-                    seq_record_str.write(
-                            self._pack_record('SEQUENCE_WAVEFORM_NAME_CH_'+ch+'_%s'%kk, wfname+'\x00','%ss'%len(wfname+'\x00'))
-                            )
+                    rec += self._pack_record('SEQUENCE_WAVEFORM_NAME_CH_'+ch+'_%s'%kk, wfname+'\x00','%ss'%len(wfname+'\x00'))
+            yield rec
             kk+=1
 
-        return head_str.getvalue() + ch_record_str.getvalue() + wf_record_str.getvalue() + seq_record_str.getvalue()
+    def send_awg_file(self,filename, awg_file, force=False):
+        '''
+        Writes awg_file to 'filename' on the instrument. The transfer is
+        skipped if the same file was sent before, unless force=True.
 
-    def send_awg_file(self,filename, awg_file):
+        awg_file is a string or a list of strings / arrays as yielded by
+        iter_awg_records; the latter is streamed without joining it.
+        '''
         #print self._visainstrument.ask('MMEMory:CDIRectory?')
 
+        if isinstance(awg_file, str):
+            parts = [awg_file]
+        else:
+            parts = list(awg_file)
+        nbytes = visaio.get_stream_size(parts)
+
+        key = ('file', filename)
+        digest = uploadcache.digest_data(parts)
+        if not force and self._upload_cache.is_current(key, digest, nbytes):
+            logging.debug(__name__ + ' : %s unchanged, not sending' % filename)
+            return
+
         s1 = 'MMEM:DATA "%s",' %filename
-        s2 = '#' + str(len(str(len(awg_file)))) + str(len(awg_file))
+        s2 = visaio.make_block_header(nbytes)
 
-        mes = s1+s2+awg_file
-        self._visainstrument.write(mes)
+        self._upload_cache.remove(key)
+        io = visaio.VisaIO(self._visainstrument, buffer_size=0)
+        io.write_stream([s1 + s2] + parts + ['\n'])
+        self._upload_cache.store(key, digest)
+
+    def stream_awg_file(self, filename,
+        packed_waveforms,wfname_l, nrep, trig_wait, goto_state, jump_to, channel_cfg, sequence_cfg, force=False):
+        '''
+        Generates an awg file (see iter_awg_records) and sends it to
+        'filename' on the instrument in chunks, without building the whole
+        file in memory.
+        '''
+
+        parts = self.iter_awg_records(packed_waveforms, wfname_l, nrep,
+            trig_wait, goto_state, jump_to, channel_cfg, sequence_cfg)
+        self.send_awg_file(filename, parts, force=force)
+
+    def write_awg_file(self, path,
+        packed_waveforms,wfname_l, nrep, trig_wait, goto_state, jump_to, channel_cfg, sequence_cfg):
+        '''
+        Generates an awg file (see iter_awg_records) and writes it to the
+        local file 'path' record by record, e.g. onto a share of the AWG
+        from which it can be loaded with load_awg_file.
+        '''
+
+        parts = self.iter_awg_records(packed_waveforms, wfname_l, nrep,
+            trig_wait, goto_state, jump_to, channel_cfg, sequence_cfg)
+        f = open(path, 'wb')
+        try:
+            for part in parts:
+                if isinstance(part, numpy.ndarray):
+                    part.tofile(f)
+                else:
+                    f.write(part)
+        finally:
+            f.close()
 
     def load_awg_file(self, filename):
         s = 'AWGCONTROL:SRESTORE "%s"' %filename
         #print s
+        # Restoring a setup replaces the sequence and waveform list
+        self._upload_cache.invalidate('seq')
         self._visainstrument.write(s)
 
     def get_error(self):
@@ -823,9 +943,11 @@ class Tektronix_AWG5014(Instrument):
 #WAVEFORM FILE FUNCTIONS------------------------------------------------------------------------------------------------
 
     # Send waveform to the device
-    def send_waveform(self,w,m1,m2,filename,clock=None):
+    def send_waveform(self,w,m1,m2,filename,clock=None,force=False):
         '''
         Sends a complete waveform. All parameters need to be specified.
+        If the file was already sent with the same contents the transfer
+        is skipped.
         See also: resend_waveform()
 
         Input:
@@ -834,6 +956,7 @@ class Tektronix_AWG5014(Instrument):
             m2 (int[numpoints])  : marker2
             filename (string)    : filename
             clock (int)          : frequency (Hz)
+            force (bool)         : always send, default=False
 
         Output:
             None
@@ -853,10 +976,10 @@ class Tektronix_AWG5014(Instrument):
         self._values['files'][filename]['numpoints']=len(w)
 
         m = m1 + numpy.multiply(m2,2)
-        ws = ''
-        #this is probalbly verry slow and memmory consuming!
-        for i in range(0,len(w)):
-            ws = ws + struct.pack('<fB',w[i],int(numpy.round(m[i],0)))
+        wfm = numpy.empty(dim, dtype=self.WFM_DTYPE)
+        wfm['w'] = w
+        wfm['m'] = numpy.round(m, 0)
+        ws = wfm.tostring()
 
         s1 = 'MMEM:DATA "%s",' % filename
         s3 = 'MAGIC 1000\n'
@@ -870,9 +993,17 @@ class Tektronix_AWG5014(Instrument):
         lenlen=str(len(str(len(s6) + len(s5) + len(s4) + len(s3))))
         s2 = '#' + lenlen + str(len(s6) + len(s5) + len(s4) + len(s3))
 
+        key = ('file', filename)
+        digest = uploadcache.digest(ws, s6)
+        if not force and self._upload_cache.is_current(key, digest, len(ws)):
+            logging.debug(__name__ + ' : %s unchanged, not sending' % filename)
+            return
+
         mes = s1 + s2 + s3 + s4 + s5 + s6
 
+        self._upload_cache.remove(key)
         self._visainstrument.write(mes)
+        self._upload_cache.store(key, digest)
 
     def resend_waveform(self, channel, w=[], m1=[], m2=[], clock=[]):
         '''
@@ -965,16 +1096,11 @@ class Tektronix_AWG5014(Instrument):
             len3=int(data[i])
             len4=int(data[i+1:i+1+len3])
 
-            w=[]
-            m1=[]
-            m2=[]
-
-            for q in range(i+1+len3, i+1+len3+len4,5):
-                j=int(q)
-                c,d = struct.unpack('<fB', data[j:5+j])
-                w.append(c)
-                m2.append(int(d/2))
-                m1.append(d-2*int(d/2))
+            wfm = numpy.frombuffer(data, dtype=self.WFM_DTYPE,
+                count=len4/5, offset=i+1+len3)
+            w = wfm['w'].astype(numpy.float64)
+            m2 = wfm['m'] / 2
+            m1 = wfm['m'] % 2
 
             clock = float(data[i+1+len3+len4+5:len(data)])
 
@@ -1224,8 +1350,23 @@ class Tektronix_AWG5014(Instrument):
 
 
     def delete_all_waveforms_from_list(self):
+        self._upload_cache.invalidate('seq')
         self._visainstrument.write('WLISt:WAVeform:DELete ALL')
 
+    def get_upload_stats(self):
+        '''
+        Returns dictionary with the hits / misses of the waveform upload
+        cache and the number of bytes that were (not) transferred.
+        '''
+        return self._upload_cache.get_stats()
+
+    def clear_upload_cache(self):
+        '''
+        Forget which waveforms and sequence settings are on the instrument,
+        e.g. after changing them from the front panel.
+        '''
+        self._upload_cache.invalidate()
+
     def _do_get_status(self, channel):
         '''
         Gets the status of the designated channel.
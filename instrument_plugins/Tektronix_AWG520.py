@@ -17,11 +17,11 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 from instrument import Instrument
+from lib import uploadcache
 import visa
 import types
 import logging
 import numpy
-import struct
 
 class Tektronix_AWG520(Instrument):
     '''
@@ -41,6 +41,9 @@ class Tektronix_AWG520(Instrument):
     3) Add docstrings
     '''
 
+    # Sample format of WFM files: float32 value followed by marker byte
+    WFM_DTYPE = numpy.dtype([('w', '<f4'), ('m', 'u1')])
+
     def __init__(self, name, address, reset=False, clock=1e9, numpoints=1000):
         '''
         Initializes the AWG520.
@@ -64,6 +67,7 @@ class Tektronix_AWG520(Instrument):
         self._values['files'] = {}
         self._clock = clock
         self._numpoints = numpoints
+        self._upload_cache = uploadcache.UploadCache(name)
 
         # Add parameters
         self.add_parameter('trigger_mode', type=types.StringType,
@@ -113,6 +117,8 @@ class Tektronix_AWG520(Instrument):
         self.add_function('set_trigger_mode_off')
         self.add_function('set_trigger_impedance_1e3')
         self.add_function('set_trigger_impedance_50')
+        self.add_function('get_upload_stats')
+        self.add_function('clear_upload_cache')
 
         if reset:
             self.reset()
@@ -131,6 +137,7 @@ class Tektronix_AWG520(Instrument):
             None
         '''
         logging.info(__name__ + ' : Resetting instrument')
+        self._upload_cache.invalidate()
         self._visainstrument.write('*RST')
 
     def get_all(self):
@@ -173,9 +180,24 @@ class Tektronix_AWG520(Instrument):
             None
         '''
         logging.debug(__name__ + ' : Clear waveforms from channels')
+        self._upload_cache.invalidate()
         self._visainstrument.write('SOUR1:FUNC:USER ""')
         self._visainstrument.write('SOUR2:FUNC:USER ""')
 
+    def get_upload_stats(self):
+        '''
+        Returns dictionary with the hits / misses of the waveform upload
+        cache and the number of bytes that were (not) transferred.
+        '''
+        return self._upload_cache.get_stats()
+
+    def clear_upload_cache(self):
+        '''
+        Forget which waveforms are on the instrument, e.g. after changing
+        them from the front panel.
+        '''
+        self._upload_cache.invalidate()
+
     def set_trigger_mode_on(self):
         '''
         Sets the trigger mode to 'On'
@@ -427,16 +449,11 @@ class Tektronix_AWG520(Instrument):
             len3=int(data[i])
             len4=int(data[i+1:i+1+len3])
 
-            w=[]
-            m1=[]
-            m2=[]
-
-            for q in range(i+1+len3, i+1+len3+len4,5):
-                j=int(q)
-                c,d = struct.unpack('<fB', data[j:5+j])
-                w.append(c)
-                m2.append(int(d/2))
-                m1.append(d-2*int(d/2))
+            wfm = numpy.frombuffer(data, dtype=self.WFM_DTYPE,
+                count=len4/5, offset=i+1+len3)
+            w = wfm['w'].astype(numpy.float64)
+            m2 = wfm['m'] / 2
+            m1 = wfm['m'] % 2
 
             clock = float(data[i+1+len3+len4+5:len(data)])
 
@@ -674,9 +691,11 @@ class Tektronix_AWG520(Instrument):
         return self._visainstrument.ask('MMEM:CAT? "MAIN"')
 
     # Send waveform to the device
-    def send_waveform(self,w,m1,m2,filename,clock):
+    def send_waveform(self,w,m1,m2,filename,clock,force=False):
         '''
         Sends a complete waveform. All parameters need to be specified.
+        If the file was already sent with the same contents the transfer
+        is skipped.
         See also: resend_waveform()
 
         Input:
@@ -685,6 +704,7 @@ class Tektronix_AWG520(Instrument):
             m2 (int[numpoints])  : marker2
             filename (string)    : filename
             clock (int)          : frequency (Hz)
+            force (bool)         : always send, default=False
 
         Output:
             None
@@ -704,9 +724,10 @@ class Tektronix_AWG520(Instrument):
         self._values['files'][filename]['numpoints']=len(w)
 
         m = m1 + numpy.multiply(m2,2)
-        ws = ''
-        for i in range(0,len(w)):
-            ws = ws + struct.pack('<fB', w[i], int(m[i]))
+        wfm = numpy.empty(dim, dtype=self.WFM_DTYPE)
+        wfm['w'] = w
+        wfm['m'] = m
+        ws = wfm.tostring()
 
         s1 = 'MMEM:DATA "%s",' % filename
         s3 = 'MAGIC 1000\n'
@@ -717,9 +738,17 @@ class Tektronix_AWG520(Instrument):
         lenlen=str(len(str(len(s6) + len(s5) + len(s4) + len(s3))))
         s2 = '#' + lenlen + str(len(s6) + len(s5) + len(s4) + len(s3))
 
+        key = ('file', filename)
+        digest = uploadcache.digest(ws, s6)
+        if not force and self._upload_cache.is_current(key, digest, len(ws)):
+            logging.debug(__name__ + ' : %s unchanged, not sending' % filename)
+            return
+
         mes = s1 + s2 + s3 + s4 + s5 + s6
 
+        self._upload_cache.remove(key)
         self._visainstrument.write(mes)
+        self._upload_cache.store(key, digest)
 
     def resend_waveform(self, channel, w=[], m1=[], m2=[], clock=[]):
         '''
@@ -18,9 +18,11 @@
 from instrument import Instrument
 import types
 import logging
+import numpy as np
 
 from lib.com_support import winspec
 from lib.dll_support import andor
+from lib import framering
 
 import qt
 
@@ -59,6 +61,14 @@ class WinspecAndor(Instrument):
                 flags=Instrument.FLAG_GETSET,
                 units='nm')
 
+        self.add_parameter('frame_count', type=types.IntType,
+                flags=Instrument.FLAG_GET)
+
+        self.add_parameter('dropped_frames', type=types.IntType,
+                flags=Instrument.FLAG_GET)
+
+        self._stream = None
+
         self.initialize_andor()
         self.add_function('take_spectrum')
 #        self.add_function('take_spectra')
@@ -69,6 +79,10 @@ class WinspecAndor(Instrument):
         self.add_function('cooldown_andor')
         self.add_function('warmup_andor')
         self.add_function('shutdown_andor')
+        self.add_function('start_continuous')
+        self.add_function('stop_continuous')
+        self.add_function('get_new_frames')
+        self.add_function('get_latest_frame')
 
         if reset:
             self.reset()
@@ -114,6 +128,7 @@ class WinspecAndor(Instrument):
         return winspec.set_grating(val)
 
     def take_spectrum(self, ret=False):
+        self.stop_continuous()
         spec = andor.get_spectrum()
         qt.plot(spec, name='andor_spectrum', clear=True)
         if ret:
@@ -127,6 +142,7 @@ class WinspecAndor(Instrument):
         return
         
     def save_spectrum(self, ret=False):
+        self.stop_continuous()
         spec = andor.get_spectrum()
         specd = qt.Data(name='spectrum')
         specd.add_value('Counts')
@@ -137,6 +153,64 @@ class WinspecAndor(Instrument):
         if ret:
             return spec
 
+    def start_continuous(self, nframes=16, cycle_time=0, simulate=False):
+        '''
+        Start continuous (run till abort) acquisition of spectra into a
+        circular buffer of nframes frames. Get the frames with
+        get_new_frames() or get_latest_frame(). With simulate=True a
+        simulated camera with the same frame size is used.
+        '''
+        self.stop_continuous()
+        source = andor.ContinuousSource(cycle_time=cycle_time)
+        shape = source.frame_shape
+        if simulate:
+            frame_time = max(cycle_time,
+                self.get_exposure_time(query=False) or 0.1)
+            source = framering.SimulatedCamera(shape, frame_time=frame_time)
+        ring = framering.FrameRing(nframes, shape, np.int32)
+        self._stream = framering.FrameStream(source, ring)
+        self._stream.start()
+
+    def stop_continuous(self):
+        if self._stream is None:
+            return
+        self._stream.stop()
+        self.get_frame_count()
+        self.get_dropped_frames()
+
+    def is_continuous_running(self):
+        return self._stream is not None and self._stream.is_running()
+
+    def get_new_frames(self, timeout=0, copy=False):
+        '''
+        Return list of (frame number, spectrum) of all frames acquired
+        since the last call. The frames are views into the circular
+        buffer, valid until it wraps around, unless copy is True.
+        '''
+        if self._stream is None:
+            return []
+        return self._stream.get_ring().get_new(timeout, copy=copy)
+
+    def get_latest_frame(self, copy=True):
+        '''Return the most recent frame of the continuous acquisition.'''
+        if self._stream is None:
+            return None
+        ret = self._stream.get_ring().get_latest(copy=copy)
+        if ret is None:
+            return None
+        return ret[1]
+
+    def do_get_frame_count(self):
+        if self._stream is None:
+            return 0
+        return self._stream.get_ring().get_frame_count()
+
+    def do_get_dropped_frames(self):
+        if self._stream is None:
+            return 0
+        ring = self._stream.get_ring()
+        return ring.get_dropped() + ring.get_overruns()
+
     def plus_1nm(self):
         return self.set_wavelength(self.get_wavelength() + 1.0)
 
@@ -159,4 +233,5 @@ class WinspecAndor(Instrument):
         self.get_all()
         
     def shutdown_andor(self):
+        self.stop_continuous()
         andor.shutdown()
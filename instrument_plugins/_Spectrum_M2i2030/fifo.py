@@ -0,0 +1,312 @@
+# fifo.py, FIFO streaming support for the Spectrum M2i cards
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+In FIFO mode the card continuously transfers segments into a ring buffer
+in PC memory. A DMA source (the card or SimulatedDMASource) exposes that
+ring buffer, and FIFOReader takes completed segments from it, optionally
+reduces them and gives the ring space back to the source.
+
+Sources implement:
+    buffer              int8 ring buffer
+    start()
+    wait(timeout)       returns (position, nbytes) of available data, or
+                        None on timeout; nbytes does not wrap around
+    release(nbytes)     give nbytes at the read position back
+    check_overrun()     return whether data was lost since the last call
+    stop()
+'''
+
+import logging
+import time
+from ctypes import c_void_p, c_int64
+import numpy
+
+from regs import regs as _spcm_regs
+from errors import errors as _spcm_errors
+
+class CardDMASource():
+    '''
+    DMA ring buffer of the card in FIFO mode.
+    '''
+
+    def __init__(self, ins, bufsize, notify_size):
+        '''
+        Input:
+            ins: Spectrum_M2i2030 instrument, set up in a FIFO card mode
+            bufsize (int): ring buffer size in bytes
+            notify_size (int): the card signals data every notify_size bytes
+        '''
+        self._ins = ins
+        self._spcm = ins._spcm_win32
+        self._notify_size = notify_size
+        self.buffer = numpy.zeros(bufsize, dtype=numpy.int8)
+
+    def start(self):
+        err = self._spcm.DefTransfer64(self._spcm.handel,
+            _spcm_regs.SPCM_BUF_DATA, _spcm_regs.SPCM_DIR_CARDTOPC,
+            self._notify_size, self.buffer.ctypes.data_as(c_void_p),
+            c_int64(0), c_int64(len(self.buffer)))
+        if err != 0:
+            logging.error(__name__ + ' : Error setting up FIFO buffer')
+            self._ins._get_error()
+            raise ValueError('Error communicating with device')
+
+        self._ins._set_param(_spcm_regs.SPC_M2CMD,
+            _spcm_regs.M2CMD_CARD_START | _spcm_regs.M2CMD_CARD_ENABLETRIGGER |
+            _spcm_regs.M2CMD_DATA_STARTDMA)
+
+    def wait(self, timeout):
+        # The wait uses the card timeout; it returns when a notify block
+        # is ready or with ERR_TIMEOUT
+        err = self._ins._set_param(_spcm_regs.SPC_M2CMD,
+            _spcm_regs.M2CMD_DATA_WAITDMA)
+        if err == _spcm_errors.ERR_TIMEOUT:
+            return None
+
+        nbytes = self._ins._get_param(_spcm_regs.SPC_DATA_AVAIL_USER_LEN)
+        pos = self._ins._get_param(_spcm_regs.SPC_DATA_AVAIL_USER_POS)
+        if nbytes <= 0:
+            return None
+        return pos, min(nbytes, len(self.buffer) - pos)
+
+    def release(self, nbytes):
+        self._ins._set_param(_spcm_regs.SPC_DATA_AVAIL_CARD_LEN, nbytes)
+
+    def check_overrun(self):
+        status = self._ins._get_param(_spcm_regs.SPC_M2STATUS)
+        return bool(status & _spcm_regs.M2STAT_DATA_OVERRUN)
+
+    def stop(self):
+        self._ins._set_param(_spcm_regs.SPC_M2CMD,
+            _spcm_regs.M2CMD_CARD_STOP | _spcm_regs.M2CMD_DATA_STOPDMA)
+
+class SimulatedDMASource():
+    '''
+    Software replacement for the card's DMA ring, to test FIFO acquisition
+    without hardware. Segments contain a decaying pulse plus noise and are
+    produced at 'segment_rate' per second; if the ring is full, segments
+    are lost and an overrun is flagged, as on the card.
+    '''
+
+    def __init__(self, bufsize, notify_size, segsize, nchannels=1,
+            segment_rate=1000.0, amplitude=100, noise=5, seed=None):
+        self.buffer = numpy.zeros(bufsize, dtype=numpy.int8)
+        self._notify_size = notify_size
+        self._segbytes = segsize * nchannels
+        self._segment_rate = float(segment_rate)
+
+        if bufsize % self._segbytes != 0:
+            raise ValueError('Buffer size should be a multiple of the segment size')
+
+        t = numpy.arange(segsize, dtype=numpy.float64)
+        pulse = amplitude * numpy.exp(-t / max(segsize / 8.0, 1.0))
+        self._pulse = numpy.repeat(pulse, nchannels)
+        self._noise = noise
+        self._random = numpy.random.RandomState(seed)
+
+        self._read_pos = 0
+        self._fill = 0
+        self._overrun = False
+        self._tstart = None
+        self._produced = 0
+
+    def start(self):
+        self._read_pos = 0
+        self._fill = 0
+        self._produced = 0
+        self._overrun = False
+        self._tstart = time.time()
+
+    def _produce(self):
+        '''Write the segments that are due into the ring.'''
+        due = int((time.time() - self._tstart) * self._segment_rate)
+        n = due - self._produced
+        if n <= 0:
+            return
+
+        nfree = (len(self.buffer) - self._fill) / self._segbytes
+        if n > nfree:
+            self._overrun = True
+        self._produced = due
+        n = min(n, nfree)
+        if n == 0:
+            return
+
+        segs = self._pulse + self._random.normal(0, self._noise,
+            (n, self._segbytes))
+        segs = numpy.clip(numpy.round(segs), -128, 127).astype(numpy.int8)
+        segs = segs.reshape(-1)
+
+        wpos = (self._read_pos + self._fill) % len(self.buffer)
+        first = min(len(segs), len(self.buffer) - wpos)
+        self.buffer[wpos:wpos+first] = segs[:first]
+        self.buffer[:len(segs)-first] = segs[first:]
+        self._fill += len(segs)
+
+    def wait(self, timeout):
+        tend = time.time() + timeout
+        while True:
+            self._produce()
+            if self._fill >= min(self._notify_size, len(self.buffer)):
+                break
+            if time.time() >= tend:
+                if self._fill == 0:
+                    return None
+                break
+            time.sleep(min(0.001 + self._notify_size / self._segbytes /
+                self._segment_rate / 4, max(tend - time.time(), 0)))
+
+        return self._read_pos, min(self._fill, len(self.buffer) - self._read_pos)
+
+    def release(self, nbytes):
+        self._read_pos = (self._read_pos + nbytes) % len(self.buffer)
+        self._fill -= nbytes
+
+    def check_overrun(self):
+        ret = self._overrun
+        self._overrun = False
+        return ret
+
+    def stop(self):
+        pass
+
+class FIFOReader():
+    '''
+    Takes segments from a DMA source and reduces them. The read() method is
+    meant to be called in a loop from a lib.streaming.StreamThread with
+    multiple=True.
+
+    Reduction modes:
+        None: items are int8[nsegments, segsize, nchannels] copies
+        'average': items are float32[segsize, nchannels] voltages,
+            averaged over 'navg' segments
+        'histogram': items are int64[nchannels, 256] histograms of the
+            sample values of 'navg' segments, see get_histogram_bins()
+    '''
+
+    def __init__(self, source, segsize, nchannels=1, reduce=None, navg=1,
+            amp=None, offset=None, timeout=1.0):
+        '''
+        Input:
+            source: DMA source
+            segsize (int): samples per segment and channel
+            nchannels (int): number of enabled channels
+            reduce (string): None, 'average' or 'histogram'
+            navg (int): number of segments per reduced item
+            amp (list): half range in mV per channel, for conversion
+            offset (list): offset in mV per channel
+            timeout (float): maximum time read() waits for data
+        '''
+
+        if reduce not in (None, 'average', 'histogram'):
+            raise ValueError('Unknown reduction mode %r' % reduce)
+
+        self._source = source
+        self._segsize = segsize
+        self._nch = nchannels
+        self._segbytes = segsize * nchannels
+        self._reduce = reduce
+        self._navg = max(int(navg), 1)
+        self._timeout = timeout
+
+        if amp is None:
+            amp = [500] * nchannels
+        if offset is None:
+            offset = [0] * nchannels
+        self._scale = numpy.array([2.0 * a / 255.0 for a in amp])
+        self._offset = numpy.array(offset, dtype=numpy.float64)
+
+        self._count = 0
+        self._acc = None
+        self._segments = 0
+        self._overruns = 0
+        self._reset_acc()
+
+    def _reset_acc(self):
+        self._count = 0
+        if self._reduce == 'average':
+            self._acc = numpy.zeros((self._segsize, self._nch), dtype=numpy.int64)
+        elif self._reduce == 'histogram':
+            self._acc = numpy.zeros((self._nch, 256), dtype=numpy.int64)
+
+    def get_segment_count(self):
+        return self._segments
+
+    def get_overruns(self):
+        '''Number of times the source lost data.'''
+        return self._overruns
+
+    def get_histogram_bins(self):
+        '''Return voltages of the histogram bins, float[nchannels, 256].'''
+        codes = numpy.arange(-128, 128, dtype=numpy.float64)
+        return numpy.outer(self._scale, codes) + self._offset[:,numpy.newaxis]
+
+    def read(self):
+        '''
+        Process the data that is available. Returns the list of completed
+        items (possibly empty).
+        '''
+
+        avail = self._source.wait(self._timeout)
+        if self._source.check_overrun():
+            self._overruns += 1
+            logging.warning(__name__ + ' : FIFO overrun, data lost')
+        if avail is None:
+            return []
+
+        pos, nbytes = avail
+        nseg = nbytes / self._segbytes
+        if nseg == 0:
+            return []
+
+        nbytes = nseg * self._segbytes
+        segs = self._source.buffer[pos:pos+nbytes]
+        segs = segs.reshape((nseg, self._segsize, self._nch))
+        try:
+            items = self._process(segs)
+        finally:
+            self._source.release(nbytes)
+        self._segments += nseg
+        return items
+
+    def _process(self, segs):
+        if self._reduce is None:
+            return [segs.copy()]
+
+        items = []
+        i = 0
+        while i < len(segs):
+            k = min(len(segs) - i, self._navg - self._count)
+            part = segs[i:i+k]
+            if self._reduce == 'average':
+                self._acc += part.sum(axis=0, dtype=numpy.int64)
+            else:
+                for ch in range(self._nch):
+                    codes = part[:,:,ch].astype(numpy.int16).reshape(-1) + 128
+                    self._acc[ch] += numpy.bincount(codes, minlength=256)
+            self._count += k
+            i += k
+
+            if self._count == self._navg:
+                if self._reduce == 'average':
+                    avg = self._acc / float(self._count)
+                    items.append((avg * self._scale + self._offset).astype(numpy.float32))
+                else:
+                    items.append(self._acc)
+                self._reset_acc()
+
+        return items
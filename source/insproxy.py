@@ -16,16 +16,71 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
-import inspect
 import types
+import weakref
 import qt
 import instrument
 
+# Exported method names per (instrument class, include_do)
+_class_names = {}
+
+def _get_class_names(cls, include_do):
+    key = (cls, include_do)
+    if key in _class_names:
+        return _class_names[key]
+
+    names = set(instrument.Instrument.__dict__.keys())
+    names.update(('connect', 'disconnect'))
+    names.update(cls.__dict__.keys())
+    ret = set()
+    for name in names:
+        if name.startswith('_'):
+            continue
+        if name.startswith('do_') and not include_do:
+            continue
+        if callable(getattr(cls, name, None)):
+            ret.add(name)
+
+    _class_names[key] = ret
+    return ret
+
+# Proxies per instrument name, updated from a single set of handlers
+_proxies = {}
+_proxies_hids = None
+
+def _register_proxy(proxy):
+    global _proxies_hids
+    if _proxies_hids is None:
+        _proxies_hids = (
+            qt.instruments.connect('instrument-added', _ins_added_cb),
+            qt.instruments.connect('instrument-removed', _ins_removed_cb),
+        )
+
+    refs = _proxies.setdefault(proxy._name, [])
+    refs.append(weakref.ref(proxy))
+
+def _get_proxies(insname):
+    refs = [r for r in _proxies.get(insname, []) if r() is not None]
+    if len(refs) > 0:
+        _proxies[insname] = refs
+    elif insname in _proxies:
+        del _proxies[insname]
+    return [r() for r in refs]
+
+def _ins_added_cb(sender, insname):
+    for proxy in _get_proxies(insname):
+        proxy._setup_proxy()
+
+def _ins_removed_cb(sender, insname):
+    for proxy in _get_proxies(insname):
+        proxy._remove_functions()
+
 class Proxy():
 
     def __init__(self, name, include_do=None):
         self._name = name
-        self._proxy_names = []
+        self._ins = None
+        self._proxy_names = set()
         self._setup_done = False
         self._padd_hid = None
         self._prem_hid = None
@@ -36,8 +91,22 @@ class Proxy():
             self._include_do = include_do
 
         self._setup_proxy()
-        qt.instruments.connect('instrument-added', self._ins_added_cb)
-        qt.instruments.connect('instrument-removed', self._ins_removed_cb)
+        _register_proxy(self)
+
+    def __getattr__(self, name):
+        # Bind exported instrument attributes lazily and cache them
+        if name not in self.__dict__.get('_proxy_names', ()):
+            raise AttributeError("Proxy for '%s' has no attribute '%s'" % \
+                (self.__dict__.get('_name', None), name))
+
+        item = getattr(self._ins, name)
+        self.__dict__[name] = item
+        return item
+
+    def __dir__(self):
+        names = set(self.__dict__.keys())
+        names.update(self._proxy_names)
+        return sorted(names)
 
     def _setup_proxy(self):
         if self._setup_done:
@@ -45,19 +114,17 @@ class Proxy():
         self._setup_done = True
 
         self._ins = qt.instruments.get(self._name, proxy=False)
-        members = inspect.getmembers(self._ins)
-
-        toadd = instrument.Instrument.__dict__.keys()
-        toadd += ['connect', 'disconnect']
-        toadd += self._ins.__class__.__dict__.keys()
-        toadd += self._ins._added_methods
-        toadd += self._ins.get_function_names()
-        for (name, item) in members:
+        names = set(_get_class_names(self._ins.__class__, self._include_do))
+        for name in self._ins._added_methods:
+            if not name.startswith('_'):
+                names.add(name)
+        for name in self._ins.get_function_names():
+            if name.startswith('_'):
+                continue
             if name.startswith('do_') and not self._include_do:
                 continue
-            if callable(item) and not name.startswith('_') and name in toadd:
-                self._proxy_names.append(name)
-                setattr(self, name, item)
+            names.add(name)
+        self._proxy_names = names
 
         self._padd_hid = self.connect('parameter-added',
                 self._parameter_added_cb)
@@ -73,25 +140,20 @@ class Proxy():
 
         self._setup_done = False
         for name in self._proxy_names:
-            delattr(self, name)
-        self._proxy_names = []
+            if name in self.__dict__:
+                del self.__dict__[name]
+        self._proxy_names = set()
         self._ins = None
 
-    def _ins_added_cb(self, sender, insname):
-        if insname == self._name:
-            self._setup_proxy()
-
-    def _ins_removed_cb(self, sender, insname):
-        if insname == self._name:
-            self._remove_functions()
-
     def _parameter_added_cb(self, sender, name):
         for func in ('get_%s' % name, 'set_%s' % name):
             if hasattr(self._ins, func):
-                setattr(self, func, getattr(self._ins, func))
+                self._proxy_names.add(func)
+                if func in self.__dict__:
+                    del self.__dict__[func]
 
     def _parameter_removed_cb(self, sender, name):
         for func in ('get_%s' % name, 'set_%s' % name):
-            if hasattr(self, func):
-                delattr(self, func)
-
+            self._proxy_names.discard(func)
+            if func in self.__dict__:
+                del self.__dict__[func]
@@ -23,7 +23,12 @@ import math
 import inspect
 from gettext import gettext as _L
 from lib import calltimer
+from lib import profiling
+from lib import persist
+from lib import probe
+from lib import ramp
 from lib.network.object_sharer import SharedGObject, cache_result
+from lib.misc import exact_time
 
 import numpy as np
 import logging
@@ -103,11 +108,12 @@ class Instrument(SharedGObject):
         self._parameter_groups = {}
         self._functions = {}
         self._added_methods = []
-        self._probe_ids = []
 
         self._default_read_var = None
         self._default_write_var = None
 
+        self._lock_wait = 0.0
+
         self._lock_class = kwargs.get('lockclass', name)
         if self._lock_class in Instrument._lock_classes:
             self._access_lock = Instrument._lock_classes[self._lock_class]
@@ -195,6 +201,7 @@ class Instrument(SharedGObject):
         Output: None
         '''
 
+        probe.get_probe_scheduler().remove(self)
         self._remove_parameters()
         self.emit('removed', self.get_name())
 
@@ -249,8 +256,11 @@ class Instrument(SharedGObject):
                 format_map (dict): map describing allowed options and the
                     formatted (mostly GUI) representation
                 option_list (array/tuple): allowed options
-                persist (bool): if true load/save values in config file
+                persist (bool): if true load/save values in persist store
                 probe_interval (int): interval in ms between automatic gets
+                max_age (float): maximum age in seconds of the stored value.
+                    A get within this window returns the stored value
+                    without querying the instrument.
                 listen_to (list of (ins, param) tuples): list of parameters
                     to watch. If any of them changes, execute a get for this
                     parameter. Useful for a parameter that depends on one
@@ -377,15 +387,21 @@ class Instrument(SharedGObject):
 #            property(lambda: self.get(name), lambda x: self.set(name, x)))
 
         if options['flags'] & self.FLAG_PERSIST:
-            val = config.get('persist_%s_%s' % (self._name, name))
+            key = 'persist_%s_%s' % (self._name, name)
+            store = persist.get_persist_store()
+            if store.has_key(key):
+                val = store.get(key)
+            else:
+                # Values written by older versions live in the config file
+                val = config.get(key)
             options['value'] = val
         else:
             options['value'] = None
+        options['value_time'] = None
 
         if 'probe_interval' in options:
             interval = int(options['probe_interval'])
-            self._probe_ids.append(gobject.timeout_add(interval,
-                lambda: self.get(name)))
+            probe.get_probe_scheduler().add(self, name, interval)
 
         if 'listen_to' in options:
             insset = set([])
@@ -425,6 +441,9 @@ class Instrument(SharedGObject):
             if hasattr(self, func):
                 delattr(self, func)
 
+        if 'probe_interval' in self._parameters[name]:
+            probe.get_probe_scheduler().remove(self, name)
+
         del self._parameters[name]
         self.emit('parameter-removed', name)
 
@@ -549,6 +568,21 @@ class Instrument(SharedGObject):
         '''
         self.set_parameter_options(name, maxstep=stepsize, stepdelay=stepdelay)
 
+    def get_parameter_value_age(self, name):
+        '''
+        Return the age of the stored value of a parameter.
+
+        Input:  name of parameter (string)
+        Output: age in seconds (float), or None if no value was stored yet
+        '''
+        if name not in self._parameters:
+            return None
+
+        t = self._parameters[name].get('value_time', None)
+        if t is None:
+            return None
+        return time.time() - t
+
     def get_parameter_names(self):
         '''
         Returns a list of parameter names.
@@ -670,13 +704,15 @@ class Instrument(SharedGObject):
 
         return text
 
-    def _get_value(self, name, query=True, **kwargs):
+    def _get_value(self, name, query=True, max_age=None, **kwargs):
         '''
         Private wrapper function to get a value.
 
         Input:  (1) name of parameter (string)
                 (2) query the instrument or return stored value (Boolean)
-                (3) optional list of extra options
+                (3) maximum age of stored value in seconds (float), overrides
+                    the 'max_age' parameter option
+                (4) optional list of extra options
         Output: value of parameter (whatever type the instrument driver returns)
         '''
 
@@ -686,9 +722,19 @@ class Instrument(SharedGObject):
             print 'Could not retrieve options for parameter %s' % name
             return None
 
+        # The stored value is only valid for a get without extra options
+        cacheable = len(kwargs) == 0
+
         if 'channel' in p and 'channel' not in kwargs:
             kwargs['channel'] = p['channel']
 
+        if max_age is None:
+            max_age = p.get('max_age', None)
+        if cacheable and max_age is not None and \
+                p.get('value_time') is not None and \
+                time.time() - p['value_time'] < max_age:
+            query = False
+
         flags = p['flags']
         if not query or flags & 8: #self.FLAG_SOFTGET:
             if 'value' in p:
@@ -711,7 +757,65 @@ class Instrument(SharedGObject):
             base_name = name
 
         func = p['get_func']
-        value = func(**kwargs)
+        if profiling.is_enabled():
+            t0 = exact_time()
+            value = func(**kwargs)
+            t1 = exact_time()
+            value = self._cast_get_value(p, value)
+            profiling.record(self._name, 'get', name, self._lock_wait,
+                    t1 - t0, exact_time() - t1)
+            self._lock_wait = 0.0
+        else:
+            value = func(**kwargs)
+            value = self._cast_get_value(p, value)
+
+        p['value'] = value
+        if cacheable:
+            p['value_time'] = time.time()
+        else:
+            p['value_time'] = None
+        return value
+
+    def _get_batch(self, names, max_age=None):
+        '''
+        Private function to query several parameters in one go with the
+        driver function do_get_batch(names), which returns a dictionary
+        of parameter -> value. Parameters with a stored value younger than
+        max_age are not queried.
+
+        Output: dictionary of parameter -> value for the queried parameters
+        '''
+
+        now = time.time()
+        query = []
+        for name in names:
+            p = self._parameters.get(name)
+            if p is None or not p['flags'] & self.FLAG_GET or \
+                    p['flags'] & self.FLAG_SOFTGET:
+                continue
+            age = max_age
+            if age is None:
+                age = p.get('max_age', None)
+            if age is not None and p.get('value_time') is not None and \
+                    now - p['value_time'] < age:
+                continue
+            query.append(name)
+        if len(query) == 0:
+            return {}
+
+        values = self.do_get_batch(query)
+        ret = {}
+        for name in query:
+            if name not in values:
+                continue
+            p = self._parameters[name]
+            value = self._cast_get_value(p, values[name])
+            p['value'] = value
+            p['value_time'] = time.time()
+            ret[name] = value
+        return ret
+
+    def _cast_get_value(self, p, value):
         if 'type' in p and value is not None:
             try:
                 if p['type'] == types.IntType:
@@ -729,10 +833,9 @@ class Instrument(SharedGObject):
             except:
                 logging.warning('Unable to cast value "%s" to %s', value, p['type'])
 
-        p['value'] = value
         return value
 
-    def get(self, name, query=True, fast=False, **kwargs):
+    def get(self, name, query=True, fast=False, max_age=None, **kwargs):
         '''
         Get one or more Instrument parameter values.
 
@@ -742,19 +845,27 @@ class Instrument(SharedGObject):
                 last stored value
             fast (bool): if True perform as fast as possible, e.g. don't
                 emit a signal to update the GUI.
+            max_age (float): if the stored value is younger than this
+                (in seconds) return it without querying the instrument.
+                Overrides the 'max_age' parameter option.
             kwargs: Optional keyword args that will be passed on.
 
         Output: Single value, or dictionary of parameter -> values
                 Type is whatever the instrument driver returns.
+
+        If the driver implements do_get_batch(names), a get of several
+        parameters queries them with a single call.
         '''
 
         if Instrument.USE_ACCESS_LOCK:
+            t0 = exact_time()
             if not self._access_lock.acquire():
                 logging.warning(_L('Failed to acquire lock!'))
                 return None
+            self._lock_wait = exact_time() - t0
 
         if fast:
-            ret = self._get_value(name, query, **kwargs)
+            ret = self._get_value(name, query, max_age, **kwargs)
             if Instrument.USE_ACCESS_LOCK:
                 self._access_lock.release()
             return ret
@@ -762,14 +873,21 @@ class Instrument(SharedGObject):
         if type(name) in (types.ListType, types.TupleType):
             changed = {}
             result = {}
+            batch = {}
+            if query and len(kwargs) == 0 and len(name) > 1 and \
+                    hasattr(self, 'do_get_batch'):
+                batch = self._get_batch(name, max_age)
             for key in name:
-                val = self._get_value(key, query, **kwargs)
+                if key in batch:
+                    val = batch[key]
+                else:
+                    val = self._get_value(key, query, max_age, **kwargs)
                 if val is not None:
                     result[key] = val
                     changed[key] = val
 
         else:
-            result = self._get_value(name, query, **kwargs)
+            result = self._get_value(name, query, max_age, **kwargs)
             changed = {name: result}
 
         if Instrument.USE_ACCESS_LOCK:
@@ -877,16 +995,15 @@ class Instrument(SharedGObject):
 
         return value
 
-    def _set_value(self, name, value, **kwargs):
+    def _check_set_value(self, name, value, kwargs):
         '''
-        Private wrapper function to set a value.
+        Private function to validate and convert a value before setting it.
 
         Input:  (1) name of parameter (string)
                 (2) value of parameter (whatever type the parameter supports).
                     Type casting is performed if necessary.
-                (3) Optional keyword args that will be passed on.
-        Output: Value returned by the _do_set_<name> function,
-                or result of get in FLAG_GET_AFTER_SET specified.
+                (3) keyword args dictionary, the channel is added if needed.
+        Output: converted value, or None if the value is not allowed.
         '''
         if self._parameters.has_key(name):
             p = self._parameters[name]
@@ -906,7 +1023,7 @@ class Instrument(SharedGObject):
             if newval is None:
                 logging.error('Value %s is not a valid option for "%s", valid options: %r',
                     value, name, repr(p['format_map']))
-                return
+                return None
             value = newval
 
         # If an option list is available check whether the value is in there
@@ -915,7 +1032,7 @@ class Instrument(SharedGObject):
             if newval is None:
                 logging.error('Value %s is not a valid option for "%s", valid: %r',
                     value, name, repr(p['option_list']))
-                return
+                return None
             value = newval
 
         if 'type' in p:
@@ -932,11 +1049,81 @@ class Instrument(SharedGObject):
             print 'Trying to set too large value: %s' % value
             return None
 
-        if 'base_name' in p:
-            base_name = p['base_name']
+        return value
+
+    def _store_set_value(self, name, value, **kwargs):
+        '''
+        Private function to store a value after it has been set.
+
+        Performs a get for FLAG_GET_AFTER_SET parameters and writes
+        FLAG_PERSIST parameters to the config file.
+
+        Output: stored value
+        '''
+        p = self._parameters[name]
+        if p['flags'] & self.FLAG_GET_AFTER_SET:
+            # Always read back, the stored value is still the old one
+            value = self._get_value(name, max_age=0, **kwargs)
+
+        if p['flags'] & self.FLAG_PERSIST:
+            persist.get_persist_store().set(
+                    'persist_%s_%s' % (self._name, name), value)
+
+        p['value'] = value
+        if len(kwargs) == 0:
+            p['value_time'] = time.time()
         else:
-            base_name = name
+            p['value_time'] = None
+        return value
 
+    def _set_value(self, name, value, **kwargs):
+        '''
+        Private wrapper function to set a value.
+
+        Input:  (1) name of parameter (string)
+                (2) value of parameter (whatever type the parameter supports).
+                    Type casting is performed if necessary.
+                (3) Optional keyword args that will be passed on.
+        Output: Value returned by the _do_set_<name> function,
+                or result of get in FLAG_GET_AFTER_SET specified.
+        '''
+        if self._is_ramped(name):
+            value = self._check_set_value(name, value, kwargs)
+            if value is None:
+                return None
+            handle = ramp.get_ramp_engine().start(self, name, value, **kwargs)
+            if not self._wait_ramp(handle):
+                return None
+            return self._parameters[name]['value']
+
+        # A running ramp would overwrite the value with its next step
+        ramp.get_ramp_engine().abort_parameter(self, name)
+
+        if profiling.is_enabled():
+            t0 = exact_time()
+            value = self._check_set_value(name, value, kwargs)
+            if value is None:
+                return None
+            t1 = exact_time()
+            self._do_set_value(name, value, **kwargs)
+            profiling.record(self._name, 'set', name, self._lock_wait,
+                    exact_time() - t1, t1 - t0)
+            self._lock_wait = 0.0
+        else:
+            value = self._check_set_value(name, value, kwargs)
+            if value is None:
+                return None
+            self._do_set_value(name, value, **kwargs)
+
+        return self._store_set_value(name, value, **kwargs)
+
+    def _do_set_value(self, name, value, **kwargs):
+        '''
+        Private function to pass a checked value to the driver, ramping it
+        if the parameter has a 'maxstep' option.
+        '''
+
+        p = self._parameters[name]
         func = p['set_func']
         if 'maxstep' in p and p['maxstep'] is not None:
             curval = p['value']
@@ -971,17 +1158,55 @@ class Instrument(SharedGObject):
         else:
             ret = func(value, **kwargs)
 
-        if p['flags'] & self.FLAG_GET_AFTER_SET:
-            value = self._get_value(name, **kwargs)
+        return ret
 
-        if p['flags'] & self.FLAG_PERSIST:
-            config.set('persist_%s_%s' % (self._name, name), value)
-            config.save()
+    def _is_ramped(self, name):
+        '''
+        Return whether parameter 'name' is ramped by the ramp engine: it
+        has a 'maxstep' option and its current value is known.
+        '''
+        p = self._parameters.get(name)
+        return p is not None and p.get('maxstep', None) is not None and \
+                p.get('value', None) is not None
 
-        p['value'] = value
-        return value
+    def _wait_ramp(self, handle):
+        '''
+        Private function to wait for a ramp while handling events, so the
+        GUI and other ramps keep running. Returns whether the ramp reached
+        its target.
+        '''
+        # The ramp engine needs the lock for every step
+        if Instrument.USE_ACCESS_LOCK:
+            self._access_lock.release()
+        try:
+            return handle.wait()
+        finally:
+            if Instrument.USE_ACCESS_LOCK:
+                self._access_lock.acquire()
+
+    def _start_ramp(self, name, value, **kwargs):
+        '''
+        Private function to set a value without blocking. Parameters with
+        a 'maxstep' option are ramped by the ramp engine, others are set
+        immediately.
+
+        Output: RampHandle, or None if the value is not allowed.
+        '''
+        value = self._check_set_value(name, value, kwargs)
+        if value is None:
+            return None
 
-    def set(self, name, value=None, fast=False, **kwargs):
+        p = self._parameters[name]
+        if self._is_ramped(name):
+            return ramp.get_ramp_engine().start(self, name, value, **kwargs)
+
+        ramp.get_ramp_engine().abort_parameter(self, name)
+        p['set_func'](value, **kwargs)
+        value = self._store_set_value(name, value, **kwargs)
+        self._queue_changed({name: value})
+        return ramp.RampHandle(self, name, value, done=True)
+
+    def set(self, name, value=None, fast=False, wait=True, **kwargs):
         '''
         Set one or more Instrument parameter values.
 
@@ -994,10 +1219,16 @@ class Instrument(SharedGObject):
             value (any): the value to set
             fast (bool): if True perform as fast as possible, e.g. don't
                 emit a signal to update the GUI.
+            wait (bool): parameters with a 'maxstep' option are ramped by
+                the ramp engine, which keeps handling events. If True,
+                wait until they reach the value; if False return
+                immediately.
             kwargs: Optional keyword args that will be passed on.
 
         Output: True or False whether the operation succeeded.
                 For multiple sets return False if any of the parameters failed.
+                If wait=False, a RampHandle (or dictionary of parameter ->
+                RampHandle) is returned instead; None for failed parameters.
         '''
 
         if self._locked:
@@ -1006,20 +1237,45 @@ class Instrument(SharedGObject):
             return False
 
         if Instrument.USE_ACCESS_LOCK:
+            t0 = exact_time()
             if not self._access_lock.acquire():
                 logging.warning(_L('Failed to acquire lock!'))
                 return None
+            self._lock_wait = exact_time() - t0
+
+        if not wait:
+            if type(name) == types.DictType:
+                result = {}
+                for key, val in name.iteritems():
+                    result[key] = self._start_ramp(key, val, **kwargs)
+            else:
+                result = self._start_ramp(name, value, **kwargs)
+
+            if Instrument.USE_ACCESS_LOCK:
+                self._access_lock.release()
+            return result
 
         result = True
         changed = {}
         if type(name) == types.DictType:
+            # Start all ramps first, so they run at the same time
+            handles = {}
             for key, val in name.iteritems():
+                if self._is_ramped(key):
+                    handles[key] = self._start_ramp(key, val, **kwargs)
+                    continue
                 val = self._set_value(key, val, **kwargs)
                 if val is not None:
                     changed[key] = val
                 else:
                     result = False
 
+            for key, handle in handles.iteritems():
+                if handle is not None and self._wait_ramp(handle):
+                    changed[key] = self._parameters[key]['value']
+                else:
+                    result = False
+
         else:
             val = self._set_value(name, value, **kwargs)
             if val is not None:
@@ -1048,6 +1304,7 @@ class Instrument(SharedGObject):
             return None
 
         p['value'] = value
+        p['value_time'] = time.time()
         self._queue_changed({name: value})
 
     def get_argspec_dict(self, a):
@@ -1121,7 +1378,13 @@ class Instrument(SharedGObject):
         Output: None
         '''
         f = getattr(self, funcname)
-        f(**kwargs)
+        if profiling.is_enabled():
+            t0 = exact_time()
+            f(**kwargs)
+            profiling.record(self._name, 'call', funcname, 0.0,
+                    exact_time() - t0)
+        else:
+            f(**kwargs)
 
     def lock(self):
         '''
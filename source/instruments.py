@@ -24,6 +24,10 @@ import logging
 import sys
 import instrument
 from lib.config import get_config
+from lib import probe
+from lib import profiling
+from lib import calltimer
+from lib.misc import exact_time
 from insproxy import Proxy
 from lib.network.object_sharer import SharedGObject
 
@@ -87,6 +91,113 @@ def _get_driver_module(name, do_reload=False):
 
     return None
 
+class DriverCatalog():
+    '''
+    Cache of the available instrument drivers.
+
+    The plugin directories are only rescanned when their modification
+    time changes. Driver modules, classes and constructor argspecs are
+    cached and a module is reloaded only when its file changed, or when
+    explicitly requested.
+    '''
+
+    def __init__(self, dirs):
+        '''
+        Input:
+            dirs (list): plugin directories, in order of precedence
+        '''
+
+        self._dirs = dirs
+        self._dir_mtimes = {}
+        self._paths = {}
+        self._modules = {}
+        self._argspecs = {}
+
+    def _check_dirs(self):
+        for d in self._dirs:
+            if self._dir_mtimes.get(d, None) != os.path.getmtime(d):
+                self._scan()
+                return
+
+    def _scan(self):
+        self._paths = {}
+        for d in reversed(self._dirs):
+            self._dir_mtimes[d] = os.path.getmtime(d)
+            for fn in os.listdir(d):
+                name, ext = os.path.splitext(fn)
+                if ext == '.py' and name != '__init__':
+                    self._paths[name] = os.path.join(d, fn)
+
+    def get_types(self):
+        '''Return sorted list of available driver names.'''
+        self._check_dirs()
+        ret = [name for name in self._paths if name[0] != '_']
+        ret.sort()
+        return ret
+
+    def type_exists(self, name):
+        self._check_dirs()
+        return name in self._paths
+
+    def _get_mtime(self, name):
+        path = self._paths.get(name, None)
+        if path is None or not os.path.exists(path):
+            return None
+        return os.path.getmtime(path)
+
+    def get_module(self, name, do_reload=False):
+        '''
+        Return driver module 'name', reloading it if the file changed or if
+        do_reload is True. Returns None if it could not be loaded.
+        '''
+
+        self._check_dirs()
+        mtime = self._get_mtime(name)
+        if name in self._modules and not do_reload:
+            module, loaded_mtime = self._modules[name]
+            if loaded_mtime == mtime:
+                return module
+            do_reload = True
+
+        module = _get_driver_module(name, do_reload=do_reload)
+        if name in self._argspecs:
+            del self._argspecs[name]
+        if module is None:
+            if name in self._modules:
+                del self._modules[name]
+            return None
+
+        self._modules[name] = (module, mtime)
+        return module
+
+    def get_class(self, name, do_reload=False):
+        '''Return instrument class of driver 'name', or None.'''
+        module = self.get_module(name, do_reload=do_reload)
+        return getattr(module, name, None)
+
+    def get_argspec(self, name):
+        '''Return argspec of the constructor of driver 'name', or None.'''
+        insclass = self.get_class(name)
+        if insclass is None:
+            return None
+        if name not in self._argspecs:
+            self._argspecs[name] = inspect.getargspec(insclass.__init__)
+        return self._argspecs[name]
+
+class InstrumentRef():
+    '''
+    Reference to an instrument by name, see Instruments.create_many().
+    '''
+
+    def __init__(self, name):
+        self._name = name
+
+    def __repr__(self):
+        return 'InstrumentRef(%r)' % self._name
+
+    def get_name(self):
+        return self._name
+
 class Instruments(SharedGObject):
 
     __gsignals__ = {
@@ -185,33 +296,10 @@ class Instruments(SharedGObject):
         '''
         Return list of supported instrument types
         '''
-        ret = []
-        filelist = os.listdir(_insdir)
-        for path_fn in filelist:
-            path, fn = os.path.split(path_fn)
-            name, ext = os.path.splitext(fn)
-            if ext == '.py' and name != "__init__" and name[0] != '_':
-                ret.append(name)
-
-        if _user_insdir is not None:
-            filelist = os.listdir(_user_insdir)
-            for path_fn in filelist:
-                path, fn = os.path.split(path_fn)
-                name, ext = os.path.splitext(fn)
-                if ext == '.py' and name != "__init__" and name[0] != '_' and not ret.count(name) > 0:
-                    ret.append(name)
-
-        ret.sort()
-        return ret
+        return _catalog.get_types()
 
     def type_exists(self, typename):
-        driverfn = os.path.join(_insdir, '%s.py' % typename)
-        if os.path.exists(driverfn):
-            return True
-        if _user_insdir is None:
-            return False
-        driverfn = os.path.join(_user_insdir, '%s.py' % typename)
-        return os.path.exists(driverfn)
+        return _catalog.type_exists(typename)
 
     def get_type_arguments(self, typename):
         '''
@@ -227,12 +315,7 @@ class Instruments(SharedGObject):
             defaults: default values
         '''
 
-        module = _get_driver_module(typename)
-        insclass = getattr(module, typename, None)
-        if insclass is None:
-            return None
-
-        return inspect.getargspec(insclass.__init__)
+        return _catalog.get_argspec(typename)
 
     def get_instruments_by_type(self, typename):
         '''
@@ -252,12 +335,73 @@ class Instruments(SharedGObject):
 
         return self._tags
 
+    def set_stats_enabled(self, enabled):
+        '''
+        Enable or disable collection of get/set/call timing statistics.
+        '''
+        profiling.set_enabled(enabled)
+
+    def get_stats_enabled(self):
+        return profiling.is_enabled()
+
+    def reset_stats(self):
+        profiling.reset()
+
+    def get_stats(self, insname=None, n=None):
+        '''
+        Return timing statistics of parameter gets/sets and function calls,
+        slowest (by total time) first.
+
+        Input:
+            insname (string): only return statistics for this instrument
+            n (int): maximum number of entries to return
+        Output:
+            list of dictionaries with keys instrument, kind, name, count,
+            total_time, mean_time, max_time, lock_time, driver_time,
+            cast_time, p50, p90 and p99 (times in seconds)
+        '''
+
+        ret = profiling.get_stats(insname)
+        if n is not None:
+            ret = ret[:n]
+        return ret
+
+    def get_stats_histogram(self, insname, kind, name):
+        '''
+        Return latency histogram as list of (upper bucket edge, count) for
+        operation 'kind' ('get', 'set' or 'call') on 'name' of 'insname'.
+        '''
+        return profiling.get_histogram(insname, kind, name)
+
+    def get_probe_stats(self):
+        '''
+        Return statistics of the periodic parameter probes as a dictionary
+        of '<instrument>.<parameter>' -> stats.
+        '''
+
+        return probe.get_probe_scheduler().get_stats()
+
     def _create_invalid_ins(self, name, instype, **kwargs):
         ins = instrument.InvalidInstrument(name, instype, **kwargs)
         self.add(ins, create_args=kwargs)
         self.emit('instrument-added', name)
         return self.get(name)
 
+    def _get_instrument_class(self, instype):
+        '''
+        Load driver module (reloading it if it changed) and return the
+        instrument class. Returns None if the driver could not be loaded.
+        '''
+
+        module = _catalog.get_module(instype)
+        if module is None:
+            return None
+        insclass = getattr(module, instype, None)
+        if insclass is None:
+            logging.error('Driver does not contain instrument class')
+            return None
+        return insclass
+
     def create(self, name, instype, **kwargs):
         '''
         Create an instrument called 'name' of type 'type'.
@@ -279,13 +423,8 @@ class Instruments(SharedGObject):
             logging.warning('Instrument "%s" already exists, removing', name)
             self.remove(name)
 
-        module = _get_driver_module(instype)
-        if module is None:
-            return self._create_invalid_ins(name, instype, **kwargs)
-        reload(module)
-        insclass = getattr(module, instype, None)
+        insclass = self._get_instrument_class(instype)
         if insclass is None:
-            logging.error('Driver does not contain instrument class')
             return self._create_invalid_ins(name, instype, **kwargs)
 
         try:
@@ -299,8 +438,201 @@ class Instruments(SharedGObject):
         self.emit('instrument-added', name)
         return self.get(name)
 
+    def ref(self, name):
+        '''
+        Return a reference to instrument 'name' that can be used as a
+        keyword argument in create_many(). It is resolved when the
+        instrument is constructed and implies a dependency.
+        '''
+        return InstrumentRef(name)
+
+    def _get_create_lock_key(self, insclass, name, kwargs):
+        if 'lockclass' in kwargs:
+            return kwargs['lockclass']
+        # Same key as the lockclass of GPIBInstrument, all boards share it
+        if issubclass(insclass, instrument.GPIBInstrument):
+            return 'GPIB'
+        address = kwargs.get('address', None)
+        if type(address) is types.StringType and \
+                address.upper().startswith('GPIB'):
+            return 'GPIB'
+        return name
+
+    def _construct_instrument(self, insclass, name, kwargs):
+        try:
+            return insclass(name, **kwargs), None
+        except Exception, e:
+            TB()
+            return None, e
+
+    def create_many(self, specs, report=True):
+        '''
+        Create several instruments, initializing independent instruments
+        concurrently in worker threads.
+
+        Constructors of instruments with the same lock class (or on GPIB)
+        are never run at the same time.
+
+        Input:
+            specs (list): instrument specifications, each a dictionary with
+                keys 'name', 'type' and optionally 'depends' (list of
+                instrument names that should be created first) and 'kwargs'
+                (keyword arguments for the constructor). Keyword arguments
+                can refer to instruments created in the same call using
+                qt.instruments.ref(<name>).
+            report (bool): print a timing report at the end.
+
+        Output:
+            dictionary of name -> Instrument object (Proxy)
+        '''
+
+        import qt
+
+        if qt.config.get('threading_warning', True):
+            logging.warning('Using threading functions could result in QTLab becoming unstable!')
+
+        infos = {}
+        order = []
+        for spec in specs:
+            name = spec['name']
+            kwargs = dict(spec.get('kwargs', {}))
+            depends = set(spec.get('depends', []))
+            for val in kwargs.itervalues():
+                if isinstance(val, InstrumentRef):
+                    depends.add(val.get_name())
+            infos[name] = {
+                'type': spec['type'],
+                'kwargs': kwargs,
+                'depends': depends,
+            }
+            order.append(name)
+
+        # Load each driver once, not on every pass of the loop below
+        classes = {}
+        for info in infos.itervalues():
+            instype = info['type']
+            if instype not in classes and self.type_exists(instype):
+                classes[instype] = self._get_instrument_class(instype)
+
+        for name, info in infos.iteritems():
+            unknown = [d for d in info['depends'] \
+                if d not in infos and d not in self._instruments]
+            if len(unknown) > 0:
+                logging.error('Instrument %s depends on unknown instrument(s) %s',
+                    name, ', '.join(unknown))
+                info['depends'] -= set(unknown)
+
+        ret = {}
+        timing = {}
+        pending = list(order)
+        running = {}
+        busy_keys = set()
+        failed = set()
+
+        while len(pending) > 0 or len(running) > 0:
+
+            # Start instruments of which all dependencies are available
+            for name in list(pending):
+                info = infos[name]
+                instype = info['type']
+                kwargs = info['kwargs']
+                if len(info['depends'] & (set(pending) | set(running))) > 0:
+                    continue
+
+                broken = info['depends'] & failed
+                if len(broken) > 0:
+                    logging.error('Not creating %s, dependencies failed: %s',
+                        name, ', '.join(broken))
+                    pending.remove(name)
+                    failed.add(name)
+                    timing[name] = (0, 'skipped')
+                    ret[name] = self._create_invalid_ins(name, instype,
+                        **kwargs)
+                    continue
+
+                if instype not in classes:
+                    logging.error('Instrument type %s not supported', instype)
+                    pending.remove(name)
+                    failed.add(name)
+                    timing[name] = (0, 'unsupported')
+                    ret[name] = None
+                    continue
+
+                insclass = classes[instype]
+                if insclass is None:
+                    pending.remove(name)
+                    failed.add(name)
+                    timing[name] = (0, 'no driver')
+                    ret[name] = self._create_invalid_ins(name, instype,
+                        **kwargs)
+                    continue
+
+                key = self._get_create_lock_key(insclass, name, kwargs)
+                if key in busy_keys:
+                    continue
+
+                if name in self._instruments:
+                    logging.warning('Instrument "%s" already exists, removing',
+                        name)
+                    self.remove(name)
+
+                args = dict(kwargs)
+                for k, val in args.iteritems():
+                    if isinstance(val, InstrumentRef):
+                        args[k] = self.get(val.get_name())
+
+                pending.remove(name)
+                busy_keys.add(key)
+                thread = calltimer.ThreadCall(self._construct_instrument,
+                    insclass, name, args)
+                running[name] = (thread, key, args, exact_time())
+
+            if len(running) == 0 and len(pending) > 0:
+                logging.error('Circular dependencies between instruments %s',
+                    ', '.join(pending))
+                for name in pending:
+                    failed.add(name)
+                    timing[name] = (0, 'circular dependency')
+                    ret[name] = self._create_invalid_ins(name,
+                        infos[name]['type'], **infos[name]['kwargs'])
+                pending = []
+                break
+
+            qt.flow.run_mainloop(0.01)
+
+            # Register instruments that finished initializing
+            for name, (thread, key, args, start) in running.items():
+                if thread.isAlive():
+                    continue
+
+                del running[name]
+                busy_keys.discard(key)
+                dt = exact_time() - start
+                ins, err = thread.get_return_value()
+                if ins is None:
+                    logging.error('Error creating instrument %s: %s', name, err)
+                    failed.add(name)
+                    timing[name] = (dt, 'failed')
+                    ret[name] = self._create_invalid_ins(name,
+                        infos[name]['type'], **args)
+                    continue
+
+                self.add(ins, create_args=args)
+                self.emit('instrument-added', name)
+                timing[name] = (dt, 'ok')
+                ret[name] = self.get(name)
+
+        if report:
+            print 'Instrument initialization times:'
+            for name in order:
+                dt, status = timing[name]
+                print '    %-20s %-25s %7.2f s  %s' % \
+                    (name, infos[name]['type'], dt, status)
+
+        return ret
+
     def reload_module(self, instype):
-        module = _get_driver_module(instype, do_reload=True)
+        module = _catalog.get_module(instype, do_reload=True)
         return module is not None
 
     def reload(self, ins):
@@ -343,10 +675,9 @@ class Instruments(SharedGObject):
         driver by implementing a detect_instruments() function.
         '''
 
-        module = _get_driver_module(driver)
+        module = _catalog.get_module(driver)
         if module is None:
             return False
-        reload(module)
 
         if not hasattr(module, 'detect_instruments'):
             logging.warning('Driver does not support instrument detection')
@@ -409,6 +740,7 @@ class Instruments(SharedGObject):
 _config = get_config()
 _insdir = _set_insdir()
 _user_insdir = _set_user_insdir()
+_catalog = DriverCatalog([d for d in (_user_insdir, _insdir) if d is not None])
 
 _instruments = None
 def get_instruments():
@@ -1,8 +1,18 @@
 # -*- coding: cp1252 -*-
-import ctypes, sys, os, array
+import ctypes, sys, os
+import threading
+import numpy
 if sys.platform == 'win32':
     import _winreg
 
+# ADwin data types in e_Set_Data / e_Get_Data etc.
+_TYPE_LONG = 2
+_TYPE_FLOAT = 5
+_DTYPES = {
+    _TYPE_LONG: numpy.int32,
+    _TYPE_FLOAT: numpy.float32,
+}
+
 # ADwin-Exception
 class ADwinError(Exception):
     def __init__(self, functionName, errorText, errorNumber):
@@ -19,6 +29,11 @@ class ADwin:
     __err = ctypes.c_long(0)
     __errPointer = ctypes.pointer(__err)
 
+    # All objects share the error variable (and mostly the device), so
+    # calls from different threads are serialised with one lock. Hold it
+    # to make a sequence of calls atomic.
+    lock = threading.RLock()
+
     def __init__(self, DeviceNo = 0x150, raiseExceptions = 1):
 
         if sys.platform == 'linux2':
@@ -68,6 +83,46 @@ class ADwin:
             if self.raiseExceptions != 0:
                 raise ADwinError(functionName, self.Get_Last_Error_Text(self.__err.value), self.__err.value)
 
+    def __inputArray(self, Data, typ, Count, functionName):
+        '''Return Data as a contiguous numpy array (or ctypes array) of the
+        ADwin type, without copying if it already is one.'''
+        if isinstance(Data, ctypes.Array):
+            return Data
+        dtype = numpy.dtype(_DTYPES[typ])
+        Data = numpy.asarray(Data)
+        if Data.dtype != dtype:
+            if not numpy.can_cast(Data.dtype, dtype, 'same_kind'):
+                raise ADwinError(functionName, 'Cannot convert %s data to %s' %
+                    (Data.dtype, dtype), 201)
+            # same_kind allows e.g. int64 -> int32, which would wrap
+            if dtype.kind == 'i' and Data.size > 0 and \
+                    not numpy.can_cast(Data.dtype, dtype, 'safe'):
+                info = numpy.iinfo(dtype)
+                if Data.min() < info.min or Data.max() > info.max:
+                    raise ADwinError(functionName, 'Data out of %s range' %
+                        dtype, 201)
+        data = numpy.ascontiguousarray(Data, dtype=dtype)
+        if data.ndim != 1 or len(data) < Count:
+            raise ADwinError(functionName, 'Data has less than %d elements' %
+                Count, 202)
+        return data
+
+    def __outputArray(self, out, typ, Count, functionName):
+        '''Return buffer for Count elements, 'out' if given.'''
+        dtype = numpy.dtype(_DTYPES[typ])
+        if out is None:
+            return numpy.empty(Count, dtype=dtype)
+        if not isinstance(out, numpy.ndarray) or out.dtype != dtype or \
+                not out.flags.c_contiguous or out.ndim != 1 or len(out) < Count:
+            raise ADwinError(functionName, 'Output buffer has to be a contiguous '
+                '%s array of at least %d elements' % (dtype, Count), 203)
+        return out[:Count]
+
+    def __pointer(self, data):
+        if isinstance(data, numpy.ndarray):
+            return data.ctypes.data_as(ctypes.c_void_p)
+        return data
+
     # system control and system information
     def Boot(self, Filename):
         '''Boot initializes the ADwin system and loads the file of the operating system.'''
@@ -156,20 +211,18 @@ class ADwin:
         self.__checkError('Get_Par')
         return ret
 
-    def Get_Par_Block(self, StartIndex, Count):
+    def Get_Par_Block(self, StartIndex, Count, out=None):
         '''Get_Par_Block returns a number of global long variables, 
-        which is to be indicated.'''
-        dataType = ctypes.c_long * Count
-        data = dataType(0)
-        self.dll.e_Get_ADBPar_All(StartIndex, Count, data, self.DeviceNo, self.__errPointer)
+        which is to be indicated, as numpy int32 array.'''
+        data = self.__outputArray(out, _TYPE_LONG, Count, 'Get_Par_Block')
+        self.dll.e_Get_ADBPar_All(StartIndex, Count, self.__pointer(data), self.DeviceNo, self.__errPointer)
         self.__checkError('Get_Par_Block')
         return data
 
-    def Get_Par_All(self):
+    def Get_Par_All(self, out=None):
         '''Get_Par_All returns all global long variables.'''
-        dataType = ctypes.c_long * 80
-        data = dataType(0)
-        self.dll.e_Get_ADBPar_All(1, 80, data, self.DeviceNo, self.__errPointer)
+        data = self.__outputArray(out, _TYPE_LONG, 80, 'Get_Par_All')
+        self.dll.e_Get_ADBPar_All(1, 80, self.__pointer(data), self.DeviceNo, self.__errPointer)
         self.__checkError('Get_Par_All')
         return data
 
@@ -186,20 +239,18 @@ class ADwin:
         self.__checkError('Get_FPar')
         return ret
         
-    def Get_FPar_Block(self, StartIndex, Count):
+    def Get_FPar_Block(self, StartIndex, Count, out=None):
         '''Get_FPar_Block returns a number of global float variables, 
-        which is to be indicated.'''
-        dataType = ctypes.c_float * Count
-        data = dataType(0)
-        self.dll.e_Get_ADBFPar_All(StartIndex, Count, data, self.DeviceNo, self.__errPointer)
+        which is to be indicated, as numpy float32 array.'''
+        data = self.__outputArray(out, _TYPE_FLOAT, Count, 'Get_FPar_Block')
+        self.dll.e_Get_ADBFPar_All(StartIndex, Count, self.__pointer(data), self.DeviceNo, self.__errPointer)
         self.__checkError('Get_FPar_Block')
         return data
 
-    def Get_FPar_All(self):
+    def Get_FPar_All(self, out=None):
         '''Get_Par_All returns all global float variables.'''
-        dataType = ctypes.c_float * 80
-        data = dataType(0)
-        self.dll.e_Get_ADBFPar_All(1, 80, data, self.DeviceNo, self.__errPointer)
+        data = self.__outputArray(out, _TYPE_FLOAT, 80, 'Get_FPar_All')
+        self.dll.e_Get_ADBFPar_All(1, 80, self.__pointer(data), self.DeviceNo, self.__errPointer)
         self.__checkError('Get_FPar_All')
         return data
 
@@ -213,47 +264,35 @@ class ADwin:
 
     def SetData_Long(self, Data, DataNo, Startindex, Count):
         '''SetData_Long transfers long data from the PC into a DATA array
-        of the ADwin system.'''
-        if (type(Data) == list) or (type(Data) == array.array):
-            # convert list to ctypes.c_long_Array
-            dataType = ctypes.c_long * Count
-            data = dataType(0)
-            for i in range(Count):
-                data[i] = Data[i]
-        else: # ctypes-array
-            data = Data
-        self.dll.e_Set_Data(data, 2, DataNo, Startindex, Count, self.DeviceNo, self.__errPointer)
+        of the ADwin system. Data can be a numpy array (passed without
+        copying if it is a contiguous int32 array), a list or a ctypes array.'''
+        data = self.__inputArray(Data, _TYPE_LONG, Count, 'SetData_Long')
+        self.dll.e_Set_Data(self.__pointer(data), _TYPE_LONG, DataNo, Startindex, Count, self.DeviceNo, self.__errPointer)
         self.__checkError('SetData_Long')
 
-    def GetData_Long(self, DataNo, StartIndex, Count):
+    def GetData_Long(self, DataNo, StartIndex, Count, out=None):
         '''GetData_Long transfers long data from a DATA array of an ADwin system
-        into an array.'''
-        dataType = ctypes.c_long * Count
-        data = dataType(0)
-        self.dll.e_Get_Data(data, 2, DataNo, StartIndex, Count, self.DeviceNo, self.__errPointer)
+        into a numpy int32 array. For repeated reads a buffer can be passed
+        as 'out', the data is then written into it.'''
+        data = self.__outputArray(out, _TYPE_LONG, Count, 'GetData_Long')
+        self.dll.e_Get_Data(self.__pointer(data), _TYPE_LONG, DataNo, StartIndex, Count, self.DeviceNo, self.__errPointer)
         self.__checkError('GetData_Long')
         return data
 
     def SetData_Float(self, Data, DataNo, Startindex, Count):
         '''SetData_Float transfers float data from the PC into a DATA array
-        of the ADwin system.'''
-        if (type(Data) == list) or (type(Data) == array.array):
-            # convert list to ctypes.c_float_Array
-            dataType = ctypes.c_float * Count
-            data = dataType(0)
-            for i in range(Count):
-                data[i] = Data[i]
-        else: # ctypes-array
-            data = Data
-        self.dll.e_Set_Data(data, 5, DataNo, Startindex, Count, self.DeviceNo, self.__errPointer)
+        of the ADwin system. Data can be a numpy array (passed without
+        copying if it is a contiguous float32 array), a list or a ctypes array.'''
+        data = self.__inputArray(Data, _TYPE_FLOAT, Count, 'SetData_Float')
+        self.dll.e_Set_Data(self.__pointer(data), _TYPE_FLOAT, DataNo, Startindex, Count, self.DeviceNo, self.__errPointer)
         self.__checkError('SetData_Float')
 
-    def GetData_Float(self, DataNo, StartIndex, Count):
+    def GetData_Float(self, DataNo, StartIndex, Count, out=None):
         '''GetData_Float transfers float data from a DATA array of an ADwin system
-        into an array.'''
-        dataType = ctypes.c_float * Count
-        data = dataType(0)
-        self.dll.e_Get_Data(data, 5, DataNo, StartIndex, Count, self.DeviceNo, self.__errPointer)
+        into a numpy float32 array. For repeated reads a buffer can be passed
+        as 'out', the data is then written into it.'''
+        data = self.__outputArray(out, _TYPE_FLOAT, Count, 'GetData_Float')
+        self.dll.e_Get_Data(self.__pointer(data), _TYPE_FLOAT, DataNo, StartIndex, Count, self.DeviceNo, self.__errPointer)
         self.__checkError('GetData_Float')
         return data
 
@@ -276,44 +315,34 @@ class ADwin:
         self.__checkError('Fifo_Clear')
 
     def SetFifo_Long(self, FifoNo, Data, Count):
-        '''SetFifo_Long transfers long data from the PC to a FIFO array of the ADwin system.'''
-        if (type(Data) == list) or (type(Data) == array.array):
-            # convert list to ctypes.c_long_Array
-            dataType = ctypes.c_long * Count
-            data = dataType(0)
-            for i in range(Count):
-                data[i] = Data[i]
-        else: # ctypes-array
-            data = Data
-        self.dll.e_Set_Fifo(data, 2, FifoNo, Count, self.DeviceNo, self.__errPointer)
+        '''SetFifo_Long transfers long data from the PC to a FIFO array of the ADwin system.
+        Data can be a numpy array (passed without copying if it is a
+        contiguous int32 array), a list or a ctypes array.'''
+        data = self.__inputArray(Data, _TYPE_LONG, Count, 'SetFifo_Long')
+        self.dll.e_Set_Fifo(self.__pointer(data), _TYPE_LONG, FifoNo, Count, self.DeviceNo, self.__errPointer)
         self.__checkError('SetFifo_Long')
 
-    def GetFifo_Long(self, FifoNo, Count):
-        '''GetFifo_Long transfers long FIFO data from the ADwin system to the PC.'''
-        dataType = ctypes.c_long * Count
-        data = dataType(0)
-        self.dll.e_Get_Fifo(data, 2, FifoNo, Count, self.DeviceNo, self.__errPointer)
+    def GetFifo_Long(self, FifoNo, Count, out=None):
+        '''GetFifo_Long transfers long FIFO data from the ADwin system to the PC,
+        as numpy int32 array (written into 'out' if given).'''
+        data = self.__outputArray(out, _TYPE_LONG, Count, 'GetFifo_Long')
+        self.dll.e_Get_Fifo(self.__pointer(data), _TYPE_LONG, FifoNo, Count, self.DeviceNo, self.__errPointer)
         self.__checkError('GetFifo_Long')
         return data
 
     def SetFifo_Float(self, FifoNo, Data, Count):
-        '''SetFifo_Float transfers float data from the PC into a FIFO array of the ADwin system.'''
-        if (type(Data) == list) or (type(Data) == array.array):
-            # convert list to ctypes.c_float_Array
-            dataType = ctypes.c_float * Count
-            data = dataType(0)
-            for i in range(Count):
-                data[i] = Data[i]
-        else: # ctypes-array
-            data = Data
-        self.dll.e_Set_Fifo(data, 5, FifoNo, Count, self.DeviceNo, self.__errPointer)
+        '''SetFifo_Float transfers float data from the PC into a FIFO array of the ADwin system.
+        Data can be a numpy array (passed without copying if it is a
+        contiguous float32 array), a list or a ctypes array.'''
+        data = self.__inputArray(Data, _TYPE_FLOAT, Count, 'SetFifo_Float')
+        self.dll.e_Set_Fifo(self.__pointer(data), _TYPE_FLOAT, FifoNo, Count, self.DeviceNo, self.__errPointer)
         self.__checkError('SetFifo_Float')
 
-    def GetFifo_Float(self, FifoNo, Count):
-        '''GetFifo_Float transfers float FIFO data from the ADwin system to the PC.'''
-        dataType = ctypes.c_float * Count
-        data = dataType(0)
-        self.dll.e_Get_Fifo(data, 5, FifoNo, Count, self.DeviceNo, self.__errPointer)
+    def GetFifo_Float(self, FifoNo, Count, out=None):
+        '''GetFifo_Float transfers float FIFO data from the ADwin system to the PC,
+        as numpy float32 array (written into 'out' if given).'''
+        data = self.__outputArray(out, _TYPE_FLOAT, Count, 'GetFifo_Float')
+        self.dll.e_Get_Fifo(self.__pointer(data), _TYPE_FLOAT, FifoNo, Count, self.DeviceNo, self.__errPointer)
         self.__checkError('GetFifo_Float')
         return data
 
@@ -353,4 +382,19 @@ class ADwin:
 
     def Get_Last_Error(self):
         '''Get_Last_Error returns the number of the last error.'''
-        return self.__err.value
\ No newline at end of file
+        return self.__err.value
+
+def _locked(func):
+    def wrapper(self, *args, **kwargs):
+        self.lock.acquire()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            self.lock.release()
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+for _name, _func in ADwin.__dict__.items():
+    if not _name.startswith('_') and callable(_func):
+        setattr(ADwin, _name, _locked(_func))
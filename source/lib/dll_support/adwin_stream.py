@@ -0,0 +1,244 @@
+# adwin_stream.py, draining ADwin DATA and FIFO arrays while a process runs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Background transfer of results from a running ADwin process, e.g. the
+pixels of a line scan. A reader copies new elements into preallocated
+numpy buffers (using the out= argument of the ADwin wrapper) and an
+ADwinDrain runs it in a lib.streaming thread:
+
+    reader = adwin_stream.ArrayReader(adw, (11, 12, 13), npixels, par=4)
+    drain = adwin_stream.ADwinDrain(reader)
+    drain.start()
+    while not drain.is_done():
+        for item in drain.get_items():
+            ...
+
+Each item is a dictionary with 'start' (index of the first new element)
+and 'values' (list of arrays, one per DATA / FIFO array). The arrays are
+views into the reader buffers, which are not overwritten during a run.
+
+The ADwin wrapper serialises DLL calls from different threads, so the
+main thread can still access the ADwin while a drain is running.
+'''
+
+import time
+import numpy
+
+from lib import streaming
+
+_DTYPES = {
+    'long': numpy.int32,
+    'float': numpy.float32,
+}
+
+def _get_funcs(adwin, dtype):
+    if dtype == 'long':
+        return adwin.GetData_Long, adwin.GetFifo_Long
+    elif dtype == 'float':
+        return adwin.GetData_Float, adwin.GetFifo_Float
+    raise ValueError('Unknown ADwin data type %r' % dtype)
+
+class _Reader():
+
+    def __init__(self, nos, count, dtype, interval):
+        self._nos = list(nos)
+        self.count = int(count)
+        self._interval = interval
+        self._buffers = [numpy.zeros(self.count, dtype=_DTYPES[dtype])
+            for no in self._nos]
+        self._done = 0
+
+    def reset(self):
+        self._done = 0
+
+    def get_buffers(self):
+        '''Return the result arrays, filled up to get_done().'''
+        return self._buffers
+
+    def get_done(self):
+        return self._done
+
+    def is_finished(self):
+        return self._done >= self.count
+
+    def _available(self):
+        raise NotImplementedError()
+
+    def _transfer(self, no, n, out):
+        raise NotImplementedError()
+
+    def read(self):
+        '''
+        Transfer all new elements. Returns an item, or None (after waiting
+        one poll interval) if nothing new is available.
+        '''
+
+        n = min(self._available(), self.count - self._done)
+        if n <= 0:
+            time.sleep(self._interval)
+            return None
+
+        start = self._done
+        for no, buf in zip(self._nos, self._buffers):
+            self._transfer(no, n, buf[start:start+n])
+        self._done += n
+        return {
+            'start': start,
+            'values': [buf[start:start+n] for buf in self._buffers],
+        }
+
+class ArrayReader(_Reader):
+    '''
+    Reads DATA arrays that a process fills from index 1 onwards. The
+    number of completed elements has to be available in a global Par.
+    '''
+
+    def __init__(self, adwin, data_nos, count, par, dtype='long',
+            interval=0.02):
+        '''
+        Input:
+            adwin (ADwin): ADwin wrapper from lib.dll_support.ADwin
+            data_nos (list of int): DATA array numbers
+            count (int): number of elements to read per array
+            par (int): Par holding the number of completed elements
+            dtype (string): 'long' or 'float'
+            interval (float): poll interval in seconds
+        '''
+
+        self._adwin = adwin
+        self._par = par
+        self._get = _get_funcs(adwin, dtype)[0]
+        _Reader.__init__(self, data_nos, count, dtype, interval)
+
+    def _available(self):
+        return self._adwin.Get_Par(self._par) - self._done
+
+    def _transfer(self, no, n, out):
+        self._get(no, self._done + 1, n, out=out)
+
+class FifoReader(_Reader):
+    '''
+    Reads FIFO arrays that a process fills with one element per array at a
+    time. Only elements present in all FIFOs are transferred.
+    '''
+
+    def __init__(self, adwin, fifo_nos, count, dtype='long', interval=0.02):
+        '''
+        Input:
+            adwin (ADwin): ADwin wrapper from lib.dll_support.ADwin
+            fifo_nos (list of int): FIFO (DATA array) numbers
+            count (int): number of elements to read per FIFO
+            dtype (string): 'long' or 'float'
+            interval (float): poll interval in seconds
+        '''
+
+        self._adwin = adwin
+        self._get = _get_funcs(adwin, dtype)[1]
+        _Reader.__init__(self, fifo_nos, count, dtype, interval)
+
+    def clear(self):
+        '''Clear the FIFOs, call before starting the process.'''
+        for no in self._nos:
+            self._adwin.Fifo_Clear(no)
+
+    def _available(self):
+        return min([self._adwin.Fifo_Full(no) for no in self._nos])
+
+    def _transfer(self, no, n, out):
+        self._get(no, n, out=out)
+
+class SimulatedReader(_Reader):
+    '''
+    Produces count elements per array at rate elements per second, with
+    Poisson distributed values of mean 'mean'.
+    '''
+
+    def __init__(self, narrays, count, rate=1000.0, mean=100.0,
+            interval=0.02, seed=None):
+        self._rate = float(rate)
+        self._mean = mean
+        self._random = numpy.random.RandomState(seed)
+        self._tstart = None
+        _Reader.__init__(self, range(narrays), count, 'long', interval)
+
+    def reset(self):
+        _Reader.reset(self)
+        self._tstart = None
+
+    def _available(self):
+        if self._tstart is None:
+            self._tstart = time.time()
+        return int((time.time() - self._tstart) * self._rate) - self._done
+
+    def _transfer(self, no, n, out):
+        out[:] = self._random.poisson(self._mean, n)
+
+class ADwinDrain():
+    '''
+    Runs a reader in a background thread until all elements are read or
+    stop() is called. New elements are collected in a queue; get_items()
+    returns them to the main thread.
+    '''
+
+    def __init__(self, reader, queue_size=1024):
+        self._reader = reader
+        self._queue = streaming.DataQueue(queue_size)
+        self._thread = None
+
+    def get_reader(self):
+        return self._reader
+
+    def start(self):
+        self._reader.reset()
+        self._queue.clear()
+        self._queue.reset_counters()
+        self._thread = streaming.StreamThread(self._read, queue=self._queue,
+            name='ADwin drain')
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._thread.stop()
+
+    def _read(self):
+        item = self._reader.read()
+        if self._reader.is_finished():
+            self._thread.stop()
+        return item
+
+    def is_running(self):
+        return self._thread is not None and self._thread.isAlive()
+
+    def is_done(self):
+        '''Return whether the thread ended and all items were retrieved.'''
+        return not self.is_running() and self._queue.qsize() == 0
+
+    def get_error(self):
+        if self._thread is None:
+            return None
+        return self._thread.get_error()
+
+    def get_items(self):
+        '''Return list of all items not retrieved yet.'''
+        return self._queue.get_all()
+
+    def get_progress(self):
+        '''Return number of elements transferred.'''
+        return self._reader.get_done()
+
+    def get_overruns(self):
+        return self._queue.get_overruns()
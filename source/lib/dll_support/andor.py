@@ -1,6 +1,7 @@
 from ctypes import *
 import numpy as np
 import time
+from lib.math import spectra
 
 DRV_ERROR_CODES = 20001
 DRV_SUCCESS = 20002
@@ -117,6 +118,15 @@ DRV_OW_NOT_INITIALIZED = 20154
 DRV_OW_ERROR_SLAVE_NUM = 20155
 DRV_MSTIMINGS_ERROR = 20156
 
+# SetAcquisitionMode values
+ACQMODE_SINGLE_SCAN = 1
+ACQMODE_ACCUMULATE = 2
+ACQMODE_KINETICS = 3
+ACQMODE_FAST_KINETICS = 4
+ACQMODE_RUN_TILL_ABORT = 5
+
+WAIT_OBJECT_0 = 0
+
 AC_ACQMODE_SINGLE = 1
 AC_ACQMODE_VIDEO = 2
 AC_ACQMODE_ACCUMULATE = 4
@@ -287,8 +297,20 @@ def set_cooler_on(on=True):
 def set_coolor_off():
     return set_cooler_on(False)
 
+# Settings that determine the background, see get_settings_key()
+_settings = {}
+
+# Background cache and spike rejection used by get_spectrum_adv()
+pipeline = spectra.SpectrumPipeline()
+
+def get_settings_key():
+    '''Return the background cache key for the current settings.'''
+    return pipeline.backgrounds.make_key(**_settings)
+
 def set_exposure_time(exposuretime):
     ret = andor.SetExposureTime(c_float(exposuretime))
+    if ret == DRV_SUCCESS:
+        _settings['exposure'] = float(exposuretime)
     return ret
 
 def start_acquisition():
@@ -308,48 +330,75 @@ def wait_idle(delay=30):
         time.sleep(0.5)
     return False
 
-def get_acquired_data(bufsize=1024):
-    data = np.zeros(bufsize, dtype=np.int32)
-    ret = andor.GetAcquiredData(data.ctypes.data, bufsize)
-    return data
-
-def get_spectrum():
-    xpix, ypix = get_detector()
-    start_acquisition()
-    while get_status() == DRV_ACQUIRING:
-        time.sleep(0.1)
-    time.sleep(0.2)
-    return get_acquired_data(xpix)
-
-def get_spectrum_adv(background=None, ntries=3, thresh=0.15):
+def wait_for_acquisition(timeout=10.0):
     '''
-    Get a spectrum from the Andor. Subtracts background and tries to
-    detect 'bad' pixels, in case of which a new spectrum will be
-    taken (up to ntries times).
+    Block until the driver signals an acquisition event (a new image or
+    the end of the acquisition). Returns False on timeout.
     '''
-    for i in range(ntries):
-        spec = get_spectrum()
-        if background is not None:
-            spec -= background
+    ret = andor.WaitForAcquisitionTimeOut(c_int(int(timeout * 1000)))
+    return ret == DRV_SUCCESS
 
-        maxval = np.max(spec)
-        if maxval < 100:
-            return spec
+def abort_acquisition():
+    return andor.AbortAcquisition()
 
-        minval = maxval * thresh
-        maxpos = np.argmax(spec)
+def set_acquisition_mode(mode):
+    return andor.SetAcquisitionMode(c_int(mode))
 
-        # If any of the neighbouring points is above the threshold it's ok.
-        if (maxpos == 0 or spec[maxpos-1] >= minval) or \
-            (maxpos == len(spec) - 1 or spec[maxpos+1] >= minval):
-            return spec
+def set_kinetic_cycle_time(t):
+    return andor.SetKineticCycleTime(c_float(t))
 
-        print 'Bad pixel detected!'
+def get_acquired_data(bufsize=1024, out=None):
+    '''
+    Return the data of the last acquisition as int32 array. A buffer can
+    be passed as 'out' to avoid allocating a new one.
+    '''
+    if out is None:
+        out = np.zeros(bufsize, dtype=np.int32)
+    ret = andor.GetAcquiredData(out.ctypes.data, c_ulong(out.size))
+    return out
 
-    print 'Warning: returning spectrum with possibly bad pixel'
-    for i in range(maxpos-5,maxpos+5):
-        print 'pos %d = %d' % (i, spec[i])
+def get_spectrum(timeout=60.0, out=None):
+    xpix, ypix = get_detector()
+    start_acquisition()
+    tend = time.time() + timeout
+    while get_status() == DRV_ACQUIRING:
+        left = tend - time.time()
+        if left <= 0:
+            abort_acquisition()
+            raise IOError('Andor acquisition timed out')
+        wait_for_acquisition(left)
+    return get_acquired_data(xpix, out=out)
+
+def take_background(nframes=5):
+    '''
+    Take nframes spectra (with the light blocked) and store their median
+    as background for the current settings.
+    '''
+    frames = [get_spectrum() for i in range(nframes)]
+    return pipeline.backgrounds.add(get_settings_key(), frames)
 
+def get_spectrum_adv(background=None, ntries=None, thresh=None):
+    '''
+    Get a spectrum from the Andor. Subtracts the background (the one
+    given, otherwise the one stored by take_background() for the current
+    settings) and replaces cosmic rays / hot pixels in place, using the
+    neighbouring pixels and the previous spectra, instead of taking a new
+    spectrum.
+
+    ntries and thresh are ignored, they were used for re-acquiring
+    spectra with bad pixels; set the thresholds on 'pipeline' instead.
+    '''
+    spec = get_spectrum().astype(np.float64)
+    if background is not None:
+        spec -= background
+        key = None
+    else:
+        key = get_settings_key()
+    npatched = pipeline.get_patched_count()
+    pipeline.process(spec, key=key, out=spec)
+    if pipeline.get_patched_count() > npatched:
+        print 'Patched %d bad pixel(s)' % \
+            (pipeline.get_patched_count() - npatched)
     return spec
 
 
@@ -358,6 +407,82 @@ def get_temperature():
     ret = andor.GetTemperature(byref(temp))
     return temp.value
 
+class ContinuousSource():
+    '''
+    Run-till-abort acquisition source for lib.framering. The driver
+    signals new images through a Windows event, and GetImages copies them
+    straight into the slots of the FrameRing (int32 frames of
+    frame_shape). Images the driver overwrote in its own circular buffer
+    before they were read are counted as dropped.
+    '''
+
+    def __init__(self, frame_shape=None, cycle_time=0):
+        '''
+        Input:
+            frame_shape (tuple): shape of one image, default is a full
+                vertical binning spectrum (1, xpix)
+            cycle_time (float): kinetic cycle time, 0 for the fastest
+        '''
+        if frame_shape is None:
+            xpix, ypix = get_detector()
+            frame_shape = (1, xpix)
+        self.frame_shape = tuple(frame_shape)
+        self._cycle_time = cycle_time
+        self._event = None
+        self._next = 1
+
+    def start(self, ring):
+        if ring.buffer.dtype != np.int32 or ring.shape != self.frame_shape:
+            raise ValueError('Ring does not match the frame shape %s' % \
+                (self.frame_shape, ))
+        set_acquisition_mode(ACQMODE_RUN_TILL_ABORT)
+        set_kinetic_cycle_time(self._cycle_time)
+        self._event = windll.kernel32.CreateEventA(None, 0, 0, None)
+        andor.SetDriverEvent(self._event)
+        self._next = 1
+        start_acquisition()
+
+    def stop(self):
+        abort_acquisition()
+        # get_spectrum() expects single scans
+        set_acquisition_mode(ACQMODE_SINGLE_SCAN)
+        if self._event is not None:
+            andor.SetDriverEvent(None)
+            windll.kernel32.CloseHandle(self._event)
+            self._event = None
+
+    def poll(self, ring, timeout):
+        windll.kernel32.WaitForSingleObject(self._event,
+            int(timeout * 1000))
+
+        first, last = c_long(0), c_long(0)
+        ret = andor.GetNumberNewImages(byref(first), byref(last))
+        if ret == DRV_NO_NEW_DATA:
+            return 0
+        elif ret != DRV_SUCCESS:
+            raise IOError('GetNumberNewImages failed with code %d' % ret)
+
+        dropped = max(first.value - self._next, 0)
+        n = last.value - first.value + 1
+        # Only the newest images fit in the ring
+        if n > ring.nframes:
+            dropped += n - ring.nframes
+            n = ring.nframes
+        num = ring.get_frame_count()
+        index = last.value - n + 1
+        validfirst, validlast = c_long(0), c_long(0)
+        for block in ring.get_slots(num, n):
+            nblock = len(block)
+            ret = andor.GetImages(c_long(index), c_long(index + nblock - 1),
+                block.ctypes.data, c_ulong(block.size),
+                byref(validfirst), byref(validlast))
+            if ret != DRV_SUCCESS:
+                raise IOError('GetImages failed with code %d' % ret)
+            index += nblock
+        self._next = last.value + 1
+        ring.commit(n, dropped)
+        return n
+
 def shutdown():
     ret = andor.ShutDown()
 
@@ -372,6 +497,8 @@ def set_read_mode(mode):
     '''
     romode = c_int32(mode)
     ret = andor.SetReadMode(romode)
+    if ret == DRV_SUCCESS:
+        _settings['read_mode'] = mode
     return ret
 
 def get_read_mode():
@@ -21,6 +21,7 @@ import types
 import numpy
 import logging
 import time
+import threading
 
 nidaq = ctypes.windll.nicaiu
 
@@ -63,6 +64,9 @@ DAQmx_Val_CountUp           = 10128
 DAQmx_Val_CountDown         = 10124
 DAQmx_Val_ExtControlled     = 10326
 
+DAQmx_Val_Task_Commit       = 3
+DAQmx_Val_Task_Unreserve    = 5
+
 def CHK(err):
     '''Error checking routine'''
 
@@ -89,6 +93,187 @@ def buf_to_list(buf):
 
     return namelist
 
+def _clear_task(taskHandle):
+    '''Stop, unreserve and clear a task, ignoring errors.'''
+    if taskHandle.value != 0:
+        nidaq.DAQmxStopTask(taskHandle)
+        nidaq.DAQmxTaskControl(taskHandle, DAQmx_Val_Task_Unreserve)
+        nidaq.DAQmxClearTask(taskHandle)
+
+def _split_devchan(devchan):
+    '''Split '/Dev1/ao0' or 'Dev1/ao0' in ('Dev1', 'ao0').'''
+    parts = devchan.strip('/').split('/', 1)
+    if len(parts) == 1:
+        return '', parts[0]
+    return parts[0], parts[1]
+
+def _get_resource(devchan):
+    '''
+    Return the name of the hardware resource a channel reserves. All analog
+    inputs of a device share one converter, so they map to 'Dev1/ai'.
+    '''
+    dev, chan = _split_devchan(devchan)
+    if chan.lower().startswith('ai'):
+        chan = 'ai'
+    return '%s/%s' % (dev, chan.lower())
+
+class TaskCache():
+    '''
+    Keeps configured tasks committed between calls, so that repeated reads
+    and writes with the same settings only have to start and stop them.
+
+    Entries are stored by a key containing the complete task configuration,
+    together with the resources the tasks reserve. Creating a task for a
+    resource that is in use by another entry releases that entry first.
+    '''
+
+    def __init__(self):
+        self._entries = {}
+        self._enabled = True
+        self._lock = threading.RLock()
+        self._hits = 0
+        self._misses = 0
+
+    def set_enabled(self, enabled):
+        self._lock.acquire()
+        try:
+            self._enabled = bool(enabled)
+            if not self._enabled:
+                self.clear()
+        finally:
+            self._lock.release()
+
+    def is_enabled(self):
+        return self._enabled
+
+    def get(self, key, resources, create_func):
+        '''
+        Return (handles, cached). If the cache is enabled, the tasks for
+        'key' are looked up or created with create_func() and committed.
+        Otherwise create_func() is called and the caller has to clear the
+        returned tasks itself.
+
+        Input:
+            key (tuple): complete task configuration
+            resources (list): resources used, see _get_resource()
+            create_func (function): returns a tuple of task handles
+        '''
+
+        self._lock.acquire()
+        try:
+            if not self._enabled:
+                self.release(resources)
+                return create_func(), False
+
+            if key in self._entries:
+                self._hits += 1
+                return self._entries[key][1], True
+
+            self._misses += 1
+            self.release(resources)
+            handles = create_func()
+            try:
+                for handle in handles:
+                    CHK(nidaq.DAQmxTaskControl(handle, DAQmx_Val_Task_Commit))
+            except:
+                for handle in handles:
+                    _clear_task(handle)
+                raise
+            self._entries[key] = (set(resources), handles)
+            return handles, True
+        finally:
+            self._lock.release()
+
+    def discard(self, key):
+        '''Clear the tasks of 'key', e.g. after an error.'''
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                for handle in entry[1]:
+                    _clear_task(handle)
+        finally:
+            self._lock.release()
+
+    def release(self, resources):
+        '''Clear all tasks that use one of 'resources'.'''
+        resources = set(resources)
+        self._lock.acquire()
+        try:
+            for key, entry in self._entries.items():
+                if entry[0] & resources:
+                    self.discard(key)
+        finally:
+            self._lock.release()
+
+    def clear(self, dev=None):
+        '''Clear all tasks, or all tasks on device 'dev'.'''
+        self._lock.acquire()
+        try:
+            for key, entry in self._entries.items():
+                if dev is None or \
+                        [r for r in entry[0] if r.split('/')[0] == dev]:
+                    self.discard(key)
+        finally:
+            self._lock.release()
+
+    def get_stats(self):
+        return {
+            'hits': self._hits,
+            'misses': self._misses,
+            'entries': len(self._entries),
+        }
+
+_task_cache = TaskCache()
+
+def enable_task_cache(enable=True):
+    '''
+    Enable or disable keeping tasks committed between calls. This is a
+    module-wide setting shared by all devices; disabling clears all cached
+    tasks.
+    '''
+    _task_cache.set_enabled(enable)
+
+def is_task_cache_enabled():
+    return _task_cache.is_enabled()
+
+def clear_task_cache(dev=None):
+    '''
+    Clear cached tasks (of device 'dev'), releasing their resources. Should
+    be called when channels are reconfigured outside of this module.
+    '''
+    _task_cache.clear(dev)
+
+def get_task_cache_stats():
+    '''Return dictionary with cache hits, misses and number of entries.'''
+    return _task_cache.get_stats()
+
+def release_channels(devchans):
+    '''Clear cached tasks that use any of the channels in 'devchans'.'''
+    _task_cache.release([_get_resource(d) for d in devchans])
+
+class HotTasks():
+    '''
+    Context manager that keeps tasks committed for a block of code, e.g. a
+    sweep, even if the task cache is disabled:
+
+        with nidaq.HotTasks():
+            for v in values:
+                nidaq.write('Dev1/ao0', v)
+                data.add_data_point(v, nidaq.read('Dev1/ai0'))
+
+    If the cache was disabled, the tasks are cleared at the end.
+    '''
+
+    def __enter__(self):
+        self._was_enabled = _task_cache.is_enabled()
+        _task_cache.set_enabled(True)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        _task_cache.set_enabled(self._was_enabled)
+        return False
+
 def get_device_names():
     '''Return a list of available NIDAQ devices.'''
 
@@ -99,6 +284,7 @@ def get_device_names():
 
 def reset_device(dev):
     '''Reset device "dev"'''
+    clear_task_cache(dev)
     nidaq.DAQmxResetDevice(dev)
 
 def get_physical_input_channels(dev):
@@ -168,19 +354,32 @@ def read(devchan, samples=1, freq=10000.0, minv=-10.0, maxv=10.0,
 
     data = numpy.zeros(samples, dtype=numpy.float64)
 
-    taskHandle = TaskHandle()
+    def create():
+        taskHandle = TaskHandle(0)
+        try:
+            CHK(nidaq.DAQmxCreateTask("", ctypes.byref(taskHandle)))
+            CHK(nidaq.DAQmxCreateAIVoltageChan(taskHandle, devchan, "",
+                config,
+                float64(minv), float64(maxv),
+                DAQmx_Val_Volts, None))
+            if retsamples > 1:
+                CHK(nidaq.DAQmxCfgSampClkTiming(taskHandle, "", float64(freq),
+                    DAQmx_Val_Rising, DAQmx_Val_FiniteSamps,
+                    uInt64(samples)));
+        except:
+            _clear_task(taskHandle)
+            raise
+        return (taskHandle,)
+
+    key = ('ai', devchan, config, minv, maxv, retsamples, freq)
+    taskHandle = TaskHandle(0)
+    cached = False
     read = int32()
     try:
-        CHK(nidaq.DAQmxCreateTask("", ctypes.byref(taskHandle)))
-        CHK(nidaq.DAQmxCreateAIVoltageChan(taskHandle, devchan, "",
-            config,
-            float64(minv), float64(maxv),
-            DAQmx_Val_Volts, None))
+        (taskHandle,), cached = _task_cache.get(key,
+            [_get_resource(devchan)], create)
 
         if retsamples > 1:
-            CHK(nidaq.DAQmxCfgSampClkTiming(taskHandle, "", float64(freq),
-                DAQmx_Val_Rising, DAQmx_Val_FiniteSamps,
-                uInt64(samples)));
             CHK(nidaq.DAQmxStartTask(taskHandle))
             CHK(nidaq.DAQmxReadAnalogF64(taskHandle, samples, float64(timeout),
                 DAQmx_Val_GroupByChannel, data.ctypes.data,
@@ -192,13 +391,20 @@ def read(devchan, samples=1, freq=10000.0, minv=-10.0, maxv=10.0,
 
     except Exception, e:
         logging.error('NI DAQ call failed: %s', str(e))
+        if cached:
+            _task_cache.discard(key)
+            cached = False
+            taskHandle = TaskHandle(0)
 
     finally:
-        if taskHandle.value != 0:
+        if cached:
+            # Back to the committed state
+            nidaq.DAQmxStopTask(taskHandle)
+        elif taskHandle.value != 0:
             nidaq.DAQmxStopTask(taskHandle)
             nidaq.DAQmxClearTask(taskHandle)
 
-    if read > 0:
+    if read.value > 0:
         if retsamples == 1:
             return data[0]
         else:
@@ -231,6 +437,10 @@ def write(devchan, data, freq=10000.0, minv=-10.0, maxv=10.0,
         data = numpy.array(data, dtype=numpy.float64)
     samples = len(data)
 
+    if samples == 1:
+        return _write_scalar(devchan, data[0], minv, maxv, timeout)
+
+    release_channels([devchan])
     taskHandle = TaskHandle()
     written = int32()
     try:
@@ -238,18 +448,13 @@ def write(devchan, data, freq=10000.0, minv=-10.0, maxv=10.0,
         CHK(nidaq.DAQmxCreateAOVoltageChan(taskHandle, devchan, "",
                 float64(minv), float64(maxv), DAQmx_Val_Volts, None))
 
-        if len(data) == 1:
-            CHK(nidaq.DAQmxWriteAnalogScalarF64(taskHandle, 1, float64(timeout),
-                float64(data[0]), None))
-            written = int32(1)
-        else:
-            print 'multiple samples detected'
-            CHK(nidaq.DAQmxCfgSampClkTiming(taskHandle, "", float64(freq),
-                DAQmx_Val_Rising, DAQmx_Val_FiniteSamps, uInt64(samples)))
-            CHK(nidaq.DAQmxWriteAnalogF64(taskHandle, samples, True, float64(timeout),
-                DAQmx_Val_GroupByChannel, data.ctypes.data,
-                ctypes.byref(written), None))
-            #CHK(nidaq.DAQmxStartTask(taskHandle))
+        logging.debug('Writing %d samples to %s', samples, devchan)
+        CHK(nidaq.DAQmxCfgSampClkTiming(taskHandle, "", float64(freq),
+            DAQmx_Val_Rising, DAQmx_Val_FiniteSamps, uInt64(samples)))
+        CHK(nidaq.DAQmxWriteAnalogF64(taskHandle, samples, True, float64(timeout),
+            DAQmx_Val_GroupByChannel, data.ctypes.data,
+            ctypes.byref(written), None))
+        #CHK(nidaq.DAQmxStartTask(taskHandle))
     except Exception, e:
         logging.error('NI DAQ call failed (correct channel configuration selected?): %s', str(e))
 
@@ -260,75 +465,87 @@ def write(devchan, data, freq=10000.0, minv=-10.0, maxv=10.0,
 
     return written.value
 
+def _write_scalar(devchan, val, minv, maxv, timeout):
+    '''Write a single value using a (cached) on-demand task.'''
+
+    def create():
+        taskHandle = TaskHandle(0)
+        try:
+            CHK(nidaq.DAQmxCreateTask("", ctypes.byref(taskHandle)))
+            CHK(nidaq.DAQmxCreateAOVoltageChan(taskHandle, devchan, "",
+                    float64(minv), float64(maxv), DAQmx_Val_Volts, None))
+        except:
+            _clear_task(taskHandle)
+            raise
+        return (taskHandle,)
+
+    key = ('ao', devchan, minv, maxv)
+    taskHandle = TaskHandle(0)
+    cached = False
+    written = 0
+    try:
+        (taskHandle,), cached = _task_cache.get(key,
+            [_get_resource(devchan)], create)
+        CHK(nidaq.DAQmxWriteAnalogScalarF64(taskHandle, 1, float64(timeout),
+            float64(val), None))
+        written = 1
+    except Exception, e:
+        logging.error('NI DAQ call failed (correct channel configuration selected?): %s', str(e))
+        if cached:
+            _task_cache.discard(key)
+            cached = False
+            taskHandle = TaskHandle(0)
+
+    finally:
+        if not cached and taskHandle.value != 0:
+            nidaq.DAQmxClearTask(taskHandle)
+
+    return written
+
 def writearray(devchan, vdata, freq=10000.0, minv=-10.0, maxv=10.0,
                 timeout=10.0):
     '''
     Write values to channel
 
     Input:
-        devchan (string): device/channel specifier, such as /Dev1/ao0
-        ctrchan (string): device/counter specifier, such as /Dev1/ctr0
-        src (string): device terminal to detect edges on, such as PFI0
-        aochan (string): device/ao sampleclock specifier, e.g. /Dev1/ao/SampleClock
-        data (numpy.array): data to write
+        devchan (string): device/channel specifier, such as /Dev1/ao0, or
+            a comma separated list of channels
+        data (numpy.array): data to write, float[nchannels, n] for more
+            than one channel
         freq (float): the frequency at which to write the AO samples (and count)
         minv (float): the minimum voltage
         maxv (float): the maximum voltage
         timeout (float): the time in seconds to wait for completion
 
     Output:
-        Number of values written
+        Number of values written per channel, raises RuntimeError if the
+        write failed
     '''
-    # First we create a counter task and then set it to use the analog out
-    # sample clock to trigger when it actually takes samples.
-
+    release_channels(devchan.split(','))
     taskHandleAO = TaskHandle(0)
     nwritten = int32()
-    nread = int32()
-    samples = len(vdata)
-    cdata = numpy.zeros(samples, dtype=numpy.uint32)
+    vdata = numpy.ascontiguousarray(vdata, dtype=numpy.float64)
+    samples = vdata.shape[-1]
 
+    # Errors are raised, the caller has to know whether the output moved
     try:
-        # Now start creating the analog out task to write the voltage array
         CHK(nidaq.DAQmxCreateTask("", ctypes.byref(taskHandleAO)))
-        # Set up the task with an analog out channel on devchan
         CHK(nidaq.DAQmxCreateAOVoltageChan(taskHandleAO, devchan, None,
             float64(minv), float64(maxv), DAQmx_Val_Volts, None))
         CHK(nidaq.DAQmxCfgSampClkTiming(taskHandleAO,"",float64(freq),DAQmx_Val_Rising,DAQmx_Val_FiniteSamps,uInt64(samples)))
-    except Exception, e:
-        logging.error('Failed in AO setup phase: %s', str(e))
-
-    try:
-        # Send the samples to write
+        # Write the samples and start the task (autostart)
         CHK(nidaq.DAQmxWriteAnalogF64(taskHandleAO, samples, True, float64(timeout),
                 DAQmx_Val_GroupByChannel, vdata.ctypes.data,
                 ctypes.byref(nwritten), None))
-    except Exception, e:
-        logging.error('Failed in AO write phase: %s', str(e))
-    try:
-        # Execute the analog out write task
-        #print 'Executing analog out write task'
-        #CHK(nidaq.DAQmxStartTask(taskHandleAO))
-        # Wait for the approximate time necessary to iterate through each of the samples
-        #print 'Waiting...'
-        time.sleep(samples*1.0/freq)
-        #print 'Wait over.'
-        # Now read using the ReadCounterU32 function, which should return an
-        # array of uint32 values corresponding to the counts samples from the
-        # counter at each instant of the analog out voltage being written
-        #print 'Going to read samples.'
-
-
-
-    except Exception, e:
-        logging.error('NI DAQ new counter read call failed: %s', str(e))
-
+        CHK(nidaq.DAQmxWaitUntilTaskDone(taskHandleAO,
+            float64(samples / float(freq) + timeout)))
     finally:
         if taskHandleAO.value != 0:
             nidaq.DAQmxStopTask(taskHandleAO)
             nidaq.DAQmxClearTask(taskHandleAO)
 
-    return cdata
+    return nwritten.value
+
 def write_and_count(devchan, ctrchan, src, aochan, vdata, freq=10000.0, minv=-10.0, maxv=10.0,
                 timeout=10.0):
     '''
@@ -349,93 +566,98 @@ def write_and_count(devchan, ctrchan, src, aochan, vdata, freq=10000.0, minv=-10
         Number of values written
     '''
     # First we create a counter task and then set it to use the analog out
-    # sample clock to trigger when it actually takes samples.
-    taskHandleCtr = TaskHandle(0)
-    taskHandleAO = TaskHandle(0)
-    nwritten = int32()
-    nread = int32()
+    # sample clock to trigger when it actually takes samples. Both tasks are
+    # kept in the task cache, so consecutive lines of equal length only
+    # restart them.
     samples = len(vdata)
+    vdata = numpy.ascontiguousarray(vdata, dtype=numpy.float64)
     cdata = numpy.zeros(samples, dtype=numpy.uint32)
-    try:
-        # Create task
-        CHK(nidaq.DAQmxCreateTask("", ctypes.byref(taskHandleCtr)))
-        initial_count = int32(0)
-        # Create an edge counting channel on ctrchan
-        CHK(nidaq.DAQmxCreateCICountEdgesChan(taskHandleCtr, ctrchan, "",
-                DAQmx_Val_Rising, initial_count, DAQmx_Val_CountUp))
-        # Set the counting channel source terminal to src
-        if src is not None and src != "":
-            CHK(nidaq.DAQmxSetCICountEdgesTerm(taskHandleCtr, ctrchan, src))
-
 
-
-        # Set the sample clock timer to the analog output sample clock specified
-        # in the input argument aochan
-        CHK(nidaq.DAQmxCfgSampClkTiming(taskHandleCtr, aochan, float64(freq),
-                DAQmx_Val_Rising, DAQmx_Val_FiniteSamps,
-                uInt64(samples)));
-    except Exception, e:
-        logging.error('Failed in counter setup phase: %s', str(e))
-    try:
-        # Now start creating the analog out task to write the voltage array
-        CHK(nidaq.DAQmxCreateTask("", ctypes.byref(taskHandleAO)))
-        # Set up the task with an analog out channel on devchan
-        CHK(nidaq.DAQmxCreateAOVoltageChan(taskHandleAO, devchan, None,
-            float64(minv), float64(maxv), DAQmx_Val_Volts, None))
-        CHK(nidaq.DAQmxCfgSampClkTiming(taskHandleAO,"",float64(freq),DAQmx_Val_Rising,DAQmx_Val_FiniteSamps,uInt64(samples)))
-    except Exception, e:
-        logging.error('Failed in AO setup phase: %s', str(e))
+    def create():
+        taskHandleCtr = TaskHandle(0)
+        taskHandleAO = TaskHandle(0)
+        try:
+            # Create task
+            CHK(nidaq.DAQmxCreateTask("", ctypes.byref(taskHandleCtr)))
+            initial_count = int32(0)
+            # Create an edge counting channel on ctrchan
+            CHK(nidaq.DAQmxCreateCICountEdgesChan(taskHandleCtr, ctrchan, "",
+                    DAQmx_Val_Rising, initial_count, DAQmx_Val_CountUp))
+            # Set the counting channel source terminal to src
+            if src is not None and src != "":
+                CHK(nidaq.DAQmxSetCICountEdgesTerm(taskHandleCtr, ctrchan, src))
+
+            # Set the sample clock timer to the analog output sample clock
+            # specified in the input argument aochan
+            CHK(nidaq.DAQmxCfgSampClkTiming(taskHandleCtr, aochan, float64(freq),
+                    DAQmx_Val_Rising, DAQmx_Val_FiniteSamps,
+                    uInt64(samples)));
+        except Exception, e:
+            logging.error('Failed in counter setup phase: %s', str(e))
+            _clear_task(taskHandleCtr)
+            raise
+
+        try:
+            # Now start creating the analog out task to write the voltage array
+            CHK(nidaq.DAQmxCreateTask("", ctypes.byref(taskHandleAO)))
+            # Set up the task with an analog out channel on devchan
+            CHK(nidaq.DAQmxCreateAOVoltageChan(taskHandleAO, devchan, None,
+                float64(minv), float64(maxv), DAQmx_Val_Volts, None))
+            CHK(nidaq.DAQmxCfgSampClkTiming(taskHandleAO,"",float64(freq),DAQmx_Val_Rising,DAQmx_Val_FiniteSamps,uInt64(samples)))
+        except Exception, e:
+            logging.error('Failed in AO setup phase: %s', str(e))
+            _clear_task(taskHandleCtr)
+            _clear_task(taskHandleAO)
+            raise
+
+        return (taskHandleCtr, taskHandleAO)
+
+    key = ('ao_ci', devchan, ctrchan, src, aochan, samples, freq, minv, maxv)
+    handles = ()
+    cached = False
+    nwritten = int32()
+    nread = int32()
     try:
-        # Start the counter task - it will wait to count until receiving an edge
-        # from the AO sample clock
-        #print 'th ctr %s' % taskHandleCtr
+        handles, cached = _task_cache.get(key,
+            [_get_resource(devchan), _get_resource(ctrchan)], create)
+        taskHandleCtr, taskHandleAO = handles
+
+        # Start the counter task - it will wait to count until receiving an
+        # edge from the AO sample clock
         CHK(nidaq.DAQmxStartTask(taskHandleCtr))
-    except Exception, e:
-        logging.error('Failed in counter start phase: %s', str(e))
-        # Stop and clear both tasks
-        if taskHandleCtr.value != 0:
-            nidaq.DAQmxStopTask(taskHandleCtr)
-            nidaq.DAQmxClearTask(taskHandleCtr)
-        if taskHandleAO.value != 0:
-            nidaq.DAQmxStopTask(taskHandleAO)
-            nidaq.DAQmxClearTask(taskHandleAO)
-    try:
-        # Send the samples to write
+
+        # Send the samples to write, this starts the AO task
         CHK(nidaq.DAQmxWriteAnalogF64(taskHandleAO, samples, True, float64(timeout),
                 DAQmx_Val_GroupByChannel, vdata.ctypes.data,
                 ctypes.byref(nwritten), None))
-    except Exception, e:
-        logging.error('Failed in AO write phase: %s', str(e))
-    try:
-        # Execute the analog out write task
-        #print 'Executing analog out write task'
-        #CHK(nidaq.DAQmxStartTask(taskHandleAO))
-        # Wait for the approximate time necessary to iterate through each of the samples
-        #print 'Waiting...'
+
+        # Wait for the approximate time necessary to iterate through each of
+        # the samples
         time.sleep(samples*1.0/freq)
-        #print 'Wait over.'
+
         # Now read using the ReadCounterU32 function, which should return an
         # array of uint32 values corresponding to the counts samples from the
         # counter at each instant of the analog out voltage being written
-        #print 'Going to read samples.'
-
         CHK(nidaq.DAQmxReadCounterU32(taskHandleCtr, -1, float64(timeout),
             cdata.ctypes.data, uInt32(samples),
             ctypes.byref(nread), None))
 
-
     except Exception, e:
         logging.error('NI DAQ new counter read call failed: %s', str(e))
+        if cached:
+            _task_cache.discard(key)
+            cached = False
+            handles = ()
 
     finally:
-        #print 'samples read: %s' % nread.value
-        # Stop and clear both tasks
-        ##if taskHandleCtr.value != 0:
-        CHK(nidaq.DAQmxTaskControl(taskHandleCtr,int(5)))
-        nidaq.DAQmxClearTask(taskHandleCtr)
-        ##if taskHandleAO.value != 0:
-        CHK(nidaq.DAQmxTaskControl(taskHandleAO,int(5)))
-        nidaq.DAQmxClearTask(taskHandleAO)
+        if cached:
+            # Back to the committed state for the next line
+            for handle in handles:
+                nidaq.DAQmxStopTask(handle)
+        else:
+            # Stop, unreserve and clear both tasks
+            for handle in handles:
+                _clear_task(handle)
 
     return cdata
 
@@ -464,6 +686,7 @@ def write_exportclk(devchan, data, freq=10000.0, minv=-10.0, maxv=10.0,
         data = numpy.array(data, dtype=numpy.float64)
     samples = len(data)
 
+    release_channels([devchan])
     taskHandle = TaskHandle(0)
     written = int32()
     try:
@@ -499,25 +722,37 @@ def read_counter(devchan="/Dev1/ctr0", samples=1, freq=1.0, timeout=1.0, src="")
     Specify source pin with 'src'.
     '''
 
+    def create():
+        taskHandle = TaskHandle(0)
+        try:
+            CHK(nidaq.DAQmxCreateTask("", ctypes.byref(taskHandle)))
+            initial_count = int32(0)
+            CHK(nidaq.DAQmxCreateCICountEdgesChan(taskHandle, devchan, "",
+                    DAQmx_Val_Rising, initial_count, DAQmx_Val_CountUp))
+            if src is not None and src != "":
+                CHK(nidaq.DAQmxSetCICountEdgesTerm(taskHandle, devchan, src))
+            if samples > 1:
+                CHK(nidaq.DAQmxCfgSampClkTiming(taskHandle, "", float64(freq),
+                    DAQmx_Val_Rising, DAQmx_Val_FiniteSamps,
+                    uInt64(samples)));
+        except:
+            _clear_task(taskHandle)
+            raise
+        return (taskHandle,)
+
+    key = ('ci', devchan, src, samples, freq)
     taskHandle = TaskHandle(0)
+    cached = False
+    nread = int32()
+    data = numpy.zeros(samples, dtype=numpy.float64)
     try:
-        CHK(nidaq.DAQmxCreateTask("", ctypes.byref(taskHandle)))
-        initial_count = int32(0)
-        CHK(nidaq.DAQmxCreateCICountEdgesChan(taskHandle, devchan, "",
-                DAQmx_Val_Rising, initial_count, DAQmx_Val_CountUp))
-        if src is not None and src != "":
-            CHK(nidaq.DAQmxSetCICountEdgesTerm(taskHandle, devchan, src))
+        (taskHandle,), cached = _task_cache.get(key,
+            [_get_resource(devchan)], create)
 
-        nread = int32()
-        data = numpy.zeros(samples, dtype=numpy.float64)
         if samples > 1:
-            CHK(nidaq.DAQmxCfgSampClkTiming(taskHandle, "", float64(freq),
-                DAQmx_Val_Rising, DAQmx_Val_FiniteSamps,
-                uInt64(samples)));
             CHK(nidaq.DAQmxStartTask(taskHandle))
-            CHK(nidaq.DAQmxReadAnalogF64(taskHandle, int32(samples), float64(timeout),
-               DAQmx_Val_GroupByChannel, data.ctypes.data,
-               samples, ctypes.byref(read), None))
+            CHK(nidaq.DAQmxReadCounterF64(taskHandle, int32(samples), float64(timeout),
+               data.ctypes.data, int32(samples), ctypes.byref(nread), None))
         else:
             # For one sample, the strategy is to start the counter, which is
             # initialized to zero, wait in software a certain amount, and then
@@ -533,21 +768,24 @@ def read_counter(devchan="/Dev1/ctr0", samples=1, freq=1.0, timeout=1.0, src="")
 
     except Exception, e:
         logging.error('NI DAQ new counter read call failed: %s', str(e))
+        if cached:
+            _task_cache.discard(key)
+            cached = False
+            taskHandle = TaskHandle(0)
 
     finally:
-        if taskHandle.value != 0:
-            # Commented out both the stop task and clear task. The problem was
-            # that the DAQ was not releasing all of its resources properly, so
+        if cached:
+            # A committed task returns to the committed state when stopped,
+            # keeping its resources reserved for the next read.
+            nidaq.DAQmxStopTask(taskHandle)
+        elif taskHandle.value != 0:
+            # The DAQ was not releasing all of its resources properly, so
             # after attempting to count only once, the next attempt to count
-            # would fail because whatever the resource was, it was still reserved.
-            # This was even after stopping and clearing the task, or just clearing
-            # only. The below code works by explicitly unreserving the resources
-            # by passing the integer 5 to the function, which corresponds to the
-            # command to unreserve the resources associated with the task.
-
-            #print '%s' % CHK(nidaq.DAQmxStopTask(taskHandle))
-            CHK(nidaq.DAQmxTaskControl(taskHandle,int(5)))
-            CHK(nidaq.DAQmxClearTask(taskHandle)) # Re-added this line 2/28/14
+            # would fail because whatever the resource was, it was still
+            # reserved. This was even after stopping and clearing the task.
+            # _clear_task() explicitly unreserves the resources associated
+            # with the task before clearing it.
+            _clear_task(taskHandle)
 
     if nread.value == 1:
         return int(data[0])
@@ -582,6 +820,7 @@ def read_counters(devchans=["/Dev1/ctr0","/Dev1/ctr1"], samples=1, freq=1.0, tim
     tasks = []
     devsrc = None
     ret = []
+    release_channels(devchans)
     for i, dev in enumerate(devchans):
         if src is not None:
             devsrc = src[i]
@@ -626,6 +865,7 @@ def write_dig_port8(channel, val, timeout=1.0):
     The value is sent to the specified channels, LSB to MSB.
     '''
 
+    release_channels([channel])
     taskHandle = TaskHandle(0)
     try:
         CHK(nidaq.DAQmxCreateTask("", ctypes.byref(taskHandle)))
@@ -674,6 +914,7 @@ def readarray(devchan, trigchan, samples, freq=10000.0, minv=-10.0, maxv=10.0,
     # First we create a counter task and then set it to use the analog out
     # sample clock to trigger when it actually takes samples.
 
+    release_channels([devchan])
     taskHandleAI = TaskHandle(0)
     nwritten = int32()
     nread = int32()
@@ -733,6 +974,7 @@ def read_array_analog_window(devchan, analogtrigchan, samples, freq=10000.0, win
     # First we create a counter task and then set it to use the analog out
     # sample clock to trigger when it actually takes samples.
 
+    release_channels([devchan])
     taskHandleAI = TaskHandle(0)
     nwritten = int32()
     nread = int32()
@@ -793,6 +1035,7 @@ def read_array_analog(devchan, trigchan, samples, freq=10000.0, trigger_level =
     # First we create a counter task and then set it to use the analog out
     # sample clock to trigger when it actually takes samples.
 
+    release_channels([devchan])
     taskHandleAI = TaskHandle(0)
     nwritten = int32()
     nread = int32()
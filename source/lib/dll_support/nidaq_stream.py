@@ -0,0 +1,602 @@
+# nidaq_stream.py, continuous buffered acquisition with NI-DAQmx
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Continuous (DAQmx_Val_ContSamps) acquisition of analog inputs and edge
+counters. A source reads fixed-size chunks into a preallocated buffer and
+a ContinuousReader reduces them; its read() method is meant to be called
+in a loop from a lib.streaming.StreamThread:
+
+    source = nidaq_stream.AISource('Dev1/ai0:1', 10000.0, 1000)
+    reader = nidaq_stream.ContinuousReader(source, reduce='average', factor=10)
+    thread = streaming.StreamThread(reader.read, queue=queue)
+    reader.start()
+    thread.start()
+
+Sources implement:
+    nchannels           number of channels
+    freq                sample rate
+    start()
+    read(out, timeout)  fill out[nchannels, chunk], return number of samples
+                        per channel read, 0 on timeout
+    check_overrun()     return whether samples were lost since last call
+    stop()
+
+SimulatedSource replaces the hardware sources, so that the acquisition
+path can be run without the DAQmx library.
+
+AOCounterSource (and SimulatedAOCounterSource) in addition stream an
+analog output trajectory, with a counter latched on the AO sample clock,
+for hardware-timed scans. Its extra methods are:
+    start(prefill)      write the first float64[naxes, n] samples, start
+    write(vdata, timeout)   append float64[naxes, n] samples to the output
+'''
+
+import ctypes
+import logging
+import time
+import numpy
+
+DAQmx_Val_ContSamps                 = 10123
+DAQmxErrorSamplesNoLongerAvailable  = -200279
+DAQmxErrorSamplesNotYetAvailable    = -200284
+DAQmxErrorTimeout                   = -200474
+DAQmxErrorGenStoppedToPreventRegen  = -200290
+DAQmx_Val_DoNotAllowRegen           = 10158
+
+class _DAQmxSource():
+    '''Common part of the hardware sources.'''
+
+    def __init__(self, devchan, freq, chunk, bufsize):
+        from lib.dll_support import nidaq
+        self._nidaq = nidaq
+        self._dll = nidaq.nidaq
+        self.devchan = devchan
+        self.freq = float(freq)
+        self.chunk = int(chunk)
+        if bufsize is None:
+            bufsize = max(10 * self.chunk, int(self.freq))
+        self._bufsize = bufsize
+        self._task = nidaq.TaskHandle(0)
+        self._overrun = False
+        self.nchannels = 1
+
+    def _create(self):
+        raise NotImplementedError()
+
+    def start(self):
+        nidaq = self._nidaq
+        nidaq.release_channels([self.devchan])
+        self._task = nidaq.TaskHandle(0)
+        try:
+            nidaq.CHK(self._dll.DAQmxCreateTask("", ctypes.byref(self._task)))
+            self._create()
+            nchans = nidaq.uInt32(0)
+            nidaq.CHK(self._dll.DAQmxGetTaskNumChans(self._task,
+                ctypes.byref(nchans)))
+            self.nchannels = nchans.value
+            nidaq.CHK(self._dll.DAQmxStartTask(self._task))
+        except:
+            nidaq._clear_task(self._task)
+            self._task = nidaq.TaskHandle(0)
+            raise
+
+    def _restart(self):
+        '''Restart the task after the buffer overflowed.'''
+        self._dll.DAQmxStopTask(self._task)
+        self._nidaq.CHK(self._dll.DAQmxStartTask(self._task))
+
+    def _check_read(self, err, nread):
+        '''Handle read errors, returns the number of samples read.'''
+        if err == DAQmxErrorSamplesNoLongerAvailable:
+            self._overrun = True
+            self._restart()
+            return 0
+        # On a timeout the samples that did arrive are still in the buffer
+        if err in (DAQmxErrorTimeout, DAQmxErrorSamplesNotYetAvailable):
+            return nread.value
+        self._nidaq.CHK(err)
+        return nread.value
+
+    def check_overrun(self):
+        ret = self._overrun
+        self._overrun = False
+        return ret
+
+    def stop(self):
+        self._nidaq._clear_task(self._task)
+        self._task = self._nidaq.TaskHandle(0)
+
+class AISource(_DAQmxSource):
+    '''
+    Continuous analog input on one or more channels, e.g. 'Dev1/ai0:3'.
+    '''
+
+    def __init__(self, devchan, freq, chunk, minv=-10.0, maxv=10.0,
+            config=None, bufsize=None):
+        _DAQmxSource.__init__(self, devchan, freq, chunk, bufsize)
+        if config is None:
+            config = self._nidaq.DAQmx_Val_Cfg_Default
+        elif type(config) is str:
+            config = self._nidaq._config_map[config.upper()]
+        self._config = config
+        self._minv = minv
+        self._maxv = maxv
+
+    def _create(self):
+        nidaq = self._nidaq
+        nidaq.CHK(self._dll.DAQmxCreateAIVoltageChan(self._task, self.devchan,
+            "", self._config, nidaq.float64(self._minv),
+            nidaq.float64(self._maxv), nidaq.DAQmx_Val_Volts, None))
+        nidaq.CHK(self._dll.DAQmxCfgSampClkTiming(self._task, "",
+            nidaq.float64(self.freq), nidaq.DAQmx_Val_Rising,
+            DAQmx_Val_ContSamps, nidaq.uInt64(self._bufsize)))
+
+    def get_dtype(self):
+        return numpy.float64
+
+    def read(self, out, timeout):
+        nidaq = self._nidaq
+        nread = nidaq.int32(0)
+        err = self._dll.DAQmxReadAnalogF64(self._task, self.chunk,
+            nidaq.float64(timeout), nidaq.DAQmx_Val_GroupByChannel,
+            out.ctypes.data, out.size, ctypes.byref(nread), None)
+        return self._check_read(err, nread)
+
+class CounterSource(_DAQmxSource):
+    '''
+    Continuous edge counting. The counter is latched on every edge of the
+    sample clock 'clock', which has to be a running clock terminal such as
+    '/Dev1/ai/SampleClock' or a PFI line. Samples are cumulative counts,
+    ContinuousReader converts them to counts per sample.
+    '''
+
+    def __init__(self, devchan, freq, chunk, clock, src=None, bufsize=None):
+        _DAQmxSource.__init__(self, devchan, freq, chunk, bufsize)
+        self._clock = clock
+        self._src = src
+
+    def _create(self):
+        nidaq = self._nidaq
+        nidaq.CHK(self._dll.DAQmxCreateCICountEdgesChan(self._task,
+            self.devchan, "", nidaq.DAQmx_Val_Rising, nidaq.int32(0),
+            nidaq.DAQmx_Val_CountUp))
+        if self._src is not None and self._src != "":
+            nidaq.CHK(self._dll.DAQmxSetCICountEdgesTerm(self._task,
+                self.devchan, self._src))
+        nidaq.CHK(self._dll.DAQmxCfgSampClkTiming(self._task, self._clock,
+            nidaq.float64(self.freq), nidaq.DAQmx_Val_Rising,
+            DAQmx_Val_ContSamps, nidaq.uInt64(self._bufsize)))
+
+    def get_dtype(self):
+        return numpy.uint32
+
+    def read(self, out, timeout):
+        nidaq = self._nidaq
+        nread = nidaq.int32(0)
+        err = self._dll.DAQmxReadCounterU32(self._task, self.chunk,
+            nidaq.float64(timeout), out.ctypes.data, nidaq.uInt32(out.size),
+            ctypes.byref(nread), None)
+        return self._check_read(err, nread)
+
+class SimulatedSource():
+    '''
+    Software replacement for the DAQmx sources. Samples are produced in
+    real time at 'freq'; if they are not read within 'bufsize' samples
+    they are lost and an overrun is flagged, as with the hardware buffer.
+
+    kind 'ai' produces a sine of 'amplitude' V plus noise on each channel,
+    kind 'counter' produces cumulative Poisson counts at 'rate' per second.
+    '''
+
+    def __init__(self, freq, chunk, nchannels=1, kind='ai', bufsize=None,
+            amplitude=1.0, signal_freq=1.0, noise=0.01, rate=1e4, seed=None):
+        if kind not in ('ai', 'counter'):
+            raise ValueError('Unknown source kind %r' % kind)
+
+        self.freq = float(freq)
+        self.chunk = int(chunk)
+        self.nchannels = nchannels
+        self._kind = kind
+        if bufsize is None:
+            bufsize = max(10 * self.chunk, int(self.freq))
+        self._bufsize = bufsize
+        self._amplitude = amplitude
+        self._signal_freq = signal_freq
+        self._noise = noise
+        self._rate = rate
+        self._random = numpy.random.RandomState(seed)
+
+        self._tstart = None
+        self._nread = 0
+        self._counts = numpy.zeros(nchannels, dtype=numpy.uint32)
+        self._overrun = False
+
+    def get_dtype(self):
+        if self._kind == 'counter':
+            return numpy.uint32
+        return numpy.float64
+
+    def start(self):
+        self._tstart = time.time()
+        self._nread = 0
+        self._counts[:] = 0
+        self._overrun = False
+
+    def _available(self):
+        return int((time.time() - self._tstart) * self.freq) - self._nread
+
+    def read(self, out, timeout):
+        tend = time.time() + timeout
+        while self._available() < self.chunk:
+            if time.time() >= tend:
+                return 0
+            time.sleep(min((self.chunk - self._available()) / self.freq,
+                max(tend - time.time(), 0)))
+
+        avail = self._available()
+        if avail > self._bufsize:
+            # Samples older than the buffer were overwritten
+            self._overrun = True
+            self._nread += avail - self._bufsize
+
+        n = self.chunk
+        idx = numpy.arange(self._nread, self._nread + n)
+        if self._kind == 'ai':
+            t = idx / self.freq
+            sig = self._amplitude * numpy.sin(2 * numpy.pi * self._signal_freq * t)
+            out[:,:n] = sig + self._random.normal(0, self._noise,
+                (self.nchannels, n))
+        else:
+            counts = self._random.poisson(self._rate / self.freq,
+                (self.nchannels, n))
+            cum = numpy.cumsum(counts, axis=1) + self._counts[:,numpy.newaxis]
+            out[:,:n] = cum
+            self._counts = out[:,n-1].astype(numpy.uint32)
+        self._nread += n
+        return n
+
+    def check_overrun(self):
+        ret = self._overrun
+        self._overrun = False
+        return ret
+
+    def stop(self):
+        pass
+
+class AOCounterSource():
+    '''
+    Continuous analog output without regeneration on one or more channels,
+    with an edge counter sampled on every AO sample clock tick. The output
+    has to be kept fed with write(); the counter samples are read with
+    read() and are cumulative counts, as for CounterSource.
+    '''
+
+    def __init__(self, aochans, ctrchan, clock, freq, chunk, src=None,
+            minv=-10.0, maxv=10.0, bufsize=None):
+        '''
+        Input:
+            aochans (list): output channels, e.g. ['Dev1/ao0', 'Dev1/ao1']
+            ctrchan (string): counter, e.g. '/Dev1/ctr0'
+            clock (string): AO sample clock terminal, '/Dev1/ao/SampleClock'
+            freq (float): sample rate
+            chunk (int): samples per read() / write()
+            src (string): counter source terminal
+            bufsize (int): output and counter buffer size in samples
+        '''
+
+        from lib.dll_support import nidaq
+        self._nidaq = nidaq
+        self._dll = nidaq.nidaq
+        self._aochans = list(aochans)
+        self._ctrchan = ctrchan
+        self._clock = clock
+        self._src = src
+        self._minv = minv
+        self._maxv = maxv
+        self.freq = float(freq)
+        self.chunk = int(chunk)
+        if bufsize is None:
+            bufsize = 4 * self.chunk
+        self.bufsize = int(bufsize)
+        self.nchannels = 1
+        self.naxes = len(self._aochans)
+        self._ao_task = nidaq.TaskHandle(0)
+        self._ctr_task = nidaq.TaskHandle(0)
+        self._overrun = False
+
+    def get_dtype(self):
+        return numpy.uint32
+
+    def start(self, prefill):
+        nidaq = self._nidaq
+        dll = self._dll
+        nidaq.release_channels(self._aochans + [self._ctrchan])
+        self._ao_task = nidaq.TaskHandle(0)
+        self._ctr_task = nidaq.TaskHandle(0)
+        try:
+            nidaq.CHK(dll.DAQmxCreateTask("", ctypes.byref(self._ao_task)))
+            nidaq.CHK(dll.DAQmxCreateAOVoltageChan(self._ao_task,
+                ','.join(self._aochans), "", nidaq.float64(self._minv),
+                nidaq.float64(self._maxv), nidaq.DAQmx_Val_Volts, None))
+            nidaq.CHK(dll.DAQmxCfgSampClkTiming(self._ao_task, "",
+                nidaq.float64(self.freq), nidaq.DAQmx_Val_Rising,
+                DAQmx_Val_ContSamps, nidaq.uInt64(self.bufsize)))
+            nidaq.CHK(dll.DAQmxSetWriteRegenMode(self._ao_task,
+                DAQmx_Val_DoNotAllowRegen))
+            nidaq.CHK(dll.DAQmxCfgOutputBuffer(self._ao_task,
+                nidaq.uInt32(self.bufsize)))
+
+            nidaq.CHK(dll.DAQmxCreateTask("", ctypes.byref(self._ctr_task)))
+            nidaq.CHK(dll.DAQmxCreateCICountEdgesChan(self._ctr_task,
+                self._ctrchan, "", nidaq.DAQmx_Val_Rising, nidaq.int32(0),
+                nidaq.DAQmx_Val_CountUp))
+            if self._src is not None and self._src != "":
+                nidaq.CHK(dll.DAQmxSetCICountEdgesTerm(self._ctr_task,
+                    self._ctrchan, self._src))
+            nidaq.CHK(dll.DAQmxCfgSampClkTiming(self._ctr_task, self._clock,
+                nidaq.float64(self.freq), nidaq.DAQmx_Val_Rising,
+                DAQmx_Val_ContSamps, nidaq.uInt64(self.bufsize)))
+
+            self.write(prefill, 10.0)
+            # The counter waits for the first AO clock edge
+            nidaq.CHK(dll.DAQmxStartTask(self._ctr_task))
+            nidaq.CHK(dll.DAQmxStartTask(self._ao_task))
+        except:
+            self.stop()
+            raise
+
+    def write(self, vdata, timeout):
+        '''Append samples to the output, blocks while the buffer is full.'''
+        nidaq = self._nidaq
+        vdata = numpy.ascontiguousarray(vdata, dtype=numpy.float64)
+        written = nidaq.int32(0)
+        err = self._dll.DAQmxWriteAnalogF64(self._ao_task, vdata.shape[1], 0,
+            nidaq.float64(timeout), nidaq.DAQmx_Val_GroupByChannel,
+            vdata.ctypes.data, ctypes.byref(written), None)
+        if err == DAQmxErrorGenStoppedToPreventRegen:
+            self._overrun = True
+        nidaq.CHK(err)
+        return written.value
+
+    def read(self, out, timeout):
+        nidaq = self._nidaq
+        nread = nidaq.int32(0)
+        err = self._dll.DAQmxReadCounterU32(self._ctr_task, self.chunk,
+            nidaq.float64(timeout), out.ctypes.data, nidaq.uInt32(out.size),
+            ctypes.byref(nread), None)
+        if err == DAQmxErrorSamplesNoLongerAvailable:
+            self._overrun = True
+        if err in (DAQmxErrorTimeout, DAQmxErrorSamplesNotYetAvailable):
+            return nread.value
+        nidaq.CHK(err)
+        return nread.value
+
+    def check_overrun(self):
+        ret = self._overrun
+        self._overrun = False
+        return ret
+
+    def stop(self):
+        self._nidaq._clear_task(self._ao_task)
+        self._nidaq._clear_task(self._ctr_task)
+        self._ao_task = self._nidaq.TaskHandle(0)
+        self._ctr_task = self._nidaq.TaskHandle(0)
+
+class SimulatedAOCounterSource():
+    '''
+    Software replacement for AOCounterSource. Output samples are consumed
+    in real time at 'freq' as long as they have been written; if the
+    output runs empty an overrun is flagged. Counts for each output
+    sample are Poisson distributed with rate_func(vdata) per second, where
+    vdata is float64[naxes, n]; the default is a constant 'rate'.
+    '''
+
+    def __init__(self, naxes, freq, chunk, bufsize=None, rate_func=None,
+            rate=1e4, seed=None):
+        self.naxes = naxes
+        self.nchannels = 1
+        self.freq = float(freq)
+        self.chunk = int(chunk)
+        if bufsize is None:
+            bufsize = 4 * self.chunk
+        self.bufsize = int(bufsize)
+        self._rate_func = rate_func
+        self._rate = rate
+        self._random = numpy.random.RandomState(seed)
+        self._pending = numpy.zeros((naxes, 0))
+        self._tstart = None
+        self._produced = 0
+        self._count = 0
+        self._overrun = False
+
+    def get_dtype(self):
+        return numpy.uint32
+
+    def start(self, prefill):
+        self._pending = numpy.zeros((self.naxes, 0))
+        self._produced = 0
+        self._count = 0
+        self._overrun = False
+        self.write(prefill, 0)
+        self._tstart = time.time()
+
+    def write(self, vdata, timeout):
+        vdata = numpy.asarray(vdata, dtype=numpy.float64)
+        self._pending = numpy.concatenate((self._pending, vdata), axis=1)
+        return vdata.shape[1]
+
+    def read(self, out, timeout):
+        tend = time.time() + timeout
+        while True:
+            due = int((time.time() - self._tstart) * self.freq) - self._produced
+            if due >= self.chunk:
+                break
+            if time.time() >= tend:
+                return 0
+            time.sleep(min((self.chunk - due) / self.freq,
+                max(tend - time.time(), 0)))
+
+        n = min(self.chunk, self._pending.shape[1])
+        if n < self.chunk:
+            self._overrun = True
+        vdata = self._pending[:,:n]
+        self._pending = self._pending[:,n:]
+        self._produced += self.chunk
+        if n == 0:
+            return 0
+
+        if self._rate_func is not None:
+            rate = self._rate_func(vdata)
+        else:
+            rate = numpy.repeat(self._rate, n)
+        counts = self._random.poisson(numpy.asarray(rate) / self.freq)
+        # Like the hardware, counter sample s is latched at the start of
+        # output sample s and holds the counts up to output sample s - 1.
+        cum = numpy.cumsum(counts) + self._count
+        out[0,0] = self._count
+        out[0,1:n] = cum[:-1]
+        self._count = int(cum[-1])
+        return n
+
+    def check_overrun(self):
+        ret = self._overrun
+        self._overrun = False
+        return ret
+
+    def stop(self):
+        pass
+
+class ContinuousReader():
+    '''
+    Reads chunks from a source into a preallocated buffer and reduces them.
+    Returned items are dictionaries with:
+        'data': float64[nchannels, n] (counts per sample for counters)
+        'start': index of the first (reduced) sample
+        'dt': time between (reduced) samples in seconds
+
+    Reduction modes:
+        None: all samples
+        'decimate': every factor-th sample
+        'average': mean of blocks of factor samples
+    '''
+
+    def __init__(self, source, reduce=None, factor=1, timeout=1.0):
+        if reduce not in (None, 'decimate', 'average'):
+            raise ValueError('Unknown reduction mode %r' % reduce)
+
+        self._source = source
+        self._reduce = reduce
+        self._factor = max(int(factor), 1)
+        if reduce is None:
+            self._factor = 1
+        self._timeout = timeout
+        self._counter = (source.get_dtype() == numpy.uint32)
+        self._buffer = None
+        self.reset_counters()
+
+    def reset_counters(self):
+        self._samples = 0
+        self._outsamples = 0
+        self._overruns = 0
+        self._last_count = None
+        self._rest = None
+
+    def start(self):
+        self.reset_counters()
+        self._source.start()
+        # Counters start at zero
+        self._last_count = numpy.zeros(self._source.nchannels, dtype=numpy.int64)
+        self._buffer = numpy.zeros((self._source.nchannels,
+            self._source.chunk), dtype=self._source.get_dtype())
+
+    def stop(self):
+        self._source.stop()
+
+    def get_sample_count(self):
+        '''Number of raw samples per channel read.'''
+        return self._samples
+
+    def get_overruns(self):
+        '''Number of times the acquisition buffer overflowed.'''
+        return self._overruns
+
+    def get_dt(self):
+        return self._factor / self._source.freq
+
+    def read(self):
+        '''
+        Read one chunk. Returns a reduced item, or None if no complete
+        item is available yet.
+        '''
+
+        n = self._source.read(self._buffer, self._timeout)
+        if self._source.check_overrun():
+            self._overruns += 1
+            self._last_count = None
+            logging.warning(__name__ + ' : acquisition buffer overrun, data lost')
+        if n == 0:
+            return None
+        self._samples += n
+
+        raw = self._buffer[:,:n]
+        if self._counter:
+            data = self._differentiate(raw)
+        else:
+            data = raw
+
+        data = self._reduce_data(data)
+        if data is None or data.shape[1] == 0:
+            return None
+
+        item = {
+            'data': data,
+            'start': self._outsamples,
+            'dt': self.get_dt(),
+        }
+        self._outsamples += data.shape[1]
+        return item
+
+    def _differentiate(self, raw):
+        '''Convert cumulative uint32 counts to counts per sample.'''
+        raw = raw.astype(numpy.int64)
+        if self._last_count is None:
+            prev = raw[:,:1]
+        else:
+            prev = self._last_count[:,numpy.newaxis]
+        self._last_count = raw[:,-1].copy()
+        diff = numpy.diff(numpy.concatenate((prev, raw), axis=1), axis=1)
+        # 32 bit counter wrap-around
+        diff[diff < 0] += 2**32
+        return diff.astype(numpy.float64)
+
+    def _reduce_data(self, data):
+        if self._reduce is None:
+            return data.astype(numpy.float64)
+
+        # Keep the samples that do not fill a block for the next chunk
+        if self._rest is not None:
+            data = numpy.concatenate((self._rest, data), axis=1)
+        nblocks = data.shape[1] / self._factor
+        used = nblocks * self._factor
+        self._rest = data[:,used:].copy()
+        if nblocks == 0:
+            return None
+
+        blocks = data[:,:used].reshape(data.shape[0], nblocks, self._factor)
+        if self._reduce == 'decimate':
+            return blocks[:,:,0].astype(numpy.float64)
+        return blocks.mean(axis=2)
@@ -85,7 +85,10 @@ pv_type_to_ctype = {
 TIMED_MODE = 0
 PARAM_READOUT_TIME = 67240115
 
+READOUT_NOT_ACTIVE = 0
 READOUT_COMPLETE = 3
+FRAME_AVAILABLE = READOUT_COMPLETE
+READOUT_FAILED = 4
 ACQUISITION_IN_PROGRESS = 5
 READOUT_IN_PROGRESS = 2
 EXPOSURE_IN_PROGRESS = 1
@@ -93,6 +96,17 @@ EXPOSURE_IN_PROGRESS = 1
 STATUS_IN_PROGRESS = (ACQUISITION_IN_PROGRESS, EXPOSURE_IN_PROGRESS,
                       READOUT_IN_PROGRESS)
 
+# circular buffer modes for continuous acquisition
+CIRC_NONE = 0
+CIRC_OVERWRITE = 1
+CIRC_NO_OVERWRITE = 2
+
+# what to do with the CCD when stopping continuous acquisition
+CCS_HALT = 1
+
+# shortest status poll interval while waiting for a frame
+POLL_MIN_INTERVAL = 0.001
+
 
 
 uns16 = ctypes.c_ushort
@@ -294,7 +308,6 @@ class PVCAMDevice():
         expected_end = start + self._exp_time + self._readout
         timeout = expected_end + 2.0 # add a 2.0 second timeout
         pvlib.pl_exp_start_seq(self._handle, self._cbuffer)
-        time.sleep(0.5)
         # now check status
         status = self.exp_check_status()
 
@@ -304,11 +317,10 @@ class PVCAMDevice():
             if now > timeout:
                 raise IOError("Timeout after %g s" % (now - start))
             # check if we should stop (sleeping less and less)
-            left = expected_end - now
+            _poll_sleep(expected_end - now)
             ##print 'status is %s' % status
             status = self.exp_check_status()
             ##print 'status is %s' % status
-            time.sleep(0.1)
 
 
         if status != READOUT_COMPLETE:
@@ -328,6 +340,71 @@ class PVCAMDevice():
         pvlib.pl_exp_finish_seq(self._handle, self._cbuffer, None)
         pvlib.pl_exp_uninit_seq()
 
+    def exp_setup_cont(self, buf):
+        '''
+        Set up continuous acquisition of the image rectangle into the
+        circular buffer buf, a contiguous uint16 numpy array of shape
+        [nframes, height, width].
+        '''
+        region = rgn_type()
+        region.s1, region.s2, region.p1, region.p2 = self._image_rect
+        region.sbin, region.pbin = self._binning
+        self._size = ((self._image_rect[1] - self._image_rect[0] + 1) // self._binning[0],
+                (self._image_rect[3] - self._image_rect[2] + 1) // self._binning[1])
+
+        frame_bytes = ctypes.c_uint32()
+        exp_ms = int(math.ceil(self._exp_time * 1e3))
+        pvlib.pl_exp_init_seq()
+        pvlib.pl_exp_setup_cont(self._handle, 1, ctypes.byref(region),
+            TIMED_MODE, exp_ms, ctypes.byref(frame_bytes), CIRC_OVERWRITE)
+        self.pv_check()
+
+        if buf.dtype != np.uint16 or not buf.flags['C_CONTIGUOUS'] or \
+                buf.shape[1:] != (self._size[1], self._size[0]):
+            raise ValueError('Buffer does not match the image size %s' % \
+                (self._size, ))
+        if frame_bytes.value != buf[0].nbytes:
+            raise ValueError('Unexpected frame size of %d bytes' % \
+                frame_bytes.value)
+        self._readout = self.get_param(PARAM_READOUT_TIME) * 1e-3
+        self._cont_buffer = buf
+
+    def exp_start_cont(self):
+        buf = self._cont_buffer
+        pvlib.pl_exp_start_cont(self._handle, buf.ctypes.data,
+            ctypes.c_uint32(buf.nbytes))
+        return self.pv_check()
+
+    def exp_check_cont_status(self):
+        '''Return (status, bytes, buffer count) of the continuous acquisition.'''
+        status = ctypes.c_int16()
+        byte_cnt = ctypes.c_uint32()
+        buffer_cnt = ctypes.c_uint32()
+        pvlib.pl_exp_check_cont_status(self._handle, ctypes.byref(status),
+            ctypes.byref(byte_cnt), ctypes.byref(buffer_cnt))
+        return status.value, byte_cnt.value, buffer_cnt.value
+
+    def exp_get_latest_slot(self):
+        '''Return the buffer slot of the latest frame, or None.'''
+        frame = ctypes.c_void_p()
+        if not pvlib.pl_exp_get_latest_frame(self._handle, ctypes.byref(frame)):
+            return None
+        if frame.value is None:
+            return None
+        offset = frame.value - self._cont_buffer.ctypes.data
+        return offset // self._cont_buffer[0].nbytes
+
+    def exp_stop_cont(self):
+        pvlib.pl_exp_stop_cont(self._handle, CCS_HALT)
+        pvlib.pl_exp_finish_seq(self._handle, self._cont_buffer.ctypes.data,
+            None)
+        pvlib.pl_exp_uninit_seq()
+        return self.pv_check()
+
+    def get_frame_time(self):
+        '''Return the expected time per frame (exposure and readout).'''
+        return self._exp_time + self._readout
+
     def buffer_as_array(self):
         """
         Converts the buffer allocated for the image as an ndarray. zero-copy
@@ -482,3 +559,70 @@ class PVCAMDevice():
                                          desc, length)
             ret[content.value] = desc.value
         return ret
+
+def _poll_sleep(left):
+    '''
+    Sleep while waiting for the camera: until shortly before the expected
+    end, then in short steps (sleeping less and less).
+    '''
+    time.sleep(max(left / 2.0, POLL_MIN_INTERVAL))
+
+class ContinuousSource():
+    '''
+    Continuous acquisition source for lib.framering. The camera writes
+    directly into the buffer of the FrameRing (with circular overwrite),
+    so frames are available as numpy views without copying. The ring
+    has to be created with ring_shape() and numpy.uint16.
+    '''
+
+    def __init__(self, dev):
+        self._dev = dev
+        self._tlast = None
+
+    def ring_shape(self):
+        '''Return the shape of one frame, (height, width).'''
+        x1, x2, y1, y2 = self._dev._image_rect
+        sbin, pbin = self._dev._binning
+        return ((y2 - y1 + 1) // pbin, (x2 - x1 + 1) // sbin)
+
+    def start(self, ring):
+        # The driver writes into the ring memory
+        self._dev.exp_setup_cont(ring.buffer)
+        self._tlast = time.time()
+        self._dev.exp_start_cont()
+
+    def stop(self):
+        self._dev.exp_stop_cont()
+
+    def poll(self, ring, timeout):
+        '''
+        Wait for new frames until the next frame is due, then poll the
+        status in short intervals, up to timeout seconds.
+        '''
+        tend = time.time() + timeout
+        frame_bytes = ring.get_frame_bytes()
+        while True:
+            status, byte_cnt, buffer_cnt = self._dev.exp_check_cont_status()
+            if status == READOUT_FAILED:
+                raise IOError('PVCAM readout failed')
+            # Frames written since the start: full passes through the
+            # buffer plus the frames in the current pass
+            total = buffer_cnt * ring.nframes + byte_cnt // frame_bytes
+            n = total - ring.get_frame_count()
+            if n > 0:
+                break
+            now = time.time()
+            if now >= tend:
+                return 0
+            due = self._tlast + self._dev.get_frame_time()
+            _poll_sleep(min(due - now, tend - now))
+
+        # If the driver wrapped around since the last poll only the newest
+        # nframes - 1 frames are intact (the next slot may be changing)
+        lost = n - (ring.nframes - 1)
+        if lost > 0:
+            ring.skip(lost)
+            n -= lost
+        self._tlast = time.time()
+        ring.commit(n)
+        return n
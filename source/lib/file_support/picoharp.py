@@ -22,6 +22,7 @@ import sys
 from lib.namedstruct import *
 
 _T2WRAPAROUND = 210698240
+_T3WRAPAROUND = 65536
 _RESOLUTION = 4e-12
 
 GENERAL_HEADER_INFO = (
@@ -117,6 +118,114 @@ GENERAL_HEADER_INFO = (
 		('RtChan4_CFDZeroCross', U32, 1),
     )
 
+def _pack_fields(fields, values):
+    '''
+    Pack little-endian header fields from a dictionary, missing values
+    are zero / empty.
+    '''
+
+    args = []
+    for name, dtype, dlen in fields:
+        val = values.get(name, None)
+        if dtype in (S, STRING):
+            args.append(val or '')
+        elif dtype == C:
+            if val is None:
+                val = '\x00' * dlen
+            args.extend(list(val))
+        elif dlen == 1:
+            args.append(val or 0)
+        else:
+            if val is None:
+                val = [0] * dlen
+            args.extend(val)
+
+    return struct.pack(format_to_structstr(fields, alignment='<'), *args)
+
+class T2Decoder:
+    '''
+    Incremental decoder of PicoHarp T2 records. The overflow correction is
+    kept between calls, so a stream can be decoded block by block.
+    '''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._offset = 0
+
+    def decode(self, records):
+        '''
+        Decode array of T2 records.
+
+        Output:
+            (channels, times, markers, marker_times): channels (uint8) and
+            times (int64, in units of 4 ps) of the photon records, marker
+            bits (uint8) and times of the marker records.
+        '''
+
+        records = np.asarray(records, dtype=np.uint32)
+        chan = (records >> 28).astype(np.uint8)
+        times = (records & 0x0FFFFFFF).astype(np.int64)
+
+        special = (chan == 15)
+        bits = (records & 0xF).astype(np.uint8)
+        ovf = special & (bits == 0)
+
+        ofs = np.cumsum(ovf, dtype=np.int64)
+        ofs *= _T2WRAPAROUND
+        ofs += self._offset
+        if len(ofs) > 0:
+            self._offset = ofs[-1]
+        times += ofs
+
+        photon = ~special
+        marker = special & ~ovf
+        return chan[photon], times[photon], bits[marker], times[marker]
+
+class T3Decoder:
+    '''
+    Incremental decoder of PicoHarp T3 records, see T2Decoder.
+    '''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._offset = 0
+
+    def decode(self, records):
+        '''
+        Decode array of T3 records.
+
+        Output:
+            (channels, nsync, dtime, markers, marker_nsync): channels
+            (uint8), sync counts (int64) and delay times (uint16, in units
+            of the resolution) of the photon records, marker bits (uint8)
+            and sync counts of the marker records.
+        '''
+
+        records = np.asarray(records, dtype=np.uint32)
+        chan = (records >> 28).astype(np.uint8)
+        nsync = (records & 0xFFFF).astype(np.int64)
+        dtime = ((records >> 16) & 0x0FFF).astype(np.uint16)
+
+        special = (chan == 15)
+        bits = (dtime & 0xF).astype(np.uint8)
+        ovf = special & (bits == 0)
+
+        ofs = np.cumsum(ovf, dtype=np.int64)
+        ofs *= _T3WRAPAROUND
+        ofs += self._offset
+        if len(ofs) > 0:
+            self._offset = ofs[-1]
+        nsync += ofs
+
+        photon = ~special
+        marker = special & ~ovf
+        return chan[photon], nsync[photon], dtime[photon], \
+            bits[marker], nsync[marker]
+
 class PHDFile:
 
     _HEADERINFO = GENERAL_HEADER_INFO
@@ -228,7 +337,7 @@ class PT2File:
 		('ImgHdrSize', U32, 1),
     )
 
-    def __init__(self, filename=None):
+    def __init__(self, filename=None, mmap=False):
         self._info = {}
         self._filename = ''
         self._data = None
@@ -238,9 +347,15 @@ class PT2File:
         self._t2t3_struct = NamedStruct(self._T2T3INFO, alignment='<')
 
         if filename:
-            self.load(filename)
+            self.load(filename, mmap=mmap)
+
+    def load(self, filename, progress=0, mmap=False):
+        '''
+        Load file. With mmap=True the records are memory-mapped instead of
+        read, so files larger than memory can be processed in chunks with
+        iter_records().
+        '''
 
-    def load(self, filename, progress=0):
         f = open(filename, 'rb')
         data = f.read(692)
         self._header = self._header_struct.unpack(data)
@@ -250,30 +365,31 @@ class PT2File:
 
         data = f.read(self._t2t3['ImgHdrSize'])
 
-        self._data = np.fromfile(f, np.uint32, -1)
+        if mmap:
+            offset = f.tell()
+            f.seek(0, 2)
+            if f.tell() > offset:
+                self._data = np.memmap(filename, dtype='<u4', mode='r',
+                    offset=offset)
+            else:
+                self._data = np.zeros(0, dtype=np.uint32)
+            f.close()
+        else:
+            self._data = np.fromfile(f, np.uint32, -1)
+
+    def iter_records(self, chunk=1048576):
+        '''Yield the records in blocks of at most 'chunk' records.'''
+        for i in range(0, len(self._data), chunk):
+            yield self._data[i:i+chunk]
 
     def get_data(self):
         return self._data
 
     def get_ch_data(self, ch, progress=0):
-        chs = (self._data >> 28)
-        d = self._data.astype(np.float64)
-
-        # Add overflows
-        idx = np.where(d == 0xf0000000)[0]
-        add = 0
-        starti = 0
-        for endi in idx:
-            d[starti:endi] += add
-            starti = endi + 1
-            add += _T2WRAPAROUND
-        d[starti:] += add
+        chs, times, markers, mtimes = T2Decoder().decode(self._data)
 
         # Convert to time
-        mask = (chs == ch)
-        d = d[mask] * _RESOLUTION
-
-        return d
+        return times[chs == ch] * _RESOLUTION
 
     def get_header(self):
         return self._header
@@ -285,8 +401,72 @@ class PT2File:
         return self._data
 
 class PT3File(PT2File):
-    def __init__(self, filename=None):
-        PT2File.__init__(self, filename)
+    def __init__(self, filename=None, mmap=False):
+        PT2File.__init__(self, filename, mmap=mmap)
+
+class TTTRFileWriter:
+    '''
+    Writes T2 / T3 records to a file in PT2 / PT3 format, block by block.
+    The number of records is filled in by close().
+    '''
+
+    def __init__(self, filename, mode=2, header=None, t2t3=None):
+        '''
+        Input:
+            filename (string): file name
+            mode (int): 2 for T2 (.pt2) or 3 for T3 (.pt3)
+            header (dict): optional values of GENERAL_HEADER_INFO fields
+            t2t3 (dict): optional values of the PT2File._T2T3INFO fields
+        '''
+
+        self._header = {
+            'Ident': 'PicoHarp 300',
+            'FormatVersion': '2.0',
+            'CreatorName': 'qtlab',
+            'CRLF': '\r\n',
+            'MeasurementMode': mode,
+            'Resolution': _RESOLUTION * 1e9,
+        }
+        if header is not None:
+            self._header.update(header)
+        self._t2t3 = {}
+        if t2t3 is not None:
+            self._t2t3.update(t2t3)
+
+        self._nrecords = 0
+        self._file = open(filename, 'wb')
+        self._write_header()
+
+    def _write_header(self):
+        self._t2t3['NumRecords'] = self._nrecords
+        self._t2t3['ImgHdrSize'] = 0
+        self._file.write(_pack_fields(GENERAL_HEADER_INFO, self._header))
+        self._file.write(_pack_fields(PT2File._T2T3INFO, self._t2t3))
+
+    def write(self, records):
+        '''Append array of records.'''
+        records = np.asarray(records, dtype='<u4')
+        records.tofile(self._file)
+        self._nrecords += len(records)
+
+    def get_record_count(self):
+        return self._nrecords
+
+    def close(self, stop_reason=1):
+        '''
+        Update the header and close the file.
+
+        Input:
+            stop_reason (int): 0 = time over, 1 = manual, 2 = overflow
+        '''
+
+        if self._file is None:
+            return
+        self._t2t3['StopReason'] = stop_reason
+        self._file.seek(0)
+        self._write_header()
+        self._file.close()
+        self._file = None
 
 def test_phd(fname):
     phd = PHDFile(fname)
@@ -0,0 +1,276 @@
+# framering.py, circular frame buffers for continuous camera acquisition
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Continuous camera acquisition into a preallocated circular frame buffer.
+
+A FrameRing holds nframes frames in one numpy array. A camera source
+writes frames into it (or lets the driver write into its memory directly)
+from a FrameStream thread, and the consumer gets numpy views of the new
+frames without copying:
+
+    ring = framering.FrameRing(16, (1, 1024), numpy.int32)
+    stream = framering.FrameStream(source, ring)
+    stream.start()
+    while ...:
+        for num, frame in ring.get_new(timeout=1.0):
+            ...
+    stream.stop()
+
+A view is valid until the ring wraps around to its slot, i.e. until
+nframes - 1 newer frames have arrived; use copy=True to keep frames
+longer. Frames lost by the camera driver are counted as dropped, frames
+overwritten before the consumer retrieved them as overruns.
+
+A source implements:
+    start(ring): configure and start the acquisition
+    poll(ring, timeout): wait up to timeout seconds for new frames, write
+        them to the ring and call ring.commit(); returns the number of
+        new frames
+    stop(): end the acquisition
+'''
+
+import threading
+import time
+import numpy
+
+from lib import streaming
+
+class FrameRing():
+    '''Preallocated circular buffer of frames with a single consumer.'''
+
+    def __init__(self, nframes, shape, dtype):
+        '''
+        Input:
+            nframes (int): number of frames in the buffer
+            shape (tuple): shape of one frame
+            dtype (numpy dtype): pixel type
+        '''
+
+        self.nframes = int(nframes)
+        self.shape = tuple(shape)
+        self.buffer = numpy.zeros((self.nframes,) + self.shape, dtype=dtype)
+        self._cond = threading.Condition()
+        self.reset()
+
+    def reset(self):
+        self._cond.acquire()
+        try:
+            self._count = 0
+            self._read = 0
+            self._dropped = 0
+            self._overruns = 0
+        finally:
+            self._cond.release()
+
+    def get_frame_bytes(self):
+        return self.buffer[0].nbytes
+
+    def get_slot(self, num):
+        '''Return the view of the slot frame number num is written to.'''
+        return self.buffer[num % self.nframes]
+
+    def get_slots(self, num, n):
+        '''
+        Return views for frames num to num + n - 1, as a list of at most
+        two contiguous blocks (the range can wrap around the end).
+        '''
+        start = num % self.nframes
+        if start + n <= self.nframes:
+            return [self.buffer[start:start+n]]
+        split = self.nframes - start
+        return [self.buffer[start:], self.buffer[:n-split]]
+
+    def commit(self, n, dropped=0):
+        '''
+        Mark the next n frames as written. dropped is the number of frames
+        the camera lost before these.
+        '''
+        self._cond.acquire()
+        try:
+            self._count += n
+            self._dropped += dropped
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def skip(self, n):
+        '''
+        Pass n slots that the camera wrote to but overwrote again before
+        they were committed. They count as dropped and are never returned;
+        frames not retrieved yet were overwritten too.
+        '''
+        self._cond.acquire()
+        try:
+            self._overruns += self._count - self._read
+            self._count += n
+            self._dropped += n
+            self._read = self._count
+        finally:
+            self._cond.release()
+
+    def get_frame_count(self):
+        '''Return number of frames written (or skipped).'''
+        return self._count
+
+    def get_dropped(self):
+        '''Return number of frames lost by the camera.'''
+        return self._dropped
+
+    def get_overruns(self):
+        '''Return number of frames overwritten before they were read.'''
+        return self._overruns
+
+    def get_latest(self, copy=False):
+        '''Return (frame number, frame) of the last frame, or None.'''
+        self._cond.acquire()
+        try:
+            if self._count == 0:
+                return None
+            num = self._count - 1
+        finally:
+            self._cond.release()
+        frame = self.get_slot(num)
+        if copy:
+            frame = frame.copy()
+        return num, frame
+
+    def get_new(self, timeout=0, copy=False):
+        '''
+        Return list of (frame number, frame) of all frames not retrieved
+        yet, waiting up to timeout seconds if there are none.
+        '''
+        self._cond.acquire()
+        try:
+            if self._count == self._read and timeout > 0:
+                self._cond.wait(timeout)
+            # The slot being written next may already be changing
+            lag = self._count - self._read
+            if lag > self.nframes - 1:
+                self._overruns += lag - (self.nframes - 1)
+                self._read = self._count - (self.nframes - 1)
+            first, last = self._read, self._count
+            self._read = last
+        finally:
+            self._cond.release()
+
+        ret = []
+        for num in range(first, last):
+            frame = self.get_slot(num)
+            if copy:
+                frame = frame.copy()
+            ret.append((num, frame))
+        return ret
+
+class FrameStream():
+    '''
+    Runs the poll loop of a camera source in a background thread.
+    Callbacks get a dictionary with 'first' (frame number) and 'count'
+    for every batch of new frames.
+    '''
+
+    def __init__(self, source, ring, poll_timeout=0.1):
+        self._source = source
+        self._ring = ring
+        self._poll_timeout = poll_timeout
+        self._callbacks = []
+        self._thread = None
+
+    def add_callback(self, func):
+        self._callbacks.append(func)
+
+    def get_ring(self):
+        return self._ring
+
+    def start(self):
+        self.stop()
+        self._ring.reset()
+        self._source.start(self._ring)
+        self._thread = streaming.StreamThread(self._poll, name='frame stream')
+        for func in self._callbacks:
+            self._thread.add_callback(func)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._thread.stop()
+        self._thread = None
+        self._source.stop()
+
+    def is_running(self):
+        return self._thread is not None and self._thread.isAlive()
+
+    def get_error(self):
+        if self._thread is None:
+            return None
+        return self._thread.get_error()
+
+    def _poll(self):
+        n = self._source.poll(self._ring, self._poll_timeout)
+        if n == 0:
+            return None
+        # Sources may skip lost slots before committing
+        first = self._ring.get_frame_count() - n
+        return {'first': first, 'count': n}
+
+class SimulatedCamera():
+    '''
+    Camera source producing frames at a fixed frame rate: a Gaussian peak
+    on a background with Poisson noise. Frames listed in 'drop' (frame
+    numbers of the camera) are lost, to test dropped frame handling.
+    '''
+
+    def __init__(self, shape, frame_time=0.01, peak=1000.0, background=100.0,
+            drop=(), seed=None):
+        self.shape = tuple(shape)
+        self.frame_time = frame_time
+        self._drop = set(drop)
+        self._random = numpy.random.RandomState(seed)
+        x = numpy.arange(self.shape[-1])
+        line = peak * numpy.exp(-(x - self.shape[-1] / 2.0)**2 / 50.0)
+        self._mean = numpy.resize(line + background, self.shape)
+        self._tstart = None
+        self._produced = 0
+
+    def start(self, ring):
+        self._tstart = time.time()
+        self._produced = 0
+
+    def stop(self):
+        self._tstart = None
+
+    def poll(self, ring, timeout):
+        # Sleep until the next frame is due, but at most timeout
+        due = self._tstart + (self._produced + 1) * self.frame_time
+        wait = due - time.time()
+        if wait > 0:
+            time.sleep(min(wait, timeout))
+
+        total = int((time.time() - self._tstart) / self.frame_time)
+        n = 0
+        dropped = 0
+        num = ring.get_frame_count()
+        for i in range(self._produced, total):
+            if i in self._drop:
+                dropped += 1
+                continue
+            ring.get_slot(num + n)[...] = self._random.poisson(self._mean)
+            n += 1
+        self._produced = max(total, self._produced)
+        if n > 0 or dropped > 0:
+            ring.commit(n, dropped)
+        return n
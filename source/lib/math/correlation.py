@@ -0,0 +1,316 @@
+# correlation.py, incremental photon cross-correlation (g2) histograms
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Cross-correlation of two photon time tag streams, e.g. for g2 / anti-
+bunching measurements. Time tags are integers in units of the time
+resolution (4 ps for the PicoHarp T2 mode) and have to be sorted. The
+PicoHarp T3 mode does not give time tags, so it cannot be used.
+
+On a live stream:
+
+    corr = correlation.Correlator(correlation.make_bins(100e-9, 200))
+    ph.subscribe_TTTR(corr.add_block)
+    d = corr.get_data()
+    qt.plot(d)
+    corr.start_live_update()
+
+On a (memory-mapped) PT2 file:
+
+    corr = correlation.correlate_file('data.pt2',
+        correlation.make_bins(100e-9, 200, log=True, tau_min=1e-10))
+'''
+
+import logging
+import threading
+import numpy as np
+
+_RESOLUTION = 4e-12
+
+def make_bins(tau_max, nbins, log=False, tau_min=None, resolution=_RESOLUTION):
+    '''
+    Return symmetric bin edges from -tau_max to tau_max.
+
+    Input:
+        tau_max (float): maximum delay in seconds
+        nbins (int): number of bins
+        log (bool): logarithmically spaced bins of |tau|, from tau_min to
+            tau_max on both sides, with one bin from -tau_min to tau_min
+        tau_min (float): smallest bin edge for log bins, default tau_max/1e4
+        resolution (float): time tag unit in seconds
+    Output:
+        int64 array of nbins+1 edges in units of the resolution
+    '''
+
+    tmax = tau_max / resolution
+    if not log:
+        edges = np.linspace(-tmax, tmax, nbins + 1)
+    else:
+        if tau_min is None:
+            tau_min = tau_max / 1e4
+        tmin = tau_min / resolution
+        npos = max(nbins / 2, 1)
+        pos = np.logspace(np.log10(tmin), np.log10(tmax), npos)
+        edges = np.concatenate((-pos[::-1], pos))
+
+    edges = np.unique(np.round(edges).astype(np.int64))
+    if len(edges) < 2:
+        raise ValueError('Bins smaller than the resolution')
+    return edges
+
+def cross_correlate(ta, tb, edges, chunk=4096):
+    '''
+    Histogram of tb[j] - ta[i] over all pairs, for sorted time tags. For
+    every a and bin edge the number of b events before it is found with a
+    binary search, so this takes O(n log n) per bin edge.
+
+    Input:
+        ta, tb (int64 arrays): sorted time tags
+        edges (int64 array): bin edges, see make_bins()
+        chunk (int): number of ta elements processed at a time
+    Output:
+        int64 array of len(edges) - 1 counts
+    '''
+
+    ta = np.asarray(ta)
+    tb = np.asarray(tb)
+    counts = np.zeros(len(edges) - 1, dtype=np.int64)
+    if len(ta) == 0 or len(tb) == 0:
+        return counts
+
+    # Only a events that can have a partner in tb
+    lo = np.searchsorted(ta, tb[0] - edges[-1], 'left')
+    hi = np.searchsorted(ta, tb[-1] - edges[0], 'right')
+    for i in range(lo, hi, chunk):
+        a = ta[i:min(i+chunk, hi)]
+        idx = np.searchsorted(tb, a[:,np.newaxis] + edges[np.newaxis,:], 'left')
+        counts += np.diff(idx, axis=1).sum(axis=0)
+    return counts
+
+class Correlator:
+    '''
+    Running cross-correlation histogram between two channels of a time tag
+    stream that arrives in blocks. Each pair of events is counted once,
+    when the later one of the two arrives, so only events within the
+    maximum delay of the end of the previous block are kept.
+    '''
+
+    def __init__(self, edges, cha=0, chb=1, resolution=_RESOLUTION):
+        '''
+        Input:
+            edges (int64 array): bin edges, see make_bins()
+            cha, chb (int): channels; the histogram is of t(chb) - t(cha)
+            resolution (float): time tag unit in seconds
+        '''
+
+        self._edges = np.asarray(edges, dtype=np.int64)
+        self._cha = cha
+        self._chb = chb
+        self._resolution = resolution
+        self._lock = threading.Lock()
+        self._data = None
+        self._update_hid = None
+        self.reset()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self._counts = np.zeros(len(self._edges) - 1, dtype=np.int64)
+            self._hist_a = np.zeros(0, dtype=np.int64)
+            self._hist_b = np.zeros(0, dtype=np.int64)
+            self._na = 0
+            self._nb = 0
+            self._tstart = None
+            self._tend = None
+        finally:
+            self._lock.release()
+
+    def add_times(self, ta, tb, t_end=None):
+        '''
+        Add the next block of sorted time tags of both channels.
+
+        Input:
+            ta, tb (int64 arrays): new time tags of channel a and b
+            t_end (int): time up to which the stream is complete, default
+                the last time tag
+        '''
+
+        ta = np.asarray(ta, dtype=np.int64)
+        tb = np.asarray(tb, dtype=np.int64)
+        if t_end is None:
+            last = [t[-1] for t in (ta, tb) if len(t) > 0]
+            if len(last) == 0:
+                return
+            t_end = max(last)
+
+        self._lock.acquire()
+        try:
+            if self._tstart is None:
+                first = [t[0] for t in (ta, tb) if len(t) > 0]
+                if len(first) > 0:
+                    self._tstart = min(first)
+            self._tend = t_end
+
+            # New a events against all b events, new b against old a
+            allb = np.concatenate((self._hist_b, tb))
+            self._counts += cross_correlate(ta, allb, self._edges)
+            self._counts += cross_correlate(self._hist_a, tb, self._edges)
+            self._na += len(ta)
+            self._nb += len(tb)
+
+            # Keep events that can still pair with future ones
+            allb = allb[allb >= t_end + self._edges[0]]
+            alla = np.concatenate((self._hist_a, ta))
+            self._hist_a = alla[alla >= t_end - self._edges[-1]]
+            self._hist_b = allb
+        finally:
+            self._lock.release()
+
+    def add_records(self, channels, times, t_end=None):
+        '''Add decoded records, e.g. from picoharp.T2Decoder.decode().'''
+        self.add_times(times[channels == self._cha],
+            times[channels == self._chb], t_end=t_end)
+
+    def add_block(self, block):
+        '''
+        Add a decoded block, as published by the PicoHarp TTTR stream.
+        Can be used as a subscriber function. Only T2 mode blocks have
+        time tags.
+        '''
+        if 'times' not in block:
+            raise ValueError('Correlator needs T2 mode time tags, T3 mode '
+                'blocks only have sync counts and delay times')
+        self.add_records(block['channels'], block['times'])
+
+    def get_edges(self):
+        return self._edges
+
+    def get_taus(self):
+        '''Return bin centers in seconds.'''
+        return (self._edges[:-1] + self._edges[1:]) / 2.0 * self._resolution
+
+    def get_histogram(self):
+        '''Return copy of the coincidence counts per bin.'''
+        self._lock.acquire()
+        ret = self._counts.copy()
+        self._lock.release()
+        return ret
+
+    def get_counts(self):
+        '''Return number of events in channel a and b.'''
+        return self._na, self._nb
+
+    def get_g2(self):
+        '''
+        Return the histogram normalized to uncorrelated events, i.e.
+        counts / (Na * Nb * binwidth / T).
+        '''
+
+        self._lock.acquire()
+        try:
+            counts = self._counts.astype(np.float64)
+            if self._tstart is None or self._tend <= self._tstart or \
+                    self._na == 0 or self._nb == 0:
+                return np.zeros_like(counts)
+            duration = float(self._tend - self._tstart)
+            norm = self._na * float(self._nb) * np.diff(self._edges) / duration
+        finally:
+            self._lock.release()
+        return counts / norm
+
+    def get_data(self, name='g2', normalize=True):
+        '''
+        Return Data object (with temporary file) with columns tau (s) and
+        g2 (or counts), that is updated by update_data().
+        '''
+
+        if self._data is not None:
+            return self._data
+
+        from data import Data
+        d = Data(name=name)
+        d.add_coordinate('tau [s]')
+        if normalize:
+            d.add_value('g2')
+        else:
+            d.add_value('counts')
+        d.add_data_point(self.get_taus(), self._get_values(normalize))
+        d.create_tempfile()
+        self._data = d
+        self._normalize = normalize
+        return d
+
+    def _get_values(self, normalize):
+        if normalize:
+            return self.get_g2()
+        return self.get_histogram().astype(np.float64)
+
+    def update_data(self):
+        '''Update the Data object with the current histogram.'''
+        if self._data is None:
+            return
+        vals = self._get_values(self._normalize)
+        self._data.update_data(np.column_stack((self.get_taus(), vals)))
+        self._data.emit('new-data-point')
+
+    def start_live_update(self, interval=1.0):
+        '''Update the Data object every interval seconds.'''
+        import gobject
+        self.stop_live_update()
+        self.get_data()
+        self._update_hid = gobject.timeout_add(int(interval * 1000),
+            self._live_update_cb)
+
+    def _live_update_cb(self):
+        try:
+            self.update_data()
+        except Exception, e:
+            logging.warning('Updating correlation data failed: %s', e)
+        return True
+
+    def stop_live_update(self):
+        if self._update_hid is not None:
+            import gobject
+            gobject.source_remove(self._update_hid)
+            self._update_hid = None
+
+def correlate_file(filename, edges, cha=0, chb=1, chunk=1048576,
+        correlator=None):
+    '''
+    Correlate two channels of a PT2 file. The file is memory-mapped and
+    decoded in chunks, so it can be larger than the available memory.
+
+    Input:
+        filename (string): PT2 file
+        edges (int64 array): bin edges, see make_bins()
+        cha, chb (int): channels
+        chunk (int): number of records decoded at a time
+        correlator (Correlator): add to an existing correlator
+    Output:
+        Correlator
+    '''
+
+    from lib.file_support import picoharp
+
+    if correlator is None:
+        correlator = Correlator(edges, cha, chb)
+    f = picoharp.PT2File(filename, mmap=True)
+    decoder = picoharp.T2Decoder()
+    for records in f.iter_records(chunk):
+        chs, times, markers, mtimes = decoder.decode(records)
+        if len(times) > 0:
+            correlator.add_records(chs, times)
+    return correlator
@@ -0,0 +1,332 @@
+# spectra.py, cosmic ray / hot pixel rejection and background handling
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Processing of CCD spectra: background subtraction and rejection of
+cosmic rays and hot pixels, without re-acquiring the spectrum.
+
+Spikes are found in two ways:
+    - against the neighbouring pixels: a pixel far above the running
+      median whose neighbours are not (real lines are wider than one
+      pixel)
+    - across consecutive frames: a pixel far above its median over the
+      previous frames that is also above its neighbours (this finds
+      cosmics that hit more than one pixel; a lasting change of the
+      signal is smooth and is kept)
+Bad pixels are replaced in place by the running median, or by the median
+over time where the signal did not change.
+
+    pipe = spectra.SpectrumPipeline(nhistory=5)
+    pipe.backgrounds.add(('exposure', 1.0), dark_frames)
+    spec = pipe.process(raw, key=('exposure', 1.0))
+'''
+
+import collections
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+# Scale factor of the median absolute deviation for Gaussian noise
+_MAD_SCALE = 1.4826
+
+def median_filter(spec, width=5):
+    '''
+    Running median along the last axis, with reflected edges. Works on a
+    single spectrum or a [nframes, npixels] array.
+    '''
+
+    spec = np.asarray(spec, dtype=np.float64)
+    half = width // 2
+    pad = [(0, 0)] * (spec.ndim - 1) + [(half, half)]
+    padded = np.ascontiguousarray(np.pad(spec, pad, 'reflect'))
+    shape = spec.shape + (2 * half + 1, )
+    strides = padded.strides + (padded.strides[-1], )
+    windows = as_strided(padded, shape=shape, strides=strides)
+    return np.median(windows, axis=-1)
+
+def robust_sigma(resid, axis=None):
+    '''Noise estimate from the median absolute deviation of residuals.'''
+    med = np.median(resid, axis=axis)
+    if axis is not None:
+        med = np.expand_dims(med, axis)
+    return _MAD_SCALE * np.median(np.abs(resid - med), axis=axis)
+
+def _noise(ref, resid, sigma):
+    if sigma is not None:
+        return sigma
+    # Shot noise of the reference, but at least the spread of the data
+    floor = max(robust_sigma(resid), 1.0)
+    return np.maximum(np.sqrt(np.abs(ref)), floor)
+
+def find_spikes(spec, width=5, thresh=6.0, ratio=0.3, sigma=None,
+        smooth=None):
+    '''
+    Find single-pixel spikes against the neighbouring pixels.
+
+    Input:
+        spec (array): spectrum
+        width (int): width of the running median
+        thresh (float): minimum excess over the median, in units of sigma
+        ratio (float): both neighbours have to be below ratio times the
+            pixel, measured from a baseline (a median over 3 * width).
+            None to skip this test.
+        sigma (float): noise level, default is shot noise of the median
+            with the robust spread of the data as minimum
+        smooth (array): precomputed median_filter(spec, width)
+    Output:
+        (mask, smooth): boolean mask of spikes and the running median
+    '''
+
+    spec = np.asarray(spec, dtype=np.float64)
+    if smooth is None:
+        smooth = median_filter(spec, width)
+    excess = spec - smooth
+    noise = _noise(smooth, excess, sigma)
+
+    mask = excess > thresh * noise
+    if ratio is None or not mask.any():
+        return mask, smooth
+
+    # Real features are wider than a pixel, so at least one neighbour is
+    # a considerable fraction of the peak. Narrow lines raise the running
+    # median itself, so compare with a wider baseline.
+    idx = np.nonzero(mask)[0]
+    base = median_filter(spec, 3 * width)[idx]
+    left = spec[np.maximum(idx - 1, 0)]
+    right = spec[np.minimum(idx + 1, len(spec) - 1)]
+    neighbour = np.maximum(left, right) - base
+    mask[idx] = neighbour < ratio * (spec[idx] - base)
+    return mask, smooth
+
+def find_spikes_frames(spec, history, thresh=6.0, sigma=None, ref=None):
+    '''
+    Find pixels that are far above their median over previous frames.
+
+    Input:
+        spec (array): new spectrum
+        history (array): [nframes, npixels] previous spectra, at least 3
+        thresh (float): minimum excess in units of sigma
+        sigma (float): noise level, default is shot noise of the median
+        ref (array): precomputed median of history over the frames
+    Output:
+        (mask, ref): boolean mask of spikes and the median spectrum
+    '''
+
+    spec = np.asarray(spec, dtype=np.float64)
+    if ref is None:
+        ref = np.median(history, axis=0)
+    excess = spec - ref
+    noise = _noise(ref, excess, sigma)
+    return excess > thresh * noise, ref
+
+def grow_mask(mask, n=1):
+    '''Extend a mask by n pixels on both sides (for spike shoulders).'''
+    ret = mask.copy()
+    for i in range(1, n + 1):
+        ret[i:] |= mask[:-i]
+        ret[:-i] |= mask[i:]
+    return ret
+
+def patch(spec, mask, ref):
+    '''Replace the masked pixels of spec by ref, in place.'''
+    spec[mask] = np.asarray(ref)[mask]
+    return spec
+
+def remove_spikes(spec, width=5, thresh=6.0, ratio=0.3, sigma=None, grow=0):
+    '''
+    Find spikes against the neighbouring pixels and replace them by the
+    running median, in place. Returns the number of patched pixels.
+    '''
+    mask, smooth = find_spikes(spec, width, thresh, ratio, sigma)
+    if grow > 0:
+        mask = grow_mask(mask, grow)
+    patch(spec, mask, smooth)
+    return int(mask.sum())
+
+class BackgroundCache():
+    '''
+    Background (dark) spectra, keyed by the acquisition settings, e.g.
+    (exposure time, read mode). Each background is the median of a set
+    of frames, so cosmics in the dark frames do not end up in it.
+    '''
+
+    def __init__(self, maxsize=16):
+        self._maxsize = maxsize
+        self._items = collections.OrderedDict()
+
+    def make_key(self, **settings):
+        '''Return a cache key for settings given as keyword arguments.'''
+        return tuple(sorted(settings.items()))
+
+    def add(self, key, frames):
+        '''
+        Store the background for key, from a single spectrum or an array
+        of [nframes, npixels] dark spectra.
+        '''
+        frames = np.asarray(frames, dtype=np.float64)
+        if frames.ndim > 1 and len(frames) > 1:
+            bg = np.median(frames, axis=0)
+        else:
+            bg = frames.reshape(-1).copy()
+        if key in self._items:
+            del self._items[key]
+        self._items[key] = bg
+        while len(self._items) > self._maxsize:
+            self._items.popitem(last=False)
+        return bg
+
+    def acquire(self, key, acquire_func, nframes=5):
+        '''
+        Return the background for key, calling acquire_func() nframes
+        times to take it if it is not cached yet.
+        '''
+        bg = self.get(key)
+        if bg is None:
+            bg = self.add(key, [acquire_func() for i in range(nframes)])
+        return bg
+
+    def get(self, key):
+        return self._items.get(key)
+
+    def has(self, key):
+        return key in self._items
+
+    def remove(self, key):
+        if key in self._items:
+            del self._items[key]
+
+    def clear(self):
+        self._items.clear()
+
+    def keys(self):
+        return self._items.keys()
+
+class SpectrumPipeline():
+    '''
+    Background subtraction followed by spike rejection against the
+    neighbouring pixels and, once enough frames were processed, against
+    the previous frames. The last nhistory spectra are kept in a
+    preallocated buffer.
+    '''
+
+    def __init__(self, nhistory=5, width=5, thresh=6.0, ratio=0.3,
+            sigma=None, grow=0, backgrounds=None, loose_thresh=None):
+        '''
+        Input:
+            nhistory (int): number of previous frames to compare with, 0
+                to only compare with neighbouring pixels
+            width (int): width of the running median
+            thresh (float): spike threshold in units of sigma
+            ratio (float): maximum relative excess of the neighbours
+            sigma (float): noise level, default is estimated
+            grow (int): also patch this many pixels around each spike
+            backgrounds (BackgroundCache): default is a new cache
+            loose_thresh (float): threshold against the neighbours, without
+                the ratio test, for pixels that are outliers in time;
+                default is thresh
+        '''
+
+        self.nhistory = nhistory
+        self.width = width
+        self.thresh = thresh
+        self.ratio = ratio
+        self.sigma = sigma
+        self.grow = grow
+        if loose_thresh is None:
+            loose_thresh = thresh
+        self.loose_thresh = loose_thresh
+        if backgrounds is None:
+            backgrounds = BackgroundCache()
+        self.backgrounds = backgrounds
+        self._history = None
+        self.reset()
+
+    def reset(self):
+        '''Forget the previous frames, e.g. after changing settings.'''
+        self._nframes = 0
+        self._npatched = 0
+        self._nprocessed = 0
+        self._key = None
+
+    def get_patched_count(self):
+        '''Return the total number of patched pixels.'''
+        return self._npatched
+
+    def get_processed_count(self):
+        return self._nprocessed
+
+    def _add_history(self, spec):
+        if self.nhistory <= 0:
+            return
+        if self._history is None or self._history.shape[1] != len(spec):
+            self._history = np.zeros((self.nhistory, len(spec)))
+            self._nframes = 0
+        self._history[self._nframes % self.nhistory] = spec
+        self._nframes += 1
+
+    def process(self, spec, key=None, out=None):
+        '''
+        Subtract the background for key (if cached) and patch spikes.
+
+        Input:
+            spec (array): raw spectrum
+            key: background cache key, see BackgroundCache.make_key()
+            out (float64 array): result buffer, can be spec itself to
+                process in place
+        Output:
+            processed spectrum
+        '''
+
+        if out is None:
+            out = np.array(spec, dtype=np.float64)
+        elif out is not spec:
+            out[:] = spec
+
+        # Frames with other settings are not comparable
+        if key != self._key:
+            self._nframes = 0
+            self._key = key
+
+        if key is not None:
+            bg = self.backgrounds.get(key)
+            if bg is not None:
+                out -= bg
+
+        mask, smooth = find_spikes(out, self.width, self.thresh, self.ratio,
+            self.sigma)
+        ref = smooth
+        if self.nhistory >= 3 and self._nframes >= 3:
+            n = min(self._nframes, self.nhistory)
+            fmask, fref = find_spikes_frames(out, self._history[:n],
+                self.thresh, self.sigma)
+            # A lasting change (new spot, laser on, grating moved) is an
+            # outlier in time too, so only patch pixels that also stick
+            # out from their neighbours.
+            loose, smooth = find_spikes(out, self.width, self.loose_thresh,
+                None, self.sigma, smooth=smooth)
+            spikes = fmask & loose
+            mask |= spikes
+            # The median over time keeps the line shape under multi-pixel
+            # cosmics, but is not valid next to a lasting change
+            changed = grow_mask(fmask & ~loose, self.width)
+            ref = np.where(spikes & ~changed, fref, smooth)
+
+        if self.grow > 0:
+            mask = grow_mask(mask, self.grow)
+        patch(out, mask, ref)
+        self._npatched += int(mask.sum())
+        self._nprocessed += 1
+        self._add_history(out)
+        return out
@@ -0,0 +1,203 @@
+# persist.py, write-behind store for persistent instrument parameter values
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import gobject
+import os
+import sys
+import logging
+
+# for backward compatibility to python 2.5
+try:
+    import json
+except:
+    import simplejson as json
+
+from lib.config import get_config, get_execdir
+
+def _replace(src, dst):
+    '''Rename src to dst, replacing dst in one step if it exists.'''
+    if sys.platform == 'win32':
+        import ctypes
+        MOVEFILE_REPLACE_EXISTING = 0x1
+        MOVEFILE_WRITE_THROUGH = 0x8
+        if not ctypes.windll.kernel32.MoveFileExW(unicode(src), unicode(dst),
+                MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH):
+            raise ctypes.WinError()
+    else:
+        os.rename(src, dst)
+
+class PersistStore():
+    '''
+    Store for values of FLAG_PERSIST parameters.
+
+    Setting a value only updates the in-memory copy; changes are appended
+    to a journal file from the gobject main loop after 'delay' seconds.
+    Once the journal contains more than 'compact_size' entries the values
+    are written to a snapshot file and the journal is cleared.
+    '''
+
+    def __init__(self, filename, delay=1, compact_size=1000):
+        self._filename = filename
+        self._journal_filename = filename + '.journal'
+        self._delay = delay
+        self._compact_size = compact_size
+
+        self._values = {}
+        self._pending = []
+        self._journal_size = 0
+        self._flush_hid = None
+
+        self.load()
+
+    def load(self):
+        '''
+        Load the snapshot and replay the journal.
+        '''
+
+        self._values = {}
+        try:
+            if os.path.exists(self._filename):
+                f = open(self._filename, 'r')
+                self._values = json.load(f)
+                f.close()
+        except Exception, e:
+            logging.warning('Unable to load persist file %s: %s',
+                self._filename, e)
+
+        self._journal_size = 0
+        if not os.path.exists(self._journal_filename):
+            return
+
+        f = open(self._journal_filename, 'r')
+        for line in f:
+            try:
+                key, val = json.loads(line)
+            except ValueError:
+                # Incomplete last line after a crash
+                logging.warning('Skipping corrupt persist journal entry')
+                continue
+            self._values[key] = val
+            self._journal_size += 1
+        f.close()
+
+    def has_key(self, key):
+        return key in self._values
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def set(self, key, val):
+        '''
+        Set value and schedule writing it to the journal.
+        '''
+
+        self._values[key] = val
+        self._pending.append((key, val))
+        if self._flush_hid is None:
+            self._flush_hid = gobject.timeout_add(int(self._delay * 1000),
+                    self._flush_cb)
+
+    def _flush_cb(self):
+        self._flush_hid = None
+        self.flush()
+        return False
+
+    def flush(self):
+        '''
+        Write pending changes to the journal, compact if needed.
+        '''
+
+        if self._flush_hid is not None:
+            gobject.source_remove(self._flush_hid)
+            self._flush_hid = None
+
+        if len(self._pending) == 0:
+            return
+
+        pending = self._pending
+        self._pending = []
+        lines = []
+        for item in pending:
+            try:
+                lines.append('%s\n' % json.dumps(item))
+            except Exception, e:
+                # Retrying will not help, drop it so later values get written
+                logging.warning('Unable to store persist value %s: %s',
+                    item[0], e)
+        if len(lines) == 0:
+            return
+
+        try:
+            f = open(self._journal_filename, 'a')
+            f.write(''.join(lines))
+            f.close()
+            self._journal_size += len(lines)
+        except Exception, e:
+            # E.g. file locked by a virus scanner, try again later
+            logging.warning('Unable to write persist journal: %s', e)
+            self._pending = pending + self._pending
+            if self._flush_hid is None:
+                self._flush_hid = gobject.timeout_add(
+                        int(self._delay * 1000), self._flush_cb)
+            return
+
+        if self._journal_size > self._compact_size:
+            self.compact()
+
+    def compact(self):
+        '''
+        Write all values to the snapshot file and clear the journal.
+        '''
+
+        tmpname = self._filename + '.tmp'
+        try:
+            try:
+                data = json.dumps(self._values)
+            except (TypeError, ValueError):
+                data = json.dumps(self._serializable_values())
+            f = open(tmpname, 'w')
+            f.write(data)
+            f.close()
+            # The old snapshot stays valid until it is replaced
+            _replace(tmpname, self._filename)
+            os.remove(self._journal_filename)
+            self._journal_size = 0
+        except Exception, e:
+            logging.warning('Unable to compact persist file: %s', e)
+
+    def _serializable_values(self):
+        '''Return the values that can be stored, flush() logged the others.'''
+        ret = {}
+        for key, val in self._values.iteritems():
+            try:
+                json.dumps(val)
+                ret[key] = val
+            except (TypeError, ValueError):
+                pass
+        return ret
+
+_store = None
+def get_persist_store():
+    '''Get persistent parameter store.'''
+    global _store
+    if _store is None:
+        cfgname = get_config()._filename
+        fname = os.path.splitext(cfgname)[0] + '.persist'
+        _store = PersistStore(os.path.join(get_execdir(), fname))
+
+        from qtflow import get_flowcontrol
+        get_flowcontrol().register_exit_handler(_store.flush)
+    return _store
@@ -0,0 +1,238 @@
+# probe.py, central scheduler for periodic parameter probes
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import gobject
+import logging
+
+from qtflow import get_flowcontrol
+from lib.misc import exact_time
+
+class _Probe():
+
+    def __init__(self, ins, name, interval):
+        self.ins = ins
+        self.name = name
+        self.interval = interval / 1000.0
+        self.next_time = exact_time() + self.interval
+
+        self.count = 0
+        self.errors = 0
+        self.last_latency = 0.0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def add_latency(self, dt):
+        self.count += 1
+        self.last_latency = dt
+        self.total_latency += dt
+        self.max_latency = max(self.max_latency, dt)
+
+    def get_stats(self):
+        if self.count > 0:
+            mean = self.total_latency / self.count
+        else:
+            mean = 0.0
+        return {
+            'interval': self.interval * 1000,
+            'count': self.count,
+            'errors': self.errors,
+            'last_latency': self.last_latency,
+            'mean_latency': mean,
+            'max_latency': self.max_latency,
+        }
+
+class ProbeScheduler():
+    '''
+    Perform the periodic gets of parameters with a 'probe_interval' option
+    from a single gobject timer.
+
+    Probes that are due are grouped per lock class and instrument, so
+    every instrument is accessed once per round with a single get() of
+    all due parameters (which uses the driver function do_get_batch() if
+    it exists).
+
+    If probing takes more than 'max_load' of the time, intervals are
+    stretched (up to 'max_slowdown' times) until the load drops again.
+    While a measurement is running intervals are multiplied by
+    'measurement_factor' (5 by default, so probes keep running but take
+    less time from the measurement); a factor of 0 pauses probing
+    altogether and 1 does not throttle at all.
+    '''
+
+    def __init__(self, max_load=0.2, max_slowdown=10.0,
+            measurement_factor=5):
+        self._probes = []
+        self._timer_hid = None
+        self._timer_time = None
+
+        self._max_load = max_load
+        self._max_slowdown = max_slowdown
+        self._measurement_factor = measurement_factor
+        self._slowdown = 1.0
+        self._measuring = False
+        self._busy_time = 0.0
+        self._load_start = exact_time()
+
+        flow = get_flowcontrol()
+        flow.connect('measurement-start', self._measurement_start_cb)
+        flow.connect('measurement-end', self._measurement_end_cb)
+
+    def add(self, ins, name, interval):
+        '''
+        Probe parameter 'name' of instrument 'ins' every 'interval' ms.
+        '''
+
+        self.remove(ins, name)
+        self._probes.append(_Probe(ins, name, interval))
+        self._schedule()
+
+    def remove(self, ins, name=None):
+        '''
+        Stop probing parameter 'name' of instrument 'ins', or all its
+        parameters if name is None.
+        '''
+
+        self._probes = [p for p in self._probes if not (p.ins is ins and \
+                (name is None or p.name == name))]
+
+    def get_stats(self):
+        '''
+        Return dictionary of '<instrument>.<parameter>' -> probe statistics.
+        Latencies are in seconds, intervals in ms.
+        '''
+
+        ret = {}
+        for p in self._probes:
+            ret['%s.%s' % (p.ins.get_name(), p.name)] = p.get_stats()
+        return ret
+
+    def get_slowdown(self):
+        '''Return the current factor by which intervals are stretched.'''
+        return self._slowdown
+
+    def set_measurement_factor(self, factor):
+        '''
+        Set factor to multiply intervals with while measuring, 0 to pause.
+        '''
+        self._measurement_factor = factor
+
+    def _get_factor(self):
+        if self._measuring:
+            return self._measurement_factor * self._slowdown
+        return self._slowdown
+
+    def _measurement_start_cb(self, sender):
+        self._measuring = True
+        if self._measurement_factor == 0:
+            self._stop_timer()
+
+    def _measurement_end_cb(self, sender):
+        self._measuring = False
+        self._schedule()
+
+    def _stop_timer(self):
+        if self._timer_hid is not None:
+            gobject.source_remove(self._timer_hid)
+            self._timer_hid = None
+            self._timer_time = None
+
+    def _schedule(self):
+        if len(self._probes) == 0 or self._get_factor() == 0:
+            return
+
+        next_time = min([p.next_time for p in self._probes])
+        if self._timer_hid is not None:
+            if self._timer_time <= next_time:
+                return
+            gobject.source_remove(self._timer_hid)
+
+        delay = max(0, int((next_time - exact_time()) * 1000))
+        self._timer_time = next_time
+        self._timer_hid = gobject.timeout_add(delay, self._timeout_cb)
+
+    def _timeout_cb(self):
+        self._timer_hid = None
+        self._timer_time = None
+
+        start = exact_time()
+        groups = {}
+        for p in self._probes:
+            if p.next_time <= start:
+                key = (p.ins._lock_class, p.ins.get_name())
+                if key not in groups:
+                    groups[key] = []
+                groups[key].append(p)
+
+        keys = groups.keys()
+        keys.sort()
+        for key in keys:
+            self._do_probes(groups[key])
+
+        factor = self._get_factor()
+        now = exact_time()
+        for probes in groups.itervalues():
+            for p in probes:
+                p.next_time = now + p.interval * factor
+
+        self._update_load(now - start, now)
+        self._schedule()
+        return False
+
+    def _do_probes(self, probes):
+        ins = probes[0].ins
+        names = [p.name for p in probes]
+
+        start = exact_time()
+        try:
+            if len(names) > 1:
+                ins.get(names)
+            else:
+                ins.get(names[0])
+        except Exception, e:
+            logging.warning('Probing %s failed: %s', ins.get_name(), e)
+            for p in probes:
+                p.errors += 1
+
+        dt = (exact_time() - start) / len(probes)
+        for p in probes:
+            p.add_latency(dt)
+
+    def _update_load(self, busy, now):
+        self._busy_time += busy
+        period = now - self._load_start
+        if period < 1.0:
+            return
+
+        load = self._busy_time / period
+        if load > self._max_load:
+            self._slowdown = min(self._slowdown * 1.5, self._max_slowdown)
+            logging.debug('Probe load %.2f, slowing down by %.1f',
+                load, self._slowdown)
+        elif load < self._max_load / 2:
+            self._slowdown = max(self._slowdown / 1.5, 1.0)
+
+        self._busy_time = 0.0
+        self._load_start = now
+
+_probe_scheduler = None
+def get_probe_scheduler():
+    global _probe_scheduler
+    if _probe_scheduler is None:
+        from lib.config import get_config
+        config = get_config()
+        _probe_scheduler = ProbeScheduler(
+            measurement_factor=config.get('probe_measurement_factor', 5))
+    return _probe_scheduler
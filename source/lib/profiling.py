@@ -0,0 +1,160 @@
+# profiling.py, low-overhead timing statistics for instrument access
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import math
+
+class LatencyHistogram():
+    '''
+    Histogram with logarithmically spaced buckets: every power of two
+    above 'min_value' (in seconds) is divided in 'sub_buckets' buckets,
+    giving a constant relative resolution.
+    '''
+
+    def __init__(self, min_value=1e-6, max_value=100.0, sub_buckets=8):
+        self._min_value = min_value
+        self._sub_buckets = sub_buckets
+        self._scale = sub_buckets / math.log(2)
+        nbuckets = int(math.log(max_value / min_value) * self._scale) + 2
+        self._counts = [0] * nbuckets
+        self._count = 0
+
+    def _index(self, value):
+        if value <= self._min_value:
+            return 0
+        idx = int(math.log(value / self._min_value) * self._scale) + 1
+        return min(idx, len(self._counts) - 1)
+
+    def _value(self, idx):
+        '''Return upper edge of bucket idx.'''
+        return self._min_value * math.exp(idx / self._scale)
+
+    def add(self, value):
+        self._counts[self._index(value)] += 1
+        self._count += 1
+
+    def get_percentile(self, percentile):
+        '''
+        Return an upper bound for the value below which 'percentile' percent
+        of the samples fall, or None if there are no samples.
+        '''
+
+        if self._count == 0:
+            return None
+
+        limit = self._count * percentile / 100.0
+        total = 0
+        for idx, n in enumerate(self._counts):
+            total += n
+            if total >= limit and n > 0:
+                return self._value(idx)
+        return self._value(len(self._counts) - 1)
+
+    def get_buckets(self):
+        '''Return list of (upper edge, count) for non-empty buckets.'''
+        return [(self._value(idx), n) \
+            for idx, n in enumerate(self._counts) if n > 0]
+
+class CallStats():
+    '''
+    Timing statistics of a parameter get/set or function call.
+    '''
+
+    def __init__(self):
+        self.count = 0
+        self.lock_time = 0.0
+        self.driver_time = 0.0
+        self.cast_time = 0.0
+        self.max_time = 0.0
+        self.histogram = LatencyHistogram()
+
+    def add(self, lock_time, driver_time, cast_time):
+        total = lock_time + driver_time + cast_time
+        self.count += 1
+        self.lock_time += lock_time
+        self.driver_time += driver_time
+        self.cast_time += cast_time
+        self.max_time = max(self.max_time, total)
+        self.histogram.add(total)
+
+    def get_summary(self):
+        total = self.lock_time + self.driver_time + self.cast_time
+        n = max(self.count, 1)
+        return {
+            'count': self.count,
+            'total_time': total,
+            'mean_time': total / n,
+            'max_time': self.max_time,
+            'lock_time': self.lock_time,
+            'driver_time': self.driver_time,
+            'cast_time': self.cast_time,
+            'p50': self.histogram.get_percentile(50),
+            'p90': self.histogram.get_percentile(90),
+            'p99': self.histogram.get_percentile(99),
+        }
+
+_enabled = False
+_stats = {}
+
+def is_enabled():
+    return _enabled
+
+def set_enabled(enabled):
+    '''Enable or disable collection of timing statistics.'''
+    global _enabled
+    _enabled = bool(enabled)
+
+def reset():
+    '''Clear all collected statistics.'''
+    _stats.clear()
+
+def record(insname, kind, name, lock_time, driver_time, cast_time=0.0):
+    '''
+    Add a sample for operation 'kind' ('get', 'set' or 'call') on
+    parameter or function 'name' of instrument 'insname'.
+    '''
+
+    key = (insname, kind, name)
+    stats = _stats.get(key, None)
+    if stats is None:
+        stats = CallStats()
+        _stats[key] = stats
+    stats.add(lock_time, driver_time, cast_time)
+
+def get_stats(insname=None):
+    '''
+    Return list of summary dictionaries, optionally only for instrument
+    'insname', sorted by total time (slowest first).
+    '''
+
+    ret = []
+    for (ins, kind, name), stats in _stats.items():
+        if insname is not None and ins != insname:
+            continue
+        summary = stats.get_summary()
+        summary['instrument'] = ins
+        summary['kind'] = kind
+        summary['name'] = name
+        ret.append(summary)
+
+    ret.sort(key=lambda x: x['total_time'], reverse=True)
+    return ret
+
+def get_histogram(insname, kind, name):
+    '''Return histogram buckets for a single parameter or function.'''
+    stats = _stats.get((insname, kind, name), None)
+    if stats is None:
+        return []
+    return stats.histogram.get_buckets()
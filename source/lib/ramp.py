@@ -0,0 +1,271 @@
+# ramp.py, engine to ramp instrument parameters without blocking
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import gobject
+import logging
+import math
+import threading
+import time
+
+from qtflow import get_flowcontrol
+from lib.misc import exact_time
+
+class RampHandle():
+    '''
+    Handle to a (possibly still running) ramp of an instrument parameter,
+    as returned by Instrument.set(..., wait=False).
+    '''
+
+    def __init__(self, ins, name, target, done=False):
+        self._ins = ins
+        self._name = name
+        self._target = target
+        self._done = done
+        self._aborted = False
+
+    def __repr__(self):
+        if self._aborted:
+            state = 'aborted'
+        elif self._done:
+            state = 'done'
+        else:
+            state = 'running'
+        return 'RampHandle(%s.%s -> %r, %s)' % \
+            (self._ins.get_name(), self._name, self._target, state)
+
+    def get_instrument(self):
+        return self._ins
+
+    def get_name(self):
+        return self._name
+
+    def get_target(self):
+        return self._target
+
+    def get_value(self):
+        '''Return the last value that was set.'''
+        return self._ins.get(self._name, query=False)
+
+    def is_done(self):
+        '''Return whether the ramp finished or was aborted.'''
+        return self._done
+
+    def is_aborted(self):
+        return self._aborted
+
+    def abort(self):
+        '''Stop the ramp at the current value.'''
+        get_ramp_engine().abort(self)
+
+    def wait(self, timeout=None):
+        '''
+        Wait for the ramp to finish while handling events. In other
+        threads (e.g. Instrument.set_threaded) just sleep, the main loop
+        runs the ramp.
+
+        Input:
+            timeout (float): maximum time to wait in seconds
+        Output:
+            True if the ramp reached its target value
+        '''
+
+        flow = get_flowcontrol()
+        main = threading.currentThread().getName() == 'MainThread'
+        start = exact_time()
+        while not self._done:
+            if timeout is not None and exact_time() - start > timeout:
+                return False
+            if main:
+                flow.measurement_idle(0.01)
+            else:
+                time.sleep(0.01)
+
+        return not self._aborted
+
+class _Ramp():
+
+    def __init__(self, handle, curval, maxstep, delay, kwargs):
+        self.handle = handle
+        self.curval = curval
+        self.maxstep = maxstep
+        self.delay = delay / 1000.0
+        self.kwargs = kwargs
+        self.next_time = exact_time()
+
+    def next_value(self):
+        target = self.handle._target
+        delta = target - self.curval
+        if math.fabs(delta) > self.maxstep:
+            if delta > 0:
+                return self.curval + self.maxstep
+            else:
+                return self.curval - self.maxstep
+        return target
+
+class RampEngine():
+    '''
+    Ramp instrument parameters with a 'maxstep' option concurrently.
+    Instrument.set() uses it for all such parameters; a blocking set
+    waits for its ramp while handling events.
+
+    All active ramps share a single gobject timer, so the GUI stays
+    responsive. Steps that are due at the same time for the same
+    instrument are sent in a single call if the driver implements
+    do_set_batch(values), where values is a dictionary of
+    parameter -> value. All ramps are aborted on a flow stop request.
+    '''
+
+    def __init__(self):
+        self._ramps = []
+        self._timer_hid = None
+        self._timer_time = None
+        self._stop_hid = None
+
+    def start(self, ins, name, value, **kwargs):
+        '''
+        Start ramping parameter 'name' of instrument 'ins' to 'value'.
+        A ramp that is already running for this parameter is aborted.
+
+        Output: RampHandle
+        '''
+
+        self.abort_parameter(ins, name)
+
+        p = ins.get_parameter_options(name)
+        delay = p.get('stepdelay', 50)
+        handle = RampHandle(ins, name, value)
+        self._ramps.append(_Ramp(handle, p['value'], p['maxstep'],
+                delay, kwargs))
+
+        if self._stop_hid is None:
+            self._stop_hid = get_flowcontrol().connect('stop-request',
+                    self._stop_request_cb)
+
+        self._schedule()
+        return handle
+
+    def abort(self, handle):
+        '''Abort the ramp belonging to 'handle'.'''
+        for r in self._ramps:
+            if r.handle is handle:
+                self._ramps.remove(r)
+                handle._aborted = True
+                handle._done = True
+                logging.info('Ramp of %s.%s aborted at %r',
+                    handle._ins.get_name(), handle._name, r.curval)
+                break
+
+    def abort_parameter(self, ins, name):
+        '''Abort the ramp of parameter 'name' of 'ins', if running.'''
+        for r in self._ramps:
+            if r.handle._ins is ins and r.handle._name == name:
+                self.abort(r.handle)
+                break
+
+    def abort_all(self):
+        '''Abort all running ramps.'''
+        for r in list(self._ramps):
+            self.abort(r.handle)
+
+    def get_active(self):
+        '''Return list of handles of running ramps.'''
+        return [r.handle for r in self._ramps]
+
+    def _stop_request_cb(self, sender):
+        self.abort_all()
+
+    def _schedule(self):
+        if len(self._ramps) == 0:
+            return
+
+        next_time = min([r.next_time for r in self._ramps])
+        if self._timer_hid is not None:
+            if self._timer_time <= next_time:
+                return
+            gobject.source_remove(self._timer_hid)
+
+        delay = max(0, int((next_time - exact_time()) * 1000))
+        self._timer_time = next_time
+        self._timer_hid = gobject.timeout_add(delay, self._timeout_cb)
+
+    def _timeout_cb(self):
+        self._timer_hid = None
+        self._timer_time = None
+
+        now = exact_time()
+        due = {}
+        for r in self._ramps:
+            if r.next_time <= now:
+                ins = r.handle._ins
+                if ins not in due:
+                    due[ins] = []
+                due[ins].append(r)
+
+        for ins, ramps in due.iteritems():
+            self._do_steps(ins, ramps)
+
+        self._schedule()
+        return False
+
+    def _do_steps(self, ins, ramps):
+        steps = [(r, r.next_value()) for r in ramps]
+
+        if ins.USE_ACCESS_LOCK and not ins._access_lock.acquire():
+            logging.warning('Failed to acquire lock, delaying ramp step')
+            for r in ramps:
+                r.next_time = exact_time() + r.delay
+            return
+
+        try:
+            if len(steps) > 1 and hasattr(ins, 'do_set_batch'):
+                ins.do_set_batch(dict([(r.handle._name, val) \
+                        for r, val in steps]))
+            else:
+                for r, val in steps:
+                    func = ins.get_parameter_options(r.handle._name)['set_func']
+                    func(val, **r.kwargs)
+        except Exception, e:
+            logging.error('Ramp step on %s failed: %s', ins.get_name(), e)
+            for r in ramps:
+                self.abort(r.handle)
+            return
+        finally:
+            if ins.USE_ACCESS_LOCK:
+                ins._access_lock.release()
+
+        changed = {}
+        for r, val in steps:
+            r.curval = val
+            name = r.handle._name
+            if val == r.handle._target:
+                self._ramps.remove(r)
+                changed[name] = ins._store_set_value(name, val, **r.kwargs)
+                r.handle._done = True
+            else:
+                p = ins.get_parameter_options(name)
+                p['value'] = val
+                p['value_time'] = time.time()
+                changed[name] = val
+                r.next_time = exact_time() + r.delay
+
+        ins._queue_changed(changed)
+
+_ramp_engine = None
+def get_ramp_engine():
+    global _ramp_engine
+    if _ramp_engine is None:
+        _ramp_engine = RampEngine()
+    return _ramp_engine
@@ -0,0 +1,190 @@
+# rasterscan.py, hardware-timed 2D raster scans with a photon counter
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Raster scan engine. The complete trajectory (see lib.trajectory.raster)
+is streamed in chunks to a single continuous analog output task, while a
+counter latched on the output sample clock is read back. The counts are
+differentiated and sorted into an image, and completed lines are handed
+to the consumer:
+
+    traj, index, line_end = trajectory.raster(xv, yv)
+    source = nidaq_stream.AOCounterSource(...)
+    scan = rasterscan.RasterScan(source, traj, index, line_end, (ny, nx))
+    scan.start()
+    while not scan.is_done():
+        item = scan.get_line()
+        ...
+
+The source has to implement the AOCounterSource interface of
+lib.dll_support.nidaq_stream.
+'''
+
+import logging
+import numpy
+
+from lib import streaming
+
+class RasterScan():
+    '''
+    Streams a raster trajectory to an output / counter source in a
+    background thread and assembles the image. Completed lines are
+    available from get_line() as dictionaries with 'line' (row number) and
+    'values' (counts per pixel, in column order).
+    '''
+
+    def __init__(self, source, traj, index, line_end, shape, timeout=2.0):
+        '''
+        Input:
+            source: AOCounterSource or SimulatedAOCounterSource
+            traj (float64[naxes, n]): output trajectory
+            index (int64[n]): flat pixel index per sample, or -1
+            line_end (int64[nlines]): last pixel sample of each line
+            shape (tuple): (nlines, npixels) of the image
+            timeout (float): maximum time to wait for the hardware
+        '''
+
+        self._source = source
+        self._traj = numpy.asarray(traj, dtype=numpy.float64)
+        self._index = numpy.asarray(index, dtype=numpy.int64)
+        self._line_end = numpy.asarray(line_end, dtype=numpy.int64)
+        self._shape = shape
+        self._timeout = timeout
+        self._image = numpy.zeros(shape, dtype=numpy.float64)
+
+        # Lines are never dropped
+        self._queue = streaming.DataQueue(len(self._line_end) + 1)
+        self._thread = None
+        self._buffer = None
+        self._reset()
+
+    def _reset(self):
+        self._written = 0
+        self._nsamples = 0
+        self._last_count = 0
+        self._lines_done = 0
+        self._done = False
+        self._image[:] = 0
+
+    def get_image(self):
+        '''Return the counts image, float64[nlines, npixels].'''
+        return self._image
+
+    def get_lines_done(self):
+        return self._lines_done
+
+    def get_progress(self):
+        '''Return the fraction of lines completed.'''
+        return self._lines_done / float(len(self._line_end))
+
+    def get_duration(self):
+        '''Return the scan duration in seconds.'''
+        return self._traj.shape[1] / self._source.freq
+
+    def get_error(self):
+        if self._thread is None:
+            return None
+        return self._thread.get_error()
+
+    def is_done(self):
+        '''Return whether the scan finished or was aborted.'''
+        if self._done:
+            return True
+        return self._thread is not None and not self._thread.isAlive()
+
+    def start(self):
+        self._reset()
+        nprefill = min(self._source.bufsize, self._traj.shape[1])
+        self._buffer = numpy.zeros((self._source.nchannels,
+            self._source.chunk), dtype=self._source.get_dtype())
+
+        logging.debug('Starting raster scan of %d samples', self._traj.shape[1])
+        self._source.start(self._traj[:,:nprefill])
+        self._written = nprefill
+        self._thread = streaming.StreamThread(self._read, queue=self._queue,
+            name='raster scan', multiple=True)
+        self._thread.start()
+
+    def stop(self):
+        '''Abort the scan.'''
+        if self._thread is not None:
+            self._thread.stop()
+        self._source.stop()
+
+    def get_line(self, timeout=1.0):
+        '''Return the next completed line, or None after timeout seconds.'''
+        return self._queue.get(timeout)
+
+    def get_lines(self):
+        '''Return list of all completed lines not retrieved yet.'''
+        return self._queue.get_all()
+
+    def _next_chunk(self):
+        '''
+        Return the next chunk of the trajectory. Once it is exhausted the
+        output stays at the last position until all counts are read.
+        '''
+        n = self._source.chunk
+        chunk = self._traj[:,self._written:self._written+n]
+        self._written += chunk.shape[1]
+        if chunk.shape[1] < n:
+            pad = numpy.repeat(self._traj[:,-1:], n - chunk.shape[1], axis=1)
+            chunk = numpy.concatenate((chunk, pad), axis=1)
+        return chunk
+
+    def _read(self):
+        if self._done:
+            return []
+
+        # Keep the output buffer filled, the counter runs at the same rate
+        self._source.write(self._next_chunk(), self._timeout)
+        n = self._source.read(self._buffer, self._timeout)
+        if self._source.check_overrun():
+            raise RuntimeError('Scan output or counter buffer overrun')
+        if n == 0:
+            return []
+
+        counts = self._buffer[0,:n].astype(numpy.int64)
+        diff = numpy.diff(numpy.concatenate(([self._last_count], counts)))
+        diff[diff < 0] += 2**32
+        self._last_count = counts[-1]
+
+        # Counter sample s is latched at the start of output sample s, so it
+        # contains the counts of output sample s - 1.
+        ntraj = self._traj.shape[1]
+        t = numpy.arange(self._nsamples - 1, self._nsamples - 1 + n)
+        self._nsamples += n
+        valid = (t >= 0) & (t < ntraj)
+        t = t[valid]
+        diff = diff[valid]
+        pix = self._index[t]
+        mask = pix >= 0
+        self._image.flat[pix[mask]] = diff[mask]
+
+        items = []
+        processed = min(self._nsamples - 1, ntraj)
+        nlines = len(self._line_end)
+        while self._lines_done < nlines and \
+                self._line_end[self._lines_done] < processed:
+            j = self._lines_done
+            items.append({'line': j, 'values': self._image[j].copy()})
+            self._lines_done += 1
+
+        if self._lines_done == nlines:
+            self._done = True
+            self._thread.stop()
+            self._source.stop()
+        return items
@@ -0,0 +1,174 @@
+# streaming.py, background acquisition threads and bounded data queues
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Helpers for drivers that acquire data continuously. A StreamThread calls a
+read function in a loop and hands the results to callbacks and / or a
+DataQueue, from which the measurement script picks them up:
+
+    queue = streaming.DataQueue(16)
+    thread = streaming.StreamThread(self._read_block, queue=queue)
+    thread.start()
+    ...
+    data = queue.get(timeout=1)
+    ...
+    thread.stop()
+
+Callbacks are executed in the acquisition thread, so they should be short
+and must not call gtk functions.
+'''
+
+import logging
+import threading
+import Queue
+
+class DataQueue():
+    '''
+    Bounded queue between an acquisition thread and its consumer.
+
+    If the queue is full new items are dropped and counted as overruns;
+    get() calls that time out without data are counted as underruns.
+    '''
+
+    def __init__(self, maxsize=16):
+        self._queue = Queue.Queue(maxsize)
+        self._lock = threading.Lock()
+        self.reset_counters()
+
+    def reset_counters(self):
+        self._lock.acquire()
+        self._overruns = 0
+        self._underruns = 0
+        self._lock.release()
+
+    def get_overruns(self):
+        return self._overruns
+
+    def get_underruns(self):
+        return self._underruns
+
+    def put(self, item):
+        '''Add item, returns False if it was dropped.'''
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except Queue.Full:
+            self._lock.acquire()
+            self._overruns += 1
+            self._lock.release()
+            return False
+
+    def get(self, timeout=1.0):
+        '''
+        Return next item, or None if nothing arrived within timeout seconds.
+        '''
+        try:
+            if timeout is None:
+                return self._queue.get()
+            return self._queue.get(True, timeout)
+        except Queue.Empty:
+            self._lock.acquire()
+            self._underruns += 1
+            self._lock.release()
+            return None
+
+    def get_all(self):
+        '''Return list of all items currently in the queue.'''
+        ret = []
+        while True:
+            try:
+                ret.append(self._queue.get_nowait())
+            except Queue.Empty:
+                return ret
+
+    def clear(self):
+        self.get_all()
+
+    def qsize(self):
+        return self._queue.qsize()
+
+class StreamThread(threading.Thread):
+    '''
+    Thread calling read_func() until stop() is called. Each value returned
+    that is not None is passed to the callbacks and put in the queue. With
+    multiple=True read_func returns a list of items instead.
+    '''
+
+    def __init__(self, read_func, queue=None, name=None, multiple=False):
+        threading.Thread.__init__(self, name=name)
+        self.setDaemon(True)
+
+        self._read_func = read_func
+        self._queue = queue
+        self._multiple = multiple
+        self._callbacks = []
+        self._stop_event = threading.Event()
+        self._error = None
+        self._nitems = 0
+
+    def add_callback(self, func):
+        self._callbacks.append(func)
+
+    def remove_callback(self, func):
+        if func in self._callbacks:
+            self._callbacks.remove(func)
+
+    def run(self):
+        while not self._stop_event.isSet():
+            try:
+                item = self._read_func()
+            except Exception, e:
+                logging.exception('Error in acquisition thread %s',
+                    self.getName())
+                self._error = e
+                break
+
+            if item is None:
+                continue
+            if self._multiple:
+                for i in item:
+                    self._add_item(i)
+            else:
+                self._add_item(item)
+
+    def _add_item(self, item):
+        self._nitems += 1
+        for func in self._callbacks:
+            try:
+                func(item)
+            except Exception, e:
+                logging.exception('Error in stream callback %s', func)
+        if self._queue is not None:
+            self._queue.put(item)
+
+    def stop(self, timeout=5.0):
+        '''Ask the thread to stop and wait for it to finish.'''
+        self._stop_event.set()
+        if self.isAlive() and threading.currentThread() is not self:
+            self.join(timeout)
+            if self.isAlive():
+                logging.warning('Acquisition thread %s did not stop',
+                    self.getName())
+
+    def is_stopping(self):
+        return self._stop_event.isSet()
+
+    def get_error(self):
+        '''Return the exception that ended the thread, if any.'''
+        return self._error
+
+    def get_item_count(self):
+        return self._nitems
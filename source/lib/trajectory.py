@@ -0,0 +1,161 @@
+# trajectory.py, precomputed output trajectories for scanning stages
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Functions that compute complete output trajectories as numpy arrays, so
+that they can be written with hardware timing instead of point by point.
+
+A trajectory is a float64[naxes, nsamples] array of output values, one
+row per axis. Raster trajectories also return a pixel index per sample,
+that is -1 for samples that are not part of the image (settling and
+moves between lines).
+
+Smooth moves and rasters are all built from smooth_ramp(), and
+check_bounds() validates a complete trajectory before it is written.
+'''
+
+import numpy
+
+def smooth_ramp(v0, v1, n):
+    '''
+    Return n points moving from v0 to v1 with a cosine velocity profile,
+    starting at v0 and ending at v1.
+    '''
+
+    n = int(n)
+    if n <= 0:
+        return numpy.zeros(0)
+    if n == 1:
+        return numpy.array([v1], dtype=numpy.float64)
+    phase = numpy.linspace(0.0, numpy.pi, n)
+    return v0 + (v1 - v0) * (1.0 - numpy.cos(phase)) / 2.0
+
+def as_trajectory(values):
+    '''Return values as float64[naxes, n], a 1D array is a single axis.'''
+    traj = numpy.asarray(values, dtype=numpy.float64)
+    if traj.ndim == 1:
+        traj = traj[numpy.newaxis,:]
+    return traj
+
+def smooth_move(start, stop, steps_per_unit, min_steps=2):
+    '''
+    Compute a smooth move of all axes from start to stop. The number of
+    samples is set by the axis that moves furthest.
+
+    Input:
+        start, stop (float or array): positions, one per axis
+        steps_per_unit (float): samples per unit of the largest distance
+        min_steps (int): minimum number of samples of a move
+
+    Output:
+        float64[naxes, n] trajectory, n is 0 if there is nothing to move
+    '''
+
+    start = numpy.atleast_1d(numpy.asarray(start, dtype=numpy.float64))
+    stop = numpy.atleast_1d(numpy.asarray(stop, dtype=numpy.float64))
+    dist = numpy.abs(stop - start).max()
+    if dist == 0:
+        return numpy.zeros((len(start), 0))
+    n = max(int(numpy.ceil(dist * steps_per_unit)), min_steps)
+    phase = (1.0 - numpy.cos(numpy.linspace(0.0, numpy.pi, n))) / 2.0
+    return start[:,numpy.newaxis] + numpy.outer(stop - start, phase)
+
+def check_bounds(traj, minv, maxv, names=None):
+    '''
+    Raise ValueError if any sample of the trajectory is outside
+    [minv, maxv]. The limits can be scalars or one value per axis.
+    '''
+
+    traj = as_trajectory(traj)
+    if traj.shape[1] == 0:
+        return
+    minv = numpy.resize(numpy.asarray(minv, dtype=numpy.float64), traj.shape[0])
+    maxv = numpy.resize(numpy.asarray(maxv, dtype=numpy.float64), traj.shape[0])
+    bad = (traj.min(axis=1) < minv) | (traj.max(axis=1) > maxv)
+    if bad.any():
+        i = numpy.nonzero(bad)[0][0]
+        if names is not None:
+            axis = names[i]
+        else:
+            axis = 'axis %d' % i
+        raise ValueError('Trajectory exceeds bounds [%s, %s] on %s' % \
+            (minv[i], maxv[i], axis))
+
+def raster(x, y, snake=True, settle=0, move=10):
+    '''
+    Compute a 2D raster trajectory. Lines run along x; the line at y[j]
+    is followed by a smooth move to the start of the next line. With
+    snake=True every other line runs backwards, otherwise the x axis flies
+    back to x[0] during the move.
+
+    Input:
+        x (array): pixel positions along a line
+        y (array): line positions
+        snake (bool): alternate line direction
+        settle (int): samples to wait at the start of each line
+        move (int): samples used to move to the next line
+
+    Output:
+        (traj, index, line_end)
+        traj: float64[2, n] x and y values
+        index: int64[n] flat pixel index (row * len(x) + column) or -1
+        line_end: int64[len(y)] index of the last pixel sample of each line
+    '''
+
+    x = numpy.asarray(x, dtype=numpy.float64)
+    y = numpy.asarray(y, dtype=numpy.float64)
+    nx = len(x)
+    ny = len(y)
+    columns = numpy.arange(nx)
+
+    xs = []
+    ys = []
+    idxs = []
+    line_end = numpy.zeros(ny, dtype=numpy.int64)
+    nsamples = 0
+    for j in range(ny):
+        if snake and j % 2 == 1:
+            cols = columns[::-1]
+        else:
+            cols = columns
+
+        # Settle at the start of the line
+        xs.append(numpy.repeat(x[cols[0]], settle))
+        ys.append(numpy.repeat(y[j], settle))
+        idxs.append(numpy.repeat(-1, settle))
+
+        xs.append(x[cols])
+        ys.append(numpy.repeat(y[j], nx))
+        idxs.append(j * nx + cols)
+        nsamples += settle + nx
+        line_end[j] = nsamples - 1
+
+        if j == ny - 1:
+            break
+
+        # Move to the start of the next line
+        if snake:
+            xnext = x[cols[-1]]
+        else:
+            xnext = x[0]
+        xs.append(smooth_ramp(x[cols[-1]], xnext, move))
+        ys.append(smooth_ramp(y[j], y[j+1], move))
+        idxs.append(numpy.repeat(-1, move))
+        nsamples += move
+
+    traj = numpy.vstack((numpy.concatenate(xs), numpy.concatenate(ys)))
+    index = numpy.concatenate(idxs).astype(numpy.int64)
+    return traj, index, line_end
@@ -0,0 +1,142 @@
+# uploadcache.py, keep track of data already present on an instrument
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Drivers that upload large amounts of data (e.g. AWG waveforms) can use an
+UploadCache to skip transfers of data that is already on the instrument:
+
+    digest = uploadcache.digest(data)
+    if not self._upload_cache.is_current(('wfm', name), digest, len(data)):
+        self._visainstrument.write(data)
+        self._upload_cache.store(('wfm', name), digest)
+
+Keys are tuples, the first element is the category that can be passed to
+invalidate(). The cache only knows what was sent through it, so it should
+be invalidated whenever the instrument state might have changed in another
+way (reset, reconnect, clearing memory).
+'''
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+import logging
+import numpy
+
+def digest(*parts):
+    '''
+    Return content hash of strings, numbers or numpy arrays.
+    '''
+
+    h = md5()
+    for part in parts:
+        if hasattr(part, 'tostring'):
+            h.update(str(part.dtype))
+            h.update(part.tostring())
+        elif isinstance(part, str):
+            h.update(part)
+        else:
+            h.update(repr(part))
+        h.update('\x00')
+    return h.hexdigest()
+
+def digest_data(parts):
+    '''
+    Return content hash of the raw bytes of a sequence of strings and numpy
+    arrays, equal to digest() of the joined string.
+    '''
+
+    h = md5()
+    for part in parts:
+        if isinstance(part, numpy.ndarray):
+            part = buffer(numpy.ascontiguousarray(part))
+        h.update(part)
+    h.update('\x00')
+    return h.hexdigest()
+
+class UploadCache():
+    '''
+    Map of key -> content digest for data present on an instrument.
+    '''
+
+    def __init__(self, name=''):
+        self._name = name
+        self._entries = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        self._hits = 0
+        self._misses = 0
+        self._bytes_saved = 0
+        self._bytes_sent = 0
+
+    def is_current(self, key, digest, nbytes=0):
+        '''
+        Return whether 'key' with content 'digest' is on the instrument.
+        Updates the hit / miss statistics; nbytes is the transfer size.
+        '''
+
+        if self._entries.get(key, None) == digest:
+            self._hits += 1
+            self._bytes_saved += nbytes
+            return True
+
+        self._misses += 1
+        self._bytes_sent += nbytes
+        return False
+
+    def store(self, key, digest):
+        '''Record that 'key' with content 'digest' is on the instrument.'''
+        self._entries[key] = digest
+
+    def remove(self, key):
+        if key in self._entries:
+            del self._entries[key]
+
+    def invalidate(self, category=None):
+        '''
+        Forget entries of 'category', or all entries if category is None.
+        '''
+
+        if category is None:
+            logging.debug('Upload cache %s: invalidating all entries',
+                self._name)
+            self._entries = {}
+            return
+
+        for key in self._entries.keys():
+            if key[0] == category:
+                del self._entries[key]
+
+    def get_keys(self, category=None):
+        if category is None:
+            return self._entries.keys()
+        return [k for k in self._entries.keys() if k[0] == category]
+
+    def get_stats(self):
+        '''
+        Return dictionary with hits, misses, number of entries and the
+        number of bytes saved / sent.
+        '''
+
+        return {
+            'hits': self._hits,
+            'misses': self._misses,
+            'entries': len(self._entries),
+            'bytes_saved': self._bytes_saved,
+            'bytes_sent': self._bytes_sent,
+        }
@@ -17,6 +17,8 @@
 
 import time
 import logging
+import warnings
+from misc import exact_time
 try:
     from visa import *
     from pyvisa import vpp43
@@ -56,15 +58,14 @@ def read_all(visains):
         warnings.filterwarnings("ignore", "VI_SUCCESS_MAX_CNT")
         _added_filter = True
 
+    chunks = []
     try:
-        buf = ""
         blen = get_navail(visains)
         while blen > 0:
-            chunk = vpp43.read(visains, blen)
-            buf += chunk
+            chunks.append(vpp43.read(visains, blen))
             blen = get_navail(visains)
     except:
         pass
 
-    return buf
+    return ''.join(chunks)
 
@@ -0,0 +1,444 @@
+# visaio.py, shared VISA I/O layer with binary block transfers.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Drivers can opt into this module by wrapping their visa instrument:
+
+    self._io = visaio.VisaIO(self._visainstrument)
+    data = self._io.ask_block('CURV?', 'INT16', endian='big')
+
+Reads go into a preallocated receive buffer and binary blocks are
+returned as numpy arrays that use the buffer memory directly. For testing
+and benchmarking without hardware use MockVisaBackend:
+
+    io = visaio.VisaIO(visaio.MockVisaBackend({'CURV?':
+        visaio.make_block(numpy.arange(1000), 'INT16')}))
+'''
+
+import ctypes
+import logging
+import warnings
+import numpy as np
+
+try:
+    from pyvisa import vpp43
+    from pyvisa.visa_exceptions import VisaIOError
+    _VISA_ERRORS = (VisaIOError, )
+except:
+    vpp43 = None
+    _VISA_ERRORS = ()
+
+# Partial reads are expected when reading in chunks
+warnings.filterwarnings('ignore', 'VI_SUCCESS_MAX_CNT')
+
+# Name -> numpy type character (without byte order)
+FORMATS = {
+    'INT8': 'i1',
+    'UINT8': 'u1',
+    'INT16': 'i2',
+    'UINT16': 'u2',
+    'INT32': 'i4',
+    'UINT32': 'u4',
+    'REAL32': 'f4',
+    'REAL64': 'f8',
+}
+
+_ENDIAN = {
+    'big': '>',
+    'little': '<',
+}
+
+def get_dtype(fmt, endian='big'):
+    '''
+    Return numpy dtype for a transfer format.
+
+    Input:
+        fmt (string): one of the keys of FORMATS, or a numpy dtype
+        endian (string): 'big' or 'little'
+    '''
+
+    if fmt in FORMATS:
+        return np.dtype(_ENDIAN[endian] + FORMATS[fmt])
+    return np.dtype(fmt)
+
+def make_block(data, fmt='REAL32', endian='big'):
+    '''
+    Return IEEE-488.2 definite length block containing 'data'.
+    '''
+
+    raw = np.asarray(data, dtype=get_dtype(fmt, endian)).tostring()
+    nbytes = str(len(raw))
+    return '#%d%s%s' % (len(nbytes), nbytes, raw)
+
+def make_block_header(nbytes):
+    '''
+    Return header of a definite length block of nbytes.
+    '''
+
+    nbytes = str(nbytes)
+    return '#%d%s' % (len(nbytes), nbytes)
+
+def get_stream_size(parts):
+    '''
+    Return the number of bytes in a sequence of strings and numpy arrays.
+    '''
+
+    size = 0
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            size += part.nbytes
+        else:
+            size += len(part)
+    return size
+
+class Vpp43Backend():
+    '''
+    Backend performing raw reads and writes on a VISA session using vpp43.
+    '''
+
+    def __init__(self, ins):
+        '''
+        Input:
+            ins: pyvisa instrument object, or VISA session handle
+        '''
+        self._vi = getattr(ins, 'vi', ins)
+
+    def write(self, data):
+        vpp43.write(self._vi, data)
+
+    def write_stream(self, chunks):
+        '''
+        Write chunks as a single message: END is only sent with the last.
+        '''
+
+        vpp43.set_attribute(self._vi, vpp43.VI_ATTR_SEND_END_EN,
+            vpp43.VI_FALSE)
+        try:
+            last = None
+            for chunk in chunks:
+                if last is not None:
+                    vpp43.write(self._vi, last)
+                last = chunk
+        finally:
+            vpp43.set_attribute(self._vi, vpp43.VI_ATTR_SEND_END_EN,
+                vpp43.VI_TRUE)
+        if last is not None:
+            vpp43.write(self._vi, last)
+
+    def readinto(self, buf, offset, nbytes):
+        '''
+        Read at most nbytes into numpy uint8 array 'buf' at 'offset'.
+        Returns the number of bytes read. VISA errors (e.g. a timeout) are
+        raised as IOError, with the VISA code in 'error_code'.
+        '''
+
+        try:
+            try:
+                lib = vpp43.visa_library()
+                read = lib.viRead
+            except AttributeError:
+                data = vpp43.read(self._vi, nbytes)
+                buf[offset:offset+len(data)] = np.frombuffer(data,
+                    dtype=np.uint8)
+                return len(data)
+
+            # viRead's buffer is declared as ViPBuf (c_char_p)
+            count = ctypes.c_uint32(0)
+            ptr = ctypes.cast(buf.ctypes.data + offset, ctypes.c_char_p)
+            read(self._vi, ptr, nbytes, ctypes.byref(count))
+            return count.value
+        except _VISA_ERRORS, e:
+            err = IOError(str(e))
+            err.error_code = getattr(e, 'error_code', None)
+            raise err
+
+class MockVisaBackend():
+    '''
+    In-memory VISA backend to test and benchmark without hardware.
+
+    Written commands are recorded in 'writes'. If a command is a key of
+    'responses' the value (a string, or a function returning a string) is
+    appended to the read buffer. Reads return at most 'max_chunk' bytes at
+    a time to mimic the instrument's transfer size.
+    '''
+
+    def __init__(self, responses=None, max_chunk=None):
+        if responses is None:
+            responses = {}
+        self.responses = responses
+        self.max_chunk = max_chunk
+        self.writes = []
+        self._out = ''
+        self._pos = 0
+
+    def queue(self, data):
+        '''Add data to the read buffer.'''
+        self._out = self._out[self._pos:] + data
+        self._pos = 0
+
+    def write(self, data):
+        self.writes.append(data)
+        resp = self.responses.get(data.strip(), None)
+        if callable(resp):
+            resp = resp()
+        if resp is not None:
+            self.queue(resp)
+
+    def write_stream(self, chunks):
+        self.write(''.join(chunks))
+
+    def readinto(self, buf, offset, nbytes):
+        if self.max_chunk is not None:
+            nbytes = min(nbytes, self.max_chunk)
+        nbytes = min(nbytes, len(self._out) - self._pos)
+        if nbytes <= 0:
+            raise IOError('Mock VISA read timeout')
+        buf[offset:offset+nbytes] = np.frombuffer(self._out, dtype=np.uint8,
+            count=nbytes, offset=self._pos)
+        self._pos += nbytes
+        return nbytes
+
+class VisaIO():
+    '''
+    Buffered VISA I/O with IEEE-488.2 binary block support.
+    '''
+
+    def __init__(self, ins, chunk_size=65536, term_chars='\n',
+            buffer_size=65536):
+        '''
+        Input:
+            ins: pyvisa instrument, VISA session or backend object
+                (anything with write() and readinto() methods)
+            chunk_size (int): maximum number of bytes per read call
+            term_chars (string): termination of text responses and the
+                optional terminator after binary blocks
+            buffer_size (int): initial receive buffer size
+        '''
+
+        if hasattr(ins, 'readinto'):
+            self._backend = ins
+        else:
+            self._backend = Vpp43Backend(ins)
+
+        self._chunk_size = chunk_size
+        self._term_chars = term_chars
+        self._buf = np.empty(buffer_size, dtype=np.uint8)
+
+        # Bytes that were read but not yet consumed, buf[_start:_end]
+        self._start = 0
+        self._end = 0
+
+    def set_chunk_size(self, size):
+        self._chunk_size = size
+
+    def get_chunk_size(self):
+        return self._chunk_size
+
+    def set_term_chars(self, term_chars):
+        self._term_chars = term_chars
+
+    def get_term_chars(self):
+        return self._term_chars
+
+    def clear(self):
+        '''Discard buffered data.'''
+        self._start = 0
+        self._end = 0
+
+    def write(self, cmd):
+        self._backend.write(cmd)
+
+    def _iter_chunks(self, parts):
+        for part in parts:
+            if isinstance(part, np.ndarray):
+                raw = np.ascontiguousarray(part).reshape(-1).view(np.uint8)
+                for i in range(0, len(raw), self._chunk_size):
+                    yield raw[i:i+self._chunk_size].tostring()
+            elif len(part) > 0:
+                yield part
+
+    def write_stream(self, parts):
+        '''
+        Write a message consisting of strings and numpy arrays (raw data)
+        without joining them in memory. Arrays are sent in pieces of at
+        most chunk_size bytes.
+        '''
+
+        chunks = self._iter_chunks(parts)
+        if hasattr(self._backend, 'write_stream'):
+            self._backend.write_stream(chunks)
+        else:
+            for chunk in chunks:
+                self._backend.write(chunk)
+
+    def _ensure_space(self, nbytes):
+        '''Make room for nbytes after the buffered data.'''
+        navail = self._end - self._start
+        if self._start > 0:
+            self._buf[:navail] = self._buf[self._start:self._end]
+            self._start = 0
+            self._end = navail
+        if len(self._buf) < navail + nbytes:
+            newbuf = np.empty(max(navail + nbytes, 2 * len(self._buf)),
+                dtype=np.uint8)
+            newbuf[:navail] = self._buf[:navail]
+            self._buf = newbuf
+
+    def _fill(self, nbytes):
+        '''Read until at least nbytes are buffered.'''
+        if self._end - self._start >= nbytes:
+            return
+        self._ensure_space(nbytes)
+
+        while self._end - self._start < nbytes:
+            n = self._backend.readinto(self._buf, self._end,
+                min(self._chunk_size, len(self._buf) - self._end))
+            if n <= 0:
+                raise IOError('VISA read returned no data')
+            self._end += n
+
+    def _take(self, nbytes):
+        ret = self._buf[self._start:self._start+nbytes]
+        self._start += nbytes
+        if self._start == self._end:
+            self._start = 0
+            self._end = 0
+        return ret
+
+    def read_raw(self, nbytes):
+        '''Read exactly nbytes, return as string.'''
+        self._fill(nbytes)
+        return self._take(nbytes).tostring()
+
+    def read(self):
+        '''Read up to the termination characters, return without them.'''
+
+        term = self._term_chars
+        tlen = len(term)
+        pos = 0
+        while True:
+            data = self._buf[self._start:self._end].tostring()
+            idx = data.find(term, pos)
+            if idx >= 0:
+                self._take(idx + tlen)
+                return data[:idx]
+            pos = max(0, len(data) - tlen + 1)
+            self._fill(len(data) + 1)
+
+    def ask(self, cmd):
+        self.write(cmd)
+        return self.read()
+
+    def read_values(self, sep=',', dtype=np.float64):
+        '''Read text response of separated numbers into numpy array.'''
+        return np.fromstring(self.read(), dtype=dtype, sep=sep)
+
+    def ask_values(self, cmd, sep=',', dtype=np.float64):
+        self.write(cmd)
+        return self.read_values(sep=sep, dtype=dtype)
+
+    def read_block(self, fmt='REAL32', endian='big', out=None):
+        '''
+        Read IEEE-488.2 definite length block '#<n><length><data>'.
+
+        Input:
+            fmt (string): data format, see FORMATS
+            endian (string): 'big' or 'little'
+            out (numpy array): optional array to read the data into, it
+                should be contiguous and large enough. If its dtype differs
+                from the transfer format (e.g. native instead of big
+                endian), the values are converted in place.
+        Output:
+            numpy array. If 'out' is given this is the part of 'out' that
+            was filled, with the dtype of 'out'. Otherwise it is a view on
+            the receive buffer, which is only valid until the next read.
+            Use copy() to keep it.
+        '''
+
+        dtype = get_dtype(fmt, endian)
+
+        # Skip whitespace / separators before the header
+        self._fill(1)
+        while chr(self._buf[self._start]) != '#':
+            self._take(1)
+            self._fill(1)
+
+        self._fill(2)
+        ndigits = int(chr(self._buf[self._start + 1]))
+        if ndigits == 0:
+            raise ValueError('Indefinite length blocks are not supported')
+        self._fill(2 + ndigits)
+        nbytes = int(self._buf[self._start+2:self._start+2+ndigits].tostring())
+        self._take(2 + ndigits)
+
+        if out is not None:
+            n = nbytes // dtype.itemsize
+            flat = out.reshape(-1)
+            if flat.size < n or not out.flags.c_contiguous:
+                raise ValueError('Output array too small or not contiguous')
+            if out.nbytes >= nbytes:
+                # Receive directly into the memory of 'out'
+                raw = flat.view(np.uint8)
+                nbuf = min(nbytes, self._end - self._start)
+                raw[:nbuf] = self._take(nbuf)
+                while nbuf < nbytes:
+                    nread = self._backend.readinto(raw, nbuf,
+                        min(self._chunk_size, nbytes - nbuf))
+                    if nread <= 0:
+                        raise IOError('VISA read returned no data')
+                    nbuf += nread
+                wire = raw[:nbytes].view(dtype)
+            else:
+                self._fill(nbytes)
+                wire = self._take(nbytes).view(dtype)
+            if out.dtype != dtype:
+                # numpy buffers overlapping copies
+                flat[:n] = wire
+            ret = flat[:n]
+        else:
+            self._fill(nbytes)
+            ret = self._take(nbytes).view(dtype)
+
+        self._skip_term()
+        return ret
+
+    def _skip_term(self):
+        '''Consume terminator following a block, if present.'''
+        if not self._term_chars:
+            return
+        tlen = len(self._term_chars)
+        if self._end - self._start >= tlen:
+            if self._buf[self._start:self._start+tlen].tostring() == \
+                    self._term_chars:
+                self._take(tlen)
+            return
+        try:
+            self._fill(tlen)
+            if self._buf[self._start:self._start+tlen].tostring() == \
+                    self._term_chars:
+                self._take(tlen)
+        except (IOError, ) + _VISA_ERRORS:
+            pass
+
+    def ask_block(self, cmd, fmt='REAL32', endian='big', out=None):
+        self.write(cmd)
+        return self.read_block(fmt, endian, out=out)
+
+    def write_block(self, cmd, data, fmt='REAL32', endian='big'):
+        '''
+        Write 'cmd' followed by 'data' as definite length block.
+        '''
+        self.write(cmd + make_block(data, fmt, endian))
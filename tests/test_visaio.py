@@ -0,0 +1,128 @@
+# Tests of lib/visaio with the Vpp43Backend, using a stand-in for the
+# pyvisa 1.3 vpp43 module that checks arguments like the real library.
+#
+# Run from the qtlab directory: python tests/test_visaio.py
+
+import os
+import sys
+import ctypes
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'source'))
+from lib import visaio
+
+VI_ERROR_TMO = -1073807339
+
+class FakeVisaIOError(Exception):
+    def __init__(self, error_code):
+        Exception.__init__(self, 'VI_ERROR_TMO: Timeout expired')
+        self.error_code = error_code
+
+class FakeViRead():
+    '''viRead with the argtypes pyvisa 1.3 declares (ViPBuf = c_char_p).'''
+
+    argtypes = (ctypes.c_ulong, ctypes.c_char_p, ctypes.c_uint32,
+        ctypes.POINTER(ctypes.c_uint32))
+
+    def __init__(self, data, max_chunk=None):
+        self.data = data
+        self.pos = 0
+        self.max_chunk = max_chunk
+
+    def __call__(self, *args):
+        if len(args) != len(self.argtypes):
+            raise TypeError('viRead takes %d arguments' % len(self.argtypes))
+        for i, (typ, arg) in enumerate(zip(self.argtypes, args)):
+            try:
+                typ.from_param(arg)
+            except TypeError, e:
+                raise ctypes.ArgumentError('argument %d: %s' % (i + 1, e))
+
+        vi, buf, count, retcount = args
+        if self.pos >= len(self.data):
+            raise FakeVisaIOError(VI_ERROR_TMO)
+        n = min(count, len(self.data) - self.pos)
+        if self.max_chunk is not None:
+            n = min(n, self.max_chunk)
+        addr = ctypes.cast(buf, ctypes.c_void_p).value
+        ctypes.memmove(addr, self.data[self.pos:self.pos+n], n)
+        self.pos += n
+        retcount._obj.value = n
+        return 0
+
+class FakeLibrary():
+    def __init__(self, viread):
+        self.viRead = viread
+
+class FakeVpp43():
+    def __init__(self, data, max_chunk=None):
+        self.lib = FakeLibrary(FakeViRead(data, max_chunk))
+        self.written = []
+
+    def visa_library(self):
+        return self.lib
+
+    def write(self, vi, data):
+        self.written.append(data)
+
+class TestVpp43Backend(unittest.TestCase):
+
+    def setUp(self):
+        self._vpp43 = visaio.vpp43
+        self._errors = visaio._VISA_ERRORS
+        visaio._VISA_ERRORS = (FakeVisaIOError, )
+
+    def tearDown(self):
+        visaio.vpp43 = self._vpp43
+        visaio._VISA_ERRORS = self._errors
+
+    def make_io(self, data, max_chunk=None):
+        visaio.vpp43 = FakeVpp43(data, max_chunk)
+        return visaio.VisaIO(visaio.Vpp43Backend(1), chunk_size=16)
+
+    def test_read_text(self):
+        io = self.make_io('1.5,2.5\n')
+        self.assertEqual(io.read(), '1.5,2.5')
+
+    def test_read_block(self):
+        vals = np.arange(100, dtype=np.float32)
+        io = self.make_io(visaio.make_block(vals, 'REAL32', 'big') + '\n',
+            max_chunk=7)
+        ret = io.read_block('REAL32', 'big')
+        self.assertTrue(np.array_equal(ret, vals))
+
+    def test_read_block_native_out(self):
+        vals = np.arange(100, dtype=np.float32) * 1.5
+        io = self.make_io(visaio.make_block(vals, 'REAL32', 'big') + '\n')
+        out = np.zeros(100, dtype=np.float32)
+        ret = io.read_block('REAL32', 'big', out=out)
+        self.assertTrue(np.array_equal(out, vals))
+        self.assertTrue(np.array_equal(ret, vals))
+        self.assertEqual(ret.dtype, out.dtype)
+
+    def test_read_block_wider_out(self):
+        vals = np.arange(10, dtype=np.int16) - 5
+        io = self.make_io(visaio.make_block(vals, 'INT16', 'big'))
+        out = np.zeros(10, dtype=np.float64)
+        io.read_block('INT16', 'big', out=out)
+        self.assertTrue(np.array_equal(out, vals))
+
+    def test_block_without_terminator(self):
+        # The terminator check times out, which has to be ignored
+        vals = np.arange(4, dtype=np.int16)
+        io = self.make_io(visaio.make_block(vals, 'INT16', 'big'))
+        ret = io.read_block('INT16', 'big')
+        self.assertTrue(np.array_equal(ret, vals))
+
+    def test_timeout_is_ioerror(self):
+        io = self.make_io('')
+        try:
+            io.read()
+        except IOError, e:
+            self.assertEqual(e.error_code, VI_ERROR_TMO)
+        else:
+            self.fail('No IOError raised')
+
+if __name__ == '__main__':
+    unittest.main()